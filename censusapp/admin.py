@@ -1,10 +1,25 @@
+from django import forms
 from django.contrib import admin
 from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
 from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db.models import F
 from django.db.models.expressions import RawSQL
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
+import hashlib
 from import_export.admin import ImportExportModelAdmin
 from . import models
+from .bulk_import import IMPORT_BATCH_SIZE, IMPORTERS, bulk_import, importer_for_model
+from .jobs import queue_import
+from .models import JobStatusChoices
+from .search_backends import census_data_version
 
 
 # --- Authentication and Authorization ---
@@ -27,6 +42,65 @@ class UserAdmin(ImportExportModelAdmin, DjangoUserAdmin):
     ordering = ("username",)
 
 
+# --- Bulk import ---
+
+class BulkImportForm(forms.Form):
+    file = forms.FileField(help_text='A CSV (UTF-8) or XLSX file, with column names in the first row.')
+    batch_size = forms.IntegerField(min_value=1, initial=IMPORT_BATCH_SIZE,
+                                    help_text='Rows written to the database at a time.')
+    dry_run = forms.BooleanField(required=False, initial=True,
+                                 help_text='Check the file and time the import without saving anything.')
+    in_background = forms.BooleanField(required=False, label='Run in the background',
+                                       help_text='Queue the import as a census job and follow its progress there, '
+                                                 'rather than waiting for it here.')
+
+class BulkImportMixin:
+    import_export_change_list_template = 'admin/censusapp/change_list_bulk_import.html'
+
+    def has_bulk_import_permission(self, request):
+        return self.has_add_permission(request) and self.has_change_permission(request)
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path('bulk-import/', self.admin_site.admin_view(self.bulk_import_view), name='%s_%s_bulk_import' % info),
+            *super().get_urls(),
+        ]
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {'has_bulk_import_permission': self.has_bulk_import_permission(request), **(extra_context or {})}
+        return super().changelist_view(request, extra_context)
+
+    def bulk_import_view(self, request):
+        if not self.has_bulk_import_permission(request):
+            raise PermissionDenied
+        kind = importer_for_model(self.model)
+        report = None
+        form = BulkImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid() and form.cleaned_data['in_background']:
+            upload = form.cleaned_data['file']
+            job = queue_import(kind, upload, upload.name,
+                               batch_size=form.cleaned_data['batch_size'], dry_run=form.cleaned_data['dry_run'])
+            self.message_user(request, f'Queued the import of {upload.name} as job {job.pk}.')
+            return redirect(reverse('admin:censusapp_censusjob_change', args=[job.pk]))
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            report = bulk_import(kind, upload.file, upload.name,
+                                 batch_size=form.cleaned_data['batch_size'], dry_run=form.cleaned_data['dry_run'])
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': f'Bulk import {self.model._meta.verbose_name_plural}',
+            'form': form,
+            'report': report,
+            'columns': IMPORTERS[kind].known_columns(),
+        }
+        return TemplateResponse(request, 'admin/censusapp/bulk_import.html', context)
+# Large loads (such as records derived from the ESTC) go through the batched importer in bulk_import.py instead of
+# the row-by-row Import button. It also runs as "manage.py bulk_import" for files too large to upload.
+# Imports run in the background are picked up by "manage.py run_census_jobs --forever".
+
+
 # --- Provenance Names and Provenance Records ---
 
 class ProvenanceOwnershipInline(admin.TabularInline):
@@ -35,13 +109,13 @@ class ProvenanceOwnershipInline(admin.TabularInline):
 	extra = 1
 	
 @admin.register(models.ProvenanceName)
-class ProvenanceNameAdmin(ImportExportModelAdmin):
+class ProvenanceNameAdmin(BulkImportMixin, ImportExportModelAdmin):
 	ordering = ('name',)
 	search_fields = ('name',)
 	inlines = (ProvenanceOwnershipInline,)
 
 @admin.register(models.ProvenanceOwnership)
-class ProvenanceOwnershipAdmin(ImportExportModelAdmin):
+class ProvenanceOwnershipAdmin(BulkImportMixin, ImportExportModelAdmin):
     ordering = ("owner__name", "id")
     search_fields = ("owner__name",)
     autocomplete_fields = ("owner",)
@@ -50,7 +124,7 @@ class ProvenanceOwnershipAdmin(ImportExportModelAdmin):
 # --- Locations ---
 
 @admin.register(models.Location)
-class LocationAdmin(ImportExportModelAdmin):
+class LocationAdmin(BulkImportMixin, ImportExportModelAdmin):
 	ordering = ('name',)
 	search_fields = ("name",)
 
@@ -58,49 +132,74 @@ class LocationAdmin(ImportExportModelAdmin):
 # --- Core Census Data ---
 
 @admin.register(models.Title)
-class TitleAdmin(ImportExportModelAdmin):
+class TitleAdmin(BulkImportMixin, ImportExportModelAdmin):
 	ordering = ('title',)
 	search_fields = ("title",)
 
 @admin.register(models.Edition)
-class EditionAdmin(ImportExportModelAdmin):
+class EditionAdmin(BulkImportMixin, ImportExportModelAdmin):
 	ordering = ('title__title', 'edition_number')
 	search_fields = ("title__title",)
 	autocomplete_fields = ("title",)
 	list_select_related = ("title",)
 
 @admin.register(models.Issue)
-class IssueAdmin(ImportExportModelAdmin):
+class IssueAdmin(BulkImportMixin, ImportExportModelAdmin):
 	ordering = ('edition__title__title', 'edition__edition_number', 'estc')
 	search_fields = ("estc", "edition__title__title")
 	autocomplete_fields = ("edition",)
 	list_select_related = ("edition", "edition__title")
 
+class CachedCountPaginator(Paginator):
+
+    @cached_property
+    def count(self):
+        query = str(self.object_list.query)
+        key = f'census:admincount:{census_data_version()}:' + hashlib.md5(query.encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(key, count, 60 * 60)
+        return count
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = min(bottom + self.per_page, self.count)
+        if top + self.orphans >= self.count:
+            top = self.count
+        ids = list(self.object_list.values_list("pk", flat=True)[bottom:top])
+        copies = self.object_list.order_by().in_bulk(ids)
+        return self._get_page([copies[pk] for pk in ids if pk in copies], number, self)
+# Copy changelist counts are kept until the census data changes, so paging through the list doesn't count every
+# copy on every page. Each page first finds its copy ids from the ordering indexes alone, then loads just those
+# copies by id with their issues, editions and titles, which keeps pages far into the list quick. The copies are
+# put back in order here: ordering the second query too would have SQLite walk the indexes all over again.
+
 @admin.register(models.Copy)
-class CopyAdmin(ImportExportModelAdmin):
+class CopyAdmin(BulkImportMixin, ImportExportModelAdmin):
     search_fields = ("census_id", "issue__edition__title__title")
     list_filter = ["verification"]
     autocomplete_fields = ("issue",)
-    list_select_related = ("issue", "issue__edition", "issue__edition__title")
-
-    def get_ordering(self, request):
-        return ()
+    list_select_related = ("issue", "issue__edition", "issue__edition__title", "location")
+    paginator = CachedCountPaginator
+    show_full_result_count = False
+    ordering = (
+        "issue__edition__title__title",
+        "issue__edition__edition_number", RawSQL(f"{models.Edition._meta.db_table}.id", []).asc(),
+        "issue__estc", RawSQL(f"{models.Issue._meta.db_table}.id", []).asc(),
+        F("census_id_number").asc(nulls_last=True), "census_id", "pk",
+    )
+    # IDs starting with a digit come first, in the order of the number they start with ("12.10" before "12.3"),
+    # then the others by ID, with blank IDs first. SQLite finds the copies in this order by walking the indexes on
+    # Title.title, Edition (title, edition_number), Issue (edition, estc) and Copy (issue, census_id_number,
+    # census_id), so it never sorts the Copy table. That only works when each table's own id breaks its ties:
+    # "issue__edition_id" would name the issue's column, which SQLite can't tell is the same value.
 
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
-
-        is_numeric_sql = (
-            "(census_id GLOB '[0-9]*' OR census_id GLOB '[0-9]*.[0-9]*') AND census_id != ''"
-        )
-        
-        return qs.order_by(
-            "issue__edition__title__title",
-            "issue__edition__edition_number",
-            "issue__estc",
-            RawSQL(f"CASE WHEN {is_numeric_sql} THEN 0 ELSE 1 END", []),  # numerics first
-            RawSQL("CASE WHEN " + is_numeric_sql + " THEN CAST(census_id AS REAL) END", []),
-            "census_id",
-        )
+        return super().get_queryset(request).prefetch_related("issue__edition__issues")
+    # Each copy's name includes its issue number when its edition has several issues, which the prefetched
+    # issues answer without a count query for every row.
 
 
 # --- Static Page Text ---
@@ -108,3 +207,34 @@ class CopyAdmin(ImportExportModelAdmin):
 @admin.register(models.StaticPageText)
 class StaticPageTextAdmin(ImportExportModelAdmin):
 	pass
+
+
+# --- Census Jobs ---
+
+@admin.register(models.CensusJob)
+class CensusJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'priority', 'progress', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status', 'kind')
+    ordering = ('-id',)
+    actions = ('retry_jobs',)
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields if field.name != 'priority']
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description='Progress')
+    def progress(self, job):
+        if job.progress_total:
+            return f'{job.progress_done} of {job.progress_total}'
+        return job.progress_done or '-'
+
+    @admin.action(description='Run the selected failed jobs again')
+    def retry_jobs(self, request, queryset):
+        retried = queryset.filter(status=JobStatusChoices.FAILED).update(
+            status=JobStatusChoices.QUEUED, attempts=0, run_after=timezone.now(), finished_at=None,
+        )
+        self.message_user(request, f'Queued {retried} job(s) again.')
+# Jobs are queued by the admin's bulk imports, the export pages and /jobs/, not here. Staff can follow their progress,
+# raise the priority of a waiting job, or queue failed jobs again.
@@ -0,0 +1,288 @@
+from django.conf import settings
+from django.http import QueryDict
+import hashlib
+import json
+from . import models
+from .database import snapshot_version
+from .pagination import SQLITE_MAX_INT, InvalidCursor, paginate_keyset
+from .search import filter_copies
+from .search_backends import census_data_version
+from .utils import SEARCH_ORDERINGS, canonical_query, parse_number
+
+
+# --- Settings ---
+
+API_PAGE_SIZE = getattr(settings, 'API_PAGE_SIZE', 100)
+API_MAX_PAGE_SIZE = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+
+
+class ApiError(Exception):
+    pass
+# Raised for requests the API can't answer, such as an unknown field; the view turns it into a 400 response.
+
+
+# --- Resources ---
+
+class Resource:
+    name = None
+    model = None
+    fields = ()
+    relations = {}
+    many = {}
+    filters = {}
+
+    def queryset(self, params):
+        return self.model.objects.all()
+
+    def orderings(self, params):
+        return {'id': []}
+
+    def value(self, obj, field):
+        if field in self.relations:
+            return getattr(obj, self.model._meta.get_field(field).attname)
+        return getattr(obj, field)
+
+    def filter(self, queryset, params):
+        for param, lookup in self.filters.items():
+            value = params.get(param)
+            if value is None:
+                continue
+            pk = parse_number(value)
+            if pk is None:
+                raise ApiError(f'"{param}" must be a record id.')
+            queryset = queryset.filter(**{lookup: pk})
+        return queryset
+# A resource lists the public fields of one model, the fields that point to other resources (relations, one id;
+# many, a list of ids) and the id filters it accepts, e.g. /api/editions/?title=3.
+
+class TitleResource(Resource):
+    name = 'titles'
+    model = models.Title
+    fields = ('title', 'apocryphal', 'notes', 'image')
+
+    def value(self, obj, field):
+        if field == 'image':
+            return obj.image.url if obj.image else None
+        return super().value(obj, field)
+
+class EditionResource(Resource):
+    name = 'editions'
+    model = models.Edition
+    fields = ('title', 'edition_number', 'edition_format', 'notes')
+    relations = {'title': 'titles'}
+    filters = {'title': 'title'}
+
+class IssueResource(Resource):
+    name = 'issues'
+    model = models.Issue
+    fields = ('edition', 'issue_number', 'unknown_issue', 'stc_wing', 'estc', 'deep', 'year', 'start_date', 'end_date', 'notes')
+    relations = {'edition': 'editions'}
+    filters = {'edition': 'edition', 'title': 'edition__title'}
+
+class CopyResource(Resource):
+    name = 'copies'
+    model = models.Copy
+    fields = (
+        'issue', 'location', 'census_id', 'shelfmark', 'verification', 'fragment', 'from_estc', 'digital_facsimile_url',
+        'binding', 'in_early_sammelband', 'sammelband_notes', 'marginalia', 'local_notes', 'provenance_names',
+        'provenance_notes', 'height', 'width', 'bibliography',
+    )
+    relations = {'issue': 'issues', 'location': 'locations'}
+    many = {'provenance_names': ('provenance_names', models.ProvenanceOwnership, 'copy_id', 'owner_id')}
+    filters = {'issue': 'issue', 'location': 'location', 'title': 'issue__edition__title'}
+
+    def queryset(self, params):
+        copies = models.Copy.objects.filter(canonical_query)
+        if params.get('field'):
+            copies, _, _ = filter_copies(copies, params['field'], params.get('value'))
+        return copies
+    # "field" and "value" search the copies exactly as the search page does, e.g. ?field=location&value=folger.
+    # Without them, every copy in the census is listed. Ghost copies are left out, as on the search page,
+    # but can be found with ?field=collection&value=ghost.
+
+    def orderings(self, params):
+        orders = {'id': [], **{order: terms for order, terms in SEARCH_ORDERINGS.items() if order != 'relevance'}}
+        if params.get('field') == 'keyword':
+            orders['relevance'] = SEARCH_ORDERINGS['relevance']
+        return orders
+
+class LocationResource(Resource):
+    name = 'locations'
+    model = models.Location
+    fields = ('name', 'city', 'state', 'country', 'continent')
+
+class ProvenanceNameResource(Resource):
+    name = 'provenance_names'
+    model = models.ProvenanceName
+    fields = ('name', 'bio', 'viaf', 'start_century', 'end_century', 'gender')
+
+RESOURCES = {resource.name: resource for resource in [
+    TitleResource(), EditionResource(), IssueResource(), CopyResource(), LocationResource(), ProvenanceNameResource(),
+]}
+# Private fields (such as nonpublic_notes and who created or verified a copy) are never listed, so they are never sent.
+
+
+# --- Request parameters ---
+
+def get_resource(name):
+    if name not in RESOURCES:
+        raise ApiError(f'Unknown resource "{name}". Choose from: {", ".join(RESOURCES)}.')
+    return RESOURCES[name]
+
+def requested_fields(resource, params, key='fields'):
+    text = params.get(key)
+    if not text:
+        return list(resource.fields)
+    fields = [name.strip() for name in text.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in resource.fields]
+    if unknown:
+        raise ApiError(f'Unknown {resource.name} fields: {", ".join(unknown)}.')
+    return fields
+# "fields=census_id,shelfmark" sends only those fields (and the id). Included resources can be narrowed the same way
+# with "fields[issues]=estc,year".
+
+def requested_includes(resource, params):
+    paths = [path.strip() for path in (params.get('include') or '').split(',') if path.strip()]
+    for path in paths:
+        current = resource
+        for name in path.split('.'):
+            target = current.relations.get(name) or current.many.get(name, (None,))[0]
+            if target is None:
+                raise ApiError(f'{current.name} have no related "{name}" to include.')
+            current = RESOURCES[target]
+    return paths
+# "include=issue.edition.title,location" also sends each copy's issue, edition, title and location, following
+# the relations one step at a time.
+
+def page_size(params):
+    try:
+        size = int(params.get('page_size', API_PAGE_SIZE))
+    except ValueError:
+        raise ApiError('"page_size" must be a number.')
+    return max(1, min(size, API_MAX_PAGE_SIZE))
+
+
+# --- Loading and serializing ---
+
+def _columns(resource, fields, includes):
+    relation_names = {path.split('.')[0] for path in includes} & set(resource.relations)
+    return [name for name in resource.fields if name not in resource.many and (name in fields or name in relation_names)]
+
+def _many_ids(resource, name, objects):
+    _, through, owner_column, target_column = resource.many[name]
+    ids = {obj.pk: [] for obj in objects}
+    pairs = through.objects.filter(**{f'{owner_column}__in': list(ids)}).order_by(owner_column, 'pk')
+    for owner_id, target_id in pairs.values_list(owner_column, target_column):
+        ids[owner_id].append(target_id)
+    return ids
+
+def serialize(resource, objects, fields, many_ids):
+    return [
+        {'id': obj.pk, **{
+            field: many_ids[field][obj.pk] if field in resource.many else resource.value(obj, field)
+            for field in fields
+        }}
+        for obj in objects
+    ]
+
+def load_page(resource, objects, fields, includes, params):
+    many_ids = {}
+    wanted = set(fields) | {path.split('.')[0] for path in includes}
+    for name in resource.many:
+        if name in wanted:
+            many_ids[name] = _many_ids(resource, name, objects)
+
+    loaded = {}
+    for path in includes:
+        current, current_objects, current_many = resource, objects, many_ids
+        for name in path.split('.'):
+            if name in current.relations:
+                target = RESOURCES[current.relations[name]]
+                attname = current.model._meta.get_field(name).attname
+                ids = {getattr(obj, attname) for obj in current_objects}
+            else:
+                target = RESOURCES[current.many[name][0]]
+                ids = {pk for obj in current_objects for pk in current_many[name][obj.pk]}
+            ids.discard(None)
+            known = loaded.setdefault(target.name, {})
+            missing = ids - known.keys()
+            if missing:
+                known.update(target.model.objects.filter(pk__in=missing).only(*[
+                    field for field in target.fields if field not in target.many
+                ]).in_bulk())
+            current, current_objects, current_many = target, [known[pk] for pk in sorted(ids) if pk in known], {}
+
+    included = {}
+    for name, objs in loaded.items():
+        target = RESOURCES[name]
+        target_fields = [field for field in requested_fields(target, params, f'fields[{name}]') if field not in target.many]
+        included[name] = serialize(target, [objs[pk] for pk in sorted(objs)], target_fields, {})
+    return serialize(resource, objects, fields, many_ids), included
+# Each related resource is loaded with one query for the whole page, however many rows refer to it, and each record
+# is sent once even when many rows share it. Lists of related ids (a copy's provenance names) also take one query.
+
+def list_records(resource, params, path):
+    fields = requested_fields(resource, params)
+    includes = requested_includes(resource, params)
+    orderings = resource.orderings(params)
+    order = params.get('order') or 'id'
+    if order not in orderings:
+        raise ApiError(f'Unknown order "{order}". Choose from: {", ".join(orderings)}.')
+
+    queryset = resource.filter(resource.queryset(params), params)
+    queryset = queryset.only(*_columns(resource, fields, includes))
+    try:
+        page = paginate_keyset(queryset, orderings[order], page_size(params),
+                               after=params.get('after'), before=params.get('before'), strict=True)
+    except InvalidCursor as e:
+        raise ApiError(f'"{e}" is not a cursor for this list.')
+    data, included = load_page(resource, page.object_list, fields, includes, params)
+
+    def link(name, cursor):
+        if cursor is None:
+            return None
+        query = QueryDict(mutable=True)
+        query.update(params)
+        query.pop('after', None)
+        query.pop('before', None)
+        query[name] = cursor
+        return f'{path}?{query.urlencode()}'
+
+    return {
+        'data': data,
+        'included': included,
+        'links': {
+            'next': link('after', page.next_cursor),
+            'previous': link('before', page.previous_cursor),
+            'resume': link('after', page.last_cursor or params.get('after')),
+        },
+    }
+# Pages are read with keyset cursors, so every page costs the same and a cursor stays valid while records are added.
+# The "resume" link continues after the last record on the page even when it is the last page, so a client that
+# walked the whole list in id order can come back to it later and fetch only the records added since. An empty
+# page hands back the cursor it was given, so polling from the end never loses its place. A cursor that can't be
+# read, or whose values don't suit the order's sort keys, is refused rather than quietly starting from the first page.
+
+def get_record(resource, pk, params):
+    fields = requested_fields(resource, params)
+    includes = requested_includes(resource, params)
+    if pk > SQLITE_MAX_INT:
+        return None
+    obj = resource.model.objects.filter(pk=pk).only(*_columns(resource, fields, includes)).first()
+    if obj is None:
+        return None
+    data, included = load_page(resource, [obj], fields, includes, params)
+    return {'data': data[0], 'included': included}
+# An id too large for the database can't belong to any record, so it is simply not found.
+
+
+# --- Validators ---
+
+def api_etag(request):
+    version = snapshot_version() or census_data_version()
+    raw = json.dumps([request.path, sorted(request.GET.lists()), version])
+    return '"' + hashlib.md5(raw.encode()).hexdigest() + '"'
+# The ETag changes whenever the census changes, so a client that sends it back with If-None-Match gets a 304 Not
+# Modified, without any query being run, until there is something new to fetch. Responses read from a snapshot are
+# versioned by the snapshot alone: an edit moves the data version on before it has been published, and an ETag made
+# from that would describe data the response doesn't hold yet.
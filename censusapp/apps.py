@@ -2,3 +2,6 @@ from django.apps import AppConfig
 
 class CensusAppConfig(AppConfig):
     name = 'censusapp'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,140 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from functools import partial
+import re
+import unicodedata
+import uuid
+from . import models
+
+
+# --- Settings ---
+
+AUTOCOMPLETE_LIMIT = getattr(settings, 'AUTOCOMPLETE_LIMIT', 20)
+AUTOCOMPLETE_MAX_AGE = getattr(settings, 'AUTOCOMPLETE_MAX_AGE', 300)
+
+
+# --- Normalization ---
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def normalize(text):
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+# This function folds case and strips accents, so that "zurich" finds "Zürich" and "BIBLIOTHEQUE" finds "Bibliothèque".
+
+
+# --- Prefix Trie ---
+
+class PrefixTrie:
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, token, value_id):
+        node = self.root
+        for char in token:
+            node = node.setdefault(char, {})
+        node.setdefault(None, set()).add(value_id)
+
+    def search(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return set()
+        matches = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for char, child in node.items():
+                if char is None:
+                    matches |= child
+                else:
+                    stack.append(child)
+        return matches
+# Each node is a dict of next characters; the None key holds the ids of the values with a word ending there.
+
+
+# --- Autocomplete Index ---
+
+class AutocompleteIndex:
+
+    def __init__(self, values):
+        self.values = sorted({v.strip() for v in values if v and v.strip()})
+        self.normalized = [normalize(v) for v in self.values]
+        self.trie = PrefixTrie()
+        for value_id, text in enumerate(self.normalized):
+            for token in set(TOKEN_PATTERN.findall(text)):
+                self.trie.insert(token, value_id)
+
+    def rank(self, value_id, query):
+        text = self.normalized[value_id]
+        if text == query:
+            position = 0
+        elif text.startswith(query):
+            position = 1
+        elif query in text:
+            position = 2
+        else:
+            position = 3
+        return (position, len(text), text)
+
+    def suggest(self, query, limit=AUTOCOMPLETE_LIMIT):
+        query = normalize(query).strip()
+        tokens = TOKEN_PATTERN.findall(query)
+        if not tokens:
+            return []
+        matches = self.trie.search(tokens[0])
+        for token in tokens[1:]:
+            matches &= self.trie.search(token)
+        ranked = sorted(matches, key=lambda value_id: self.rank(value_id, query))
+        return [self.values[value_id] for value_id in ranked[:limit]]
+# A value matches when every word of the query starts one of its words. Exact matches come first, then values
+# that start with the query, then values that contain it, with shorter values ahead of longer ones.
+
+
+# --- Indexed fields ---
+
+def location_values():
+    return models.Location.objects.values_list('name', flat=True)
+
+def geography_values():
+    for row in models.Location.objects.values_list('city', 'state', 'country', 'continent'):
+        yield from row
+
+def provenance_values():
+    return models.ProvenanceName.objects.values_list('name', flat=True)
+
+AUTOCOMPLETE_FIELDS = {
+    'location': location_values,
+    'geography': geography_values,
+    'provenance': provenance_values,
+}
+
+_indexes = {}
+
+def _version_key(field):
+    return f'census:autocomplete:{field}:version'
+
+def get_index(field):
+    version = cache.get_or_set(_version_key(field), uuid.uuid4().hex, None)
+    cached = _indexes.get(field)
+    if cached is None or cached[0] != version:
+        cached = (version, AutocompleteIndex(AUTOCOMPLETE_FIELDS[field]()))
+        _indexes[field] = cached
+    return cached[1]
+# Each worker process keeps its own indexes in memory, and rebuilds one when its version in the shared cache changes.
+
+def _new_versions(fields):
+    cache.set_many({_version_key(field): uuid.uuid4().hex for field in fields}, None)
+
+def invalidate_index(*fields, using=DEFAULT_DB_ALIAS):
+    transaction.on_commit(partial(_new_versions, fields), using=using)
+# The versions move on once the change has been committed; an index rebuilt before then would hold the old values
+# under the newest version.
+
+def suggest(field, query):
+    if not query:
+        return []
+    return get_index(field).suggest(query)
@@ -0,0 +1,194 @@
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+import json
+import math
+import time
+from . import models
+from .exports import EXPORTS
+from .instrumentation import QueryLog
+from .utils import FEATURE_DISPLAY_NAMES, SEARCH_ORDERINGS
+
+
+# --- Settings ---
+
+BENCHMARK_TOLERANCE = getattr(settings, 'CENSUS_BENCHMARK_TOLERANCE', 0.25)
+BENCHMARK_MIN_DIFFERENCE_MS = getattr(settings, 'CENSUS_BENCHMARK_MIN_DIFFERENCE_MS', 2.0)
+# A case has regressed when its median time grows by more than BENCHMARK_TOLERANCE (25%) and by more than
+# BENCHMARK_MIN_DIFFERENCE_MS, or when it runs more queries than before. Tiny differences are timer noise.
+
+
+# --- Benchmark cases ---
+
+def _search_url(field, value, order):
+    return reverse('search') + '?' + urlencode({'field': field, 'value': value, 'order': order})
+
+def _first(queryset, field):
+    return queryset.values_list(field, flat=True).first()
+
+def search_values():
+    location = _first(models.Location.objects.order_by('pk'), 'name') or ''
+    owner = _first(models.ProvenanceName.objects.order_by('pk'), 'name') or ''
+    title = models.Title.objects.order_by('pk').first()
+    issue = models.Issue.objects.exclude(stc_wing=None).exclude(stc_wing='').order_by('pk').first()
+    year = _first(models.Issue.objects.filter(start_date__gt=0).order_by('pk'), 'start_date')
+    return {
+        'keyword': title.title.split()[-1] if title else '',
+        'location': location.split()[-2] if len(location.split()) > 1 else location,
+        'geography': _first(models.Location.objects.exclude(country=None).order_by('pk'), 'country') or '',
+        'provenance_name': owner.split()[-1] if owner else '',
+        'collection': 'womanowner',
+        'year': str(year or 1623),
+        'stc': issue.stc_wing.split()[0] if issue else 'STC',
+        'census_id': _first(models.Copy.objects.order_by('pk'), 'census_id') or '1',
+        'century': str((year or 1623) // 100 + 1),
+        'continent': _first(models.Location.objects.exclude(continent=None).order_by('pk'), 'continent') or '',
+        'country': _first(models.Location.objects.exclude(country=None).order_by('-pk'), 'country') or '',
+        'title': str(title.pk) if title else '',
+        'verification': 'V',
+        'fragment': 'yes',
+        'facsimile': 'yes',
+    }
+# Search values are read from the census itself, so the same cases work on the real census and on a synthetic one.
+
+def benchmark_cases():
+    cases = {'homepage': reverse('homepage')}
+
+    titles = models.Title.objects.annotate(copy_total=Count('editions__issues__copies')).order_by('-copy_total', 'pk')
+    for rank, title in zip(('largest', 'smallest'), [titles.first(), titles.last()]):
+        if title is not None:
+            cases[f'issue_list {rank}'] = reverse('issue_list', args=[title.pk])
+    issues = models.Issue.objects.annotate(copy_total=Count('copies')).order_by('-copy_total', 'pk')
+    for rank, issue in zip(('largest', 'smallest'), [issues.first(), issues.last()]):
+        if issue is not None:
+            cases[f'copy_list {rank}'] = reverse('copy_list', args=[issue.pk])
+    copy = models.Copy.objects.exclude(census_id=None).order_by('pk').first()
+    if copy is not None:
+        cases['copy_data'] = reverse('copy_data', args=[copy.pk])
+        cases['single_copy'] = reverse('single_copy', args=[copy.census_id])
+
+    for field, value in search_values().items():
+        orders = [order for order in SEARCH_ORDERINGS if order != 'relevance' or field == 'keyword']
+        for order in orders:
+            cases[f'search {field} {order}'] = _search_url(field, value, order)
+    for feature in FEATURE_DISPLAY_NAMES:
+        cases[f'search collection {feature}'] = _search_url('collection', feature, 'date')
+
+    location = _first(models.Location.objects.order_by('pk'), 'city') or 'Lon'
+    owner = _first(models.ProvenanceName.objects.order_by('pk'), 'name') or 'Joh'
+    for name, query in [('location', location[:3]), ('geography', location[:3]), ('provenance', owner[:3]),
+                        ('collection', 'wom')]:
+        cases[f'autofill {name}'] = reverse(f'autofill_{name}', args=[query])
+
+    for viewname in models.StaticPageText.objects.order_by('viewname').values_list('viewname', flat=True):
+        if viewname:
+            cases[f'info {viewname}'] = reverse('info', args=[viewname])
+
+    for name in EXPORTS:
+        cases[f'export {name}'] = reverse(name)
+    return cases
+# This function lists every hot path of the public site, by name, with the URL to request. Listing and search pages
+# are requested for both a large and a small title or issue, and every search field is tried with every ordering.
+
+
+# --- Running ---
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * p / 100) - 1)] if ordered else 0.0
+
+def _request(client, url):
+    query_log = QueryLog()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(query_log))
+        started = time.perf_counter()
+        response = client.get(url)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        elapsed = (time.perf_counter() - started) * 1000
+    return response.status_code, elapsed, query_log.count
+
+def _uncached(url):
+    return url + ('&' if '?' in url else '?') + 'nocache=1'
+
+def run_case(client, url, repeat=10, warmup=1, cached=False):
+    url = url if cached else _uncached(url)
+    for _ in range(warmup):
+        _request(client, url)
+    timings, queries, statuses = [], [], set()
+    for _ in range(repeat):
+        status, elapsed, count = _request(client, url)
+        timings.append(elapsed)
+        queries.append(count)
+        statuses.add(status)
+    return {
+        'p50': round(percentile(timings, 50), 2),
+        'p95': round(percentile(timings, 95), 2),
+        'max': round(max(timings), 2),
+        'queries': max(queries),
+        'status': max(statuses),
+    }
+# Unless cached=True, each URL gets an extra query parameter, which keeps the page cache from answering it,
+# so the time is that of building the page. With cached=True, pages are timed as repeat visitors get them.
+
+def run_benchmarks(cases, repeat=10, warmup=1, cached=False, progress=None):
+    results = {}
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        client = Client()
+        for name, url in cases.items():
+            results[name] = run_case(client, url, repeat=repeat, warmup=warmup, cached=cached)
+            if progress is not None:
+                progress(name, results[name])
+    return results
+# Requests go through the full middleware stack, the same as a visitor's, but without a web server in front.
+
+
+# --- Baselines ---
+
+def census_size():
+    return {
+        'titles': models.Title.objects.count(),
+        'issues': models.Issue.objects.count(),
+        'copies': models.Copy.objects.count(),
+    }
+
+def save_baseline(path, results, cached=False):
+    baseline = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'cached': cached,
+        'census': census_size(),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compare(results, baseline, tolerance=BENCHMARK_TOLERANCE, min_difference=BENCHMARK_MIN_DIFFERENCE_MS):
+    regressions = {}
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        reasons = []
+        slower = result['p50'] - before['p50']
+        if slower > min_difference and result['p50'] > before['p50'] * (1 + tolerance):
+            reasons.append(f"median {before['p50']:.1f} -> {result['p50']:.1f} ms")
+        if result['queries'] > before['queries']:
+            reasons.append(f"queries {before['queries']} -> {result['queries']}")
+        if result['status'] != before['status']:
+            reasons.append(f"status {before['status']} -> {result['status']}")
+        if reasons:
+            regressions[name] = reasons
+    return regressions
+# This function returns the cases that got slower, ran more queries or changed status since the baseline was saved,
+# with the reasons for each. Cases that are new or no longer run are ignored.
@@ -0,0 +1,478 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models as db_models, transaction
+from functools import partial
+from pathlib import Path
+import csv
+import io
+import time
+from . import models
+from .models import ChangeOperationChoices
+from .autocomplete import AUTOCOMPLETE_FIELDS, invalidate_index
+from .changes import record_changes
+from .database import schedule_snapshot
+from .page_cache import invalidate_all_pages, invalidate_pages
+from .search_backends import invalidate_search_backend
+from .search_index import get_search_index
+from .stats import invalidate_statistics
+from .utils import (
+    census_id_sort_group, census_id_sort_number, census_id_sort_pair, convert_year_range, copy_features,
+    location_sort_key, refresh_copy_features, title_sort_key,
+)
+
+
+# --- Settings ---
+
+IMPORT_BATCH_SIZE = getattr(settings, 'BULK_IMPORT_BATCH_SIZE', 500)
+IMPORT_MAX_REPORTED_ERRORS = getattr(settings, 'BULK_IMPORT_MAX_REPORTED_ERRORS', 200)
+# Every invalid row is counted, but only the first IMPORT_MAX_REPORTED_ERRORS are listed in the report.
+
+IMPORT_MAX_PAGE_TAGS = 100
+
+
+# --- Reading files ---
+
+def read_csv(file):
+    if not isinstance(file, io.TextIOBase):
+        file = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    yield from csv.reader(file)
+
+def read_xlsx(file):
+    from openpyxl import load_workbook
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+# Only the first worksheet is read. openpyxl is installed with django-import-export.
+
+def read_rows(file, filename):
+    rows = read_xlsx(file) if Path(filename).suffix.lower() == '.xlsx' else read_csv(file)
+    header = [str(name or '').strip() for name in next(rows, [])]
+    for row_number, row in enumerate(rows, start=2):
+        if any(value not in (None, '') for value in row):
+            yield row_number, dict(zip(header, row))
+# This function streams a CSV or XLSX file as (row number, row) pairs, with each row keyed by the column names in
+# the first row. Blank rows are skipped, but still counted in the row numbers given in error messages.
+
+def clean_value(field, raw):
+    if isinstance(raw, str):
+        raw = raw.strip()
+    if isinstance(raw, float) and raw.is_integer():
+        raw = int(raw)
+    if raw is None or raw == '':
+        if field.null:
+            return None
+        return field.get_default() if field.has_default() else ''
+    if isinstance(field, db_models.BooleanField) and isinstance(raw, str):
+        raw = {'yes': True, 'y': True, 'x': True, 'no': False, 'n': False}.get(raw.lower(), raw)
+    return field.to_python(raw)
+# Spreadsheets store whole numbers as floats, which would otherwise turn a year of 1623 into "1623.0".
+
+def natural_key(*values):
+    return tuple(str(value).strip().casefold() for value in values)
+
+
+# --- Foreign key lookups ---
+
+class Lookup:
+
+    def __init__(self, queryset, *key_fields):
+        self.pks = set()
+        self.keys = {}
+        for *key, pk in queryset.values_list(*key_fields, 'pk'):
+            self.pks.add(pk)
+            key = natural_key(*key)
+            self.keys[key] = None if key in self.keys else pk
+
+    def resolve(self, label, pk, key):
+        if pk not in (None, ''):
+            pk = int(float(pk))
+            if pk not in self.pks:
+                raise ValidationError(f'There is no {label} with id {pk}.')
+            return pk
+        if key is None or all(value in (None, '') for value in key):
+            raise ValidationError(f'No {label} was given.')
+        key = natural_key(*key)
+        if key not in self.keys:
+            raise ValidationError(f'There is no {label} matching {" / ".join(key)}.')
+        if self.keys[key] is None:
+            raise ValidationError(f'More than one {label} matches {" / ".join(key)}; give its id instead.')
+        return self.keys[key]
+# Each lookup loads the ids and natural keys of a related table once, so rows are matched without any queries.
+# Natural keys are compared without regard to case or surrounding spaces.
+
+
+# --- Importers ---
+
+class ModelImporter:
+    model = None
+    fields = []
+    references = {}
+    unique = []
+    derived = []
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.lookups = {
+            name: Lookup(
+                self.model._meta.get_field(name).related_model.objects.using(using),
+                *[key.removeprefix(f'{name}__') for key in key_fields],
+            )
+            for name, (_, key_fields) in self.references.items()
+        }
+        self.moved_from = {name: set() for name in self.references}
+        self.unique_pks = {fields: {} for fields in self.unique}
+        self.unique_values = {fields: {} for fields in self.unique}
+        for fields in self.unique:
+            for pk, *values in self.model.objects.using(using).values_list('pk', *fields):
+                self.unique_pks[fields][tuple(values)] = pk
+                self.unique_values[fields][pk] = tuple(values)
+
+    def columns(self, header):
+        return [name for name in self.fields if name in header]
+
+    def build(self, row, instance, columns):
+        errors = {}
+        previous = {name: getattr(instance, f'{name}_id') for name in self.references}
+        for name in columns:
+            field = self.model._meta.get_field(name)
+            try:
+                setattr(instance, field.attname, clean_value(field, row[name]))
+            except ValidationError as e:
+                errors[name] = e.messages
+        for name, (label, key_fields) in self.references.items():
+            if name not in row and not any(key in row for key in key_fields) and instance.pk is not None:
+                continue
+            try:
+                key = [row.get(key) for key in key_fields] if any(key in row for key in key_fields) else None
+                setattr(instance, f'{name}_id', self.lookups[name].resolve(label, row.get(name), key))
+            except (ValidationError, ValueError) as e:
+                errors[name] = e.messages if isinstance(e, ValidationError) else [f'"{row.get(name)}" is not an id.']
+        if errors:
+            raise ValidationError(errors)
+        self.derive(instance)
+        instance.clean_fields(exclude=list(self.references))
+        self.check_unique(instance)
+        for name, pk in previous.items():
+            if pk is not None and pk != getattr(instance, f'{name}_id'):
+                self.moved_from[name].add(pk)
+        return instance
+
+    def derive(self, instance):
+        pass
+
+    def check_unique(self, instance):
+        for fields in self.unique:
+            values = tuple(getattr(instance, self.model._meta.get_field(name).attname) for name in fields)
+            if None in values:
+                continue
+            other = self.unique_pks[fields].get(values)
+            if other is not None and (instance.pk is None or other != instance.pk):
+                names = ' and '.join(str(self.model._meta.get_field(name).verbose_name) for name in fields)
+                raise ValidationError(f'Another {self.model._meta.verbose_name} already has this {names}.')
+            if instance.pk is not None:
+                self.unique_pks[fields].pop(self.unique_values[fields].get(instance.pk), None)
+                self.unique_values[fields][instance.pk] = values
+            self.unique_pks[fields][values] = instance.pk if instance.pk is not None else object()
+    # Unique fields are checked against the rows already in the database and those earlier in the file,
+    # since a single clash would otherwise fail a whole batch.
+
+    @classmethod
+    def known_columns(cls):
+        keys = [key for _, key_fields in cls.references.values() for key in key_fields]
+        return ['id', *cls.fields, *cls.references, *keys]
+
+    def update_fields(self, columns):
+        return [*columns, *self.references, *self.derived]
+# Each importer lists the columns it reads. A foreign key is given either as the related row's id (e.g. "issue")
+# or by its natural key columns (e.g. "issue__estc"). Rows with the id of an existing record update only the
+# columns present in the file; all other rows are added. When an update moves a record (e.g. a copy to another
+# issue), the record it was moved from is noted in moved_from, so that its pages can be brought up to date too.
+
+class LocationImporter(ModelImporter):
+    model = models.Location
+    fields = ['name', 'city', 'state', 'country', 'continent']
+    derived = ['sort_name']
+
+    def derive(self, instance):
+        instance.sort_name = location_sort_key(instance)
+
+class ProvenanceNameImporter(ModelImporter):
+    model = models.ProvenanceName
+    fields = ['name', 'bio', 'viaf', 'start_century', 'end_century', 'gender']
+
+class TitleImporter(ModelImporter):
+    model = models.Title
+    fields = ['title', 'apocryphal', 'notes']
+    unique = [('title',)]
+    derived = ['sort_title']
+
+    def derive(self, instance):
+        instance.sort_title = title_sort_key(instance)
+
+class EditionImporter(ModelImporter):
+    model = models.Edition
+    fields = ['edition_number', 'edition_format', 'notes']
+    references = {'title': ('title', ['title__title'])}
+
+class IssueImporter(ModelImporter):
+    model = models.Issue
+    fields = ['issue_number', 'unknown_issue', 'stc_wing', 'estc', 'deep', 'year', 'start_date', 'end_date', 'notes']
+    references = {'edition': ('edition', ['edition__title__title', 'edition__edition_number'])}
+    unique = [('edition', 'issue_number')]
+    derived = ['start_date', 'end_date']
+
+    def derive(self, instance):
+        year_range = convert_year_range(instance.year)
+        if year_range and None not in year_range:
+            instance.start_date, instance.end_date = year_range
+
+class CopyImporter(ModelImporter):
+    model = models.Copy
+    fields = [
+        'shelfmark', 'census_id', 'verification', 'fragment', 'from_estc', 'digital_facsimile_url', 'binding',
+        'in_early_sammelband', 'sammelband_notes', 'marginalia', 'local_notes', 'provenance_notes', 'height', 'width',
+        'bibliography', 'nonpublic_notes', 'created_by', 'verified_by', 'examined_by',
+    ]
+    references = {
+        'issue': ('issue', ['issue__estc']),
+        'location': ('location', ['location__name']),
+    }
+    derived = ['census_id_a', 'census_id_b', 'census_id_group', 'census_id_number', 'features']
+
+    def derive(self, instance):
+        instance.census_id_a, instance.census_id_b = census_id_sort_pair(instance.census_id)
+        instance.census_id_group = census_id_sort_group(instance.census_id)
+        instance.census_id_number = census_id_sort_number(instance.census_id)
+        if instance.pk is None:
+            instance.features = copy_features(instance, [])
+# The features of updated copies also depend on their owners, so they are recalculated once the import is done.
+
+class ProvenanceOwnershipImporter(ModelImporter):
+    model = models.ProvenanceOwnership
+    references = {
+        'copy': ('copy', ['copy__census_id']),
+        'owner': ('provenance name', ['owner__name']),
+    }
+
+IMPORTERS = {
+    'locations': LocationImporter,
+    'provenance_names': ProvenanceNameImporter,
+    'titles': TitleImporter,
+    'editions': EditionImporter,
+    'issues': IssueImporter,
+    'copies': CopyImporter,
+    'ownerships': ProvenanceOwnershipImporter,
+}
+# Load files in this order, so that the records each one refers to are already in the database.
+
+def importer_for_model(model):
+    return next((name for name, importer in IMPORTERS.items() if importer.model is model), None)
+
+
+# --- Import report ---
+
+class ImportReport:
+
+    def __init__(self, kind, dry_run=False):
+        self.kind = kind
+        self.dry_run = dry_run
+        self.rows = 0
+        self.created = []
+        self.updated = []
+        self.error_count = 0
+        self.errors = []
+        self.timings = {}
+
+    def error(self, row_number, error):
+        self.error_count += 1
+        if len(self.errors) < IMPORT_MAX_REPORTED_ERRORS:
+            if isinstance(error, ValidationError) and hasattr(error, 'error_dict'):
+                message = '; '.join(f'{name}: {" ".join(messages)}' for name, messages in error.message_dict.items())
+            elif isinstance(error, ValidationError):
+                message = ' '.join(error.messages)
+            else:
+                message = str(error)
+            self.errors.append((row_number, message))
+
+    def summary(self):
+        timings = ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.timings.items())
+        prefix = 'Dry run: would have added' if self.dry_run else 'Added'
+        return (
+            f'{prefix} {len(self.created)} and updated {len(self.updated)} {self.kind} '
+            f'from {self.rows} rows, with {self.error_count} errors ({timings}).'
+        )
+
+
+# --- Bulk import ---
+
+class _Timer:
+
+    def __init__(self, report, phase):
+        self.report, self.phase = report, phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.report.timings[self.phase] = self.report.timings.get(self.phase, 0) + time.perf_counter() - self.started
+
+def _check_batch(importer, report, batch, columns):
+    parsed = []
+    for row_number, row in batch:
+        pk = row.get('id')
+        try:
+            parsed.append((row_number, row, int(float(pk)) if pk not in (None, '') else None))
+        except ValueError:
+            report.error(row_number, f'"{pk}" is not an id.')
+    existing = importer.model.objects.using(importer.using).in_bulk([pk for _, _, pk in parsed if pk is not None])
+    creates, updates = [], []
+    for row_number, row, pk in parsed:
+        try:
+            instance = importer.build(row, existing.get(pk) or importer.model(pk=pk), columns)
+        except ValidationError as e:
+            report.error(row_number, e)
+            continue
+        (updates if pk in existing else creates).append((row_number, instance))
+    return creates, updates
+# The records updated by a batch are loaded in one query, and every row is checked before anything is written.
+
+def _write_batch(importer, report, creates, updates, fields, batch_size):
+    manager = importer.model.objects.db_manager(importer.using)
+    try:
+        with transaction.atomic(using=importer.using):
+            manager.bulk_create([instance for _, instance in creates], batch_size=batch_size)
+            if updates:
+                manager.bulk_update([instance for _, instance in updates], fields, batch_size=batch_size)
+            record_changes([instance for _, instance in creates], ChangeOperationChoices.CREATE, importer.using)
+            record_changes([instance for _, instance in updates], ChangeOperationChoices.UPDATE, importer.using)
+        report.created.extend(instance.pk for _, instance in creates)
+        report.updated.extend(instance.pk for _, instance in updates)
+        return
+    except IntegrityError:
+        pass
+    for row_number, instance in creates:
+        try:
+            with transaction.atomic(using=importer.using):
+                manager.bulk_create([instance])
+                record_changes([instance], ChangeOperationChoices.CREATE, importer.using)
+            report.created.append(instance.pk)
+        except IntegrityError as e:
+            report.error(row_number, e)
+    for row_number, instance in updates:
+        try:
+            with transaction.atomic(using=importer.using):
+                manager.bulk_update([instance], fields)
+                record_changes([instance], ChangeOperationChoices.UPDATE, importer.using)
+            report.updated.append(instance.pk)
+        except IntegrityError as e:
+            report.error(row_number, e)
+# Each batch is written in a savepoint. If the database rejects it, the batch is written again one row at a time,
+# so that only the offending rows are reported and skipped. Bulk writes send no signals, so the change log is written here.
+
+def _import_batch(importer, report, batch, columns, fields, batch_size):
+    with _Timer(report, 'checks'):
+        creates, updates = _check_batch(importer, report, batch, columns)
+    with _Timer(report, 'writes'):
+        _write_batch(importer, report, creates, updates, fields, batch_size)
+
+def bulk_import(kind, file, filename, batch_size=IMPORT_BATCH_SIZE, dry_run=False, using=DEFAULT_DB_ALIAS, progress=None):
+    report = ImportReport(kind, dry_run)
+    started = time.perf_counter()
+    with _Timer(report, 'lookups'):
+        importer = IMPORTERS[kind](using)
+
+    with transaction.atomic(using=using):
+        columns = fields = None
+        batch = []
+        for row_number, row in read_rows(file, filename):
+            report.rows += 1
+            if columns is None:
+                columns = importer.columns(row)
+                fields = importer.update_fields(columns)
+            batch.append((row_number, row))
+            if len(batch) >= batch_size:
+                _import_batch(importer, report, batch, columns, fields, batch_size)
+                batch = []
+                if progress is not None:
+                    progress(report.rows)
+        if batch:
+            _import_batch(importer, report, batch, columns, fields, batch_size)
+        if dry_run:
+            transaction.set_rollback(True, using=using)
+        elif report.created or report.updated:
+            with _Timer(report, 'refresh'):
+                refresh_after_import(importer.model, report.created + report.updated, using, importer.moved_from)
+    report.timings['total'] = time.perf_counter() - started
+    return report
+# This function imports one CSV or XLSX file of a single kind of record, in one transaction, which also brings the
+# copy features and the keyword index up to date, so that if anything fails, nothing is left half done. Rows are
+# read in batches of batch_size, checked against the lookups, and written with bulk_create and bulk_update. Invalid
+# rows are reported and skipped; the rest are still imported. A dry run does all of the same work, then rolls it back.
+# progress, if given, is called with the number of rows read so far after each batch.
+
+
+# --- After an import ---
+
+def _chunks(ids, size=500):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+AFFECTED_COPIES = {
+    models.Title: 'issue__edition__title__in',
+    models.Edition: 'issue__edition__in',
+    models.Issue: 'issue__in',
+    models.Copy: 'pk__in',
+    models.Location: 'location__in',
+    models.ProvenanceName: 'ownerships__owner__in',
+    models.ProvenanceOwnership: 'ownerships__in',
+}
+
+AFFECTED_ISSUES = {
+    models.Title: 'edition__title__in',
+    models.Edition: 'edition__in',
+    models.Issue: 'pk__in',
+}
+
+def refresh_after_import(model, pks, using=DEFAULT_DB_ALIAS, moved_from=None):
+    moved_from = moved_from or {}
+    copy_ids, issue_ids, title_ids = set(moved_from.get('copy', ())), set(moved_from.get('issue', ())), set()
+    for chunk in _chunks(pks):
+        copy_ids.update(
+            models.Copy.objects.using(using).filter(**{AFFECTED_COPIES[model]: chunk}).values_list('pk', flat=True)
+        )
+        if model in AFFECTED_ISSUES:
+            issue_ids.update(
+                models.Issue.objects.using(using).filter(**{AFFECTED_ISSUES[model]: chunk}).values_list('pk', flat=True)
+            )
+    for chunk in _chunks(copy_ids):
+        issue_ids.update(models.Copy.objects.using(using).filter(pk__in=chunk).values_list('issue_id', flat=True))
+    for chunk in _chunks(issue_ids):
+        title_ids.update(models.Issue.objects.using(using).filter(pk__in=chunk).values_list('edition__title_id', flat=True))
+    for chunk in _chunks(moved_from.get('edition', ())):
+        title_ids.update(models.Edition.objects.using(using).filter(pk__in=chunk).values_list('title_id', flat=True))
+    title_ids.update(moved_from.get('title', ()))
+
+    refresh_copy_features(copy_ids)
+    get_search_index().update_copies(copy_ids, using=using)
+    schedule_snapshot(using)
+    tags = ['titles', 'statistics', *[f'title:{pk}' for pk in title_ids],
+            *[f'issue:{pk}' for pk in issue_ids], *[f'copy:{pk}' for pk in copy_ids]]
+    transaction.on_commit(partial(_expire_after_import, tags), using=using)
+# Bulk writes skip the signals that the admin relies on, so this function brings everything built from the census
+# up to date in one go: copy features, the keyword index, statistics, autocomplete, search indexes and cached pages.
+# It runs inside the import's transaction. Records moved elsewhere by the import are refreshed along with the rest:
+# a copy moved to another issue leaves both issues' pages (and their titles') out of date.
+
+def _expire_after_import(tags):
+    invalidate_statistics()
+    invalidate_index(*AUTOCOMPLETE_FIELDS)
+    invalidate_search_backend()
+    if len(tags) > IMPORT_MAX_PAGE_TAGS:
+        invalidate_all_pages()
+    else:
+        invalidate_pages(*tags)
+# The caches are only cleared once the import has been committed, so that nothing is rebuilt from the records
+# as they were before it. Rather than expiring thousands of pages one by one, large imports expire every cached page.
@@ -0,0 +1,160 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+from datetime import timedelta
+from . import models
+from .database import schedule_snapshot
+from .models import ChangeOperationChoices as Operation
+from .search_backends import invalidate_search_backend
+
+
+# --- Settings ---
+
+CHANGE_LOG_RETENTION_DAYS = getattr(settings, 'CENSUS_CHANGE_LOG_RETENTION_DAYS', 90)
+CHANGE_LOG_COMPACT_AFTER_DAYS = getattr(settings, 'CENSUS_CHANGE_LOG_COMPACT_AFTER_DAYS', 1)
+CHANGE_FEED_LIMIT = getattr(settings, 'CENSUS_CHANGE_FEED_LIMIT', 1000)
+CHANGE_FEED_MAX_LIMIT = 10000
+
+
+# --- Recording changes ---
+
+LOGGED_MODELS = {
+    models.Title: 'titles',
+    models.Edition: 'editions',
+    models.Issue: 'issues',
+    models.Copy: 'copies',
+    models.Location: 'locations',
+    models.ProvenanceName: 'provenance_names',
+}
+# Entries use the names of the JSON API resources, so a mirror can fetch each changed record from /api/<resource>/<id>/.
+
+def _entry(instance, operation):
+    if isinstance(instance, models.ProvenanceOwnership):
+        return models.ChangeLogEntry(resource='copies', object_id=instance.copy_id, operation=Operation.UPDATE)
+    return models.ChangeLogEntry(resource=LOGGED_MODELS[type(instance)], object_id=instance.pk, operation=operation)
+# A change to a provenance record changes the provenance names listed on its copy, so it is logged as a copy update.
+
+def is_logged(model):
+    return model in LOGGED_MODELS or model is models.ProvenanceOwnership
+
+def record_changes(instances, operation, using=DEFAULT_DB_ALIAS):
+    entries = [_entry(instance, operation) for instance in instances]
+    if entries:
+        models.ChangeLogEntry.objects.using(using).bulk_create(entries)
+
+def record_copy_updates(copy_ids, using=DEFAULT_DB_ALIAS):
+    models.ChangeLogEntry.objects.using(using).bulk_create([
+        models.ChangeLogEntry(resource='copies', object_id=pk, operation=Operation.UPDATE) for pk in copy_ids
+    ])
+
+def record_truncation(using=DEFAULT_DB_ALIAS, horizon=None):
+    entries = models.ChangeLogEntry.objects.using(using)
+    with transaction.atomic(using=using):
+        marker, = entries.bulk_create([
+            models.ChangeLogEntry(resource='', object_id=horizon or 0, operation=Operation.TRUNCATE)
+        ])
+        if horizon is None:
+            horizon = marker.pk
+            entries.filter(pk=marker.pk).update(object_id=horizon)
+        _delete(using, 'operation = %s AND object_id < %s', [Operation.TRUNCATE, horizon])
+# A truncation entry records that the changes up to its object_id can no longer be read from the log, either because
+# they have expired or (with no horizon given) because the whole census has just been replaced. Mirrors that are
+# further behind must copy the census again.
+# Entries are written with bulk_create, the same as the records of a bulk import, so that logging sends no signals.
+
+
+# --- Reading the feed ---
+
+def horizon(using=None):
+    entries = models.ChangeLogEntry.objects.filter(operation=Operation.TRUNCATE)
+    if using is not None:
+        entries = entries.using(using)
+    return entries.aggregate(horizon=Max('object_id'))['horizon'] or 0
+
+def latest_change():
+    return models.ChangeLogEntry.objects.aggregate(last=Max('pk'))['last'] or 0
+
+def changed_records(since):
+    entries = models.ChangeLogEntry.objects.filter(pk__gt=since).exclude(operation=Operation.TRUNCATE)
+    records = {}
+    for resource, object_id in entries.values_list('resource', 'object_id').distinct():
+        records.setdefault(resource, set()).add(object_id)
+    return records
+# This function returns the ids of the records changed after sequence number "since", by resource name, for code that
+# only needs to know what to refresh. Check horizon() first: changes before it are no longer in the log.
+
+def changes_since(since, limit=CHANGE_FEED_LIMIT):
+    entries = models.ChangeLogEntry.objects.all()
+    last = latest_change()
+    truncated_at = horizon()
+    if since < truncated_at:
+        return {'reset': True, 'changes': [], 'next_since': last, 'has_more': False, 'latest': last}
+
+    rows = list(
+        entries.filter(pk__gt=since).exclude(operation=Operation.TRUNCATE).order_by('pk')
+        .values_list('pk', 'resource', 'object_id', 'operation', 'changed_at')[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        'reset': False,
+        'changes': [
+            {'seq': seq, 'resource': resource, 'id': object_id,
+             'operation': Operation(operation).label.lower(), 'at': changed_at.isoformat()}
+            for seq, resource, object_id, operation, changed_at in rows
+        ],
+        'next_since': rows[-1][0] if has_more else max(since, last),
+        'has_more': has_more,
+        'latest': last,
+    }
+# This function returns the changes made after sequence number "since", oldest first, and the number to ask from next.
+# "created" and "updated" both mean the record should be fetched again; after compaction, a record created and then
+# edited may only be listed as updated. If older changes have expired, "reset" tells the mirror to copy the census
+# again, after which it can carry on from next_since. A new mirror notes "latest" before it first copies the census.
+
+
+# --- Retention and compaction ---
+
+def _delete(using, condition, params):
+    connection = connections[using]
+    table = connection.ops.quote_name(models.ChangeLogEntry._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE {condition}', params)
+        return cursor.rowcount
+
+def compact(using=DEFAULT_DB_ALIAS, days=CHANGE_LOG_COMPACT_AFTER_DAYS):
+    ops = connections[using].ops
+    table = ops.quote_name(models.ChangeLogEntry._meta.db_table)
+    cutoff = ops.adapt_datetimefield_value(timezone.now() - timedelta(days=days))
+    return _delete(using, (
+        f'operation != %s AND changed_at < %s AND EXISTS ('
+        f'SELECT 1 FROM {table} AS newer WHERE newer.resource = {table}.resource '
+        f'AND newer.object_id = {table}.object_id AND newer.id > {table}.id)'
+    ), [Operation.TRUNCATE, cutoff])
+# Entries older than CHANGE_LOG_COMPACT_AFTER_DAYS are removed when a later entry exists for the same record. A mirror
+# only ever needs the latest change to each record, so this never affects what it ends up with, however far behind it is.
+
+def expire(using=DEFAULT_DB_ALIAS, days=CHANGE_LOG_RETENTION_DAYS):
+    cutoff = timezone.now() - timedelta(days=days)
+    expired = models.ChangeLogEntry.objects.using(using).filter(changed_at__lt=cutoff).exclude(operation=Operation.TRUNCATE)
+    last_expired = expired.aggregate(last=Max('pk'))['last']
+    if last_expired is None:
+        return 0
+    with transaction.atomic(using=using):
+        removed = _delete(using, 'operation != %s AND id <= %s', [Operation.TRUNCATE, last_expired])
+        if last_expired > horizon(using):
+            record_truncation(using, horizon=last_expired)
+    return removed
+# Entries older than CHANGE_LOG_RETENTION_DAYS are deleted, and a truncation entry marks how far the log was cut.
+
+def prune_change_log(using=DEFAULT_DB_ALIAS, retention_days=CHANGE_LOG_RETENTION_DAYS,
+                     compact_after_days=CHANGE_LOG_COMPACT_AFTER_DAYS):
+    expired = expire(using, retention_days)
+    compacted = compact(using, compact_after_days)
+    if expired or compacted:
+        invalidate_search_backend(using)
+        schedule_snapshot(using)
+    return expired, compacted
+# Run this regularly (e.g. daily, with "manage.py change_log prune"). The snapshot is published again so that
+# the feed, which reads from it, shows the pruned log, and the data version moves on so that feed ETags change.
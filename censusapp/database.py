@@ -0,0 +1,243 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.dispatch import Signal
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+from urllib.parse import urlsplit
+import os
+import re
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+
+
+# --- SQLite tuning ---
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'memory',
+}
+
+def sqlite_pragmas():
+    return getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+
+def apply_sqlite_pragmas(cursor, pragmas=None):
+    pragmas = sqlite_pragmas() if pragmas is None else pragmas
+    for name, value in pragmas.items():
+        if not re.fullmatch(r'\w+', str(name)) or not re.fullmatch(r'-?\w+', str(value)):
+            raise ValueError(f'Invalid SQLite pragma: {name} = {value}')
+        cursor.execute(f'PRAGMA {name} = {value}')
+# This function applies the configured pragmas to a new SQLite connection.
+# WAL mode lets visitors keep reading while a curator saves in the admin, and "synchronous = normal" is safe with WAL.
+# mmap_size and cache_size (negative means KiB) keep the census in memory, and temp_store keeps sorting off the disk.
+
+def connect_sqlite(path, pragmas=None, timeout=5):
+    db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+    apply_sqlite_pragmas(db.cursor(), pragmas)
+    return db
+# A plain sqlite3 connection (in autocommit mode) with the configured pragmas, for checks run outside of Django.
+
+def check_sqlite_concurrency(using=DEFAULT_DB_ALIAS, pragmas=None, seconds=5, readers=4):
+    pragmas = sqlite_pragmas() if pragmas is None else pragmas
+    timeout = settings.DATABASES[using].get('OPTIONS', {}).get('timeout', 5)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'census.sqlite3')
+        connection = connections[using]
+        connection.ensure_connection()
+        copy = sqlite3.connect(path)
+        connection.connection.backup(copy)
+        copy.close()
+        connect_sqlite(path, pragmas, timeout).close()
+
+        stop = threading.Event()
+        latencies, errors, commits = [], [], [0]
+        lock = threading.Lock()
+
+        def write():
+            db = connect_sqlite(path, pragmas, timeout)
+            while not stop.is_set():
+                try:
+                    db.execute('BEGIN IMMEDIATE')
+                    db.execute('UPDATE censusapp_copy SET features = features')
+                    time.sleep(0.01)
+                    db.execute('COMMIT')
+                    commits[0] += 1
+                except sqlite3.OperationalError as e:
+                    with lock:
+                        errors.append(f'writer: {e}')
+                    if db.in_transaction:
+                        db.execute('ROLLBACK')
+            db.close()
+
+        def read():
+            db = connect_sqlite(path, pragmas, timeout)
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    db.execute("SELECT COUNT(*), SUM(features) FROM censusapp_copy WHERE verification IN ('V', 'U')").fetchone()
+                except sqlite3.OperationalError as e:
+                    with lock:
+                        errors.append(f'reader: {e}')
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+            db.close()
+
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return {'latencies': latencies, 'errors': errors, 'commits': commits[0], 'seconds': seconds}
+# This function runs reader threads against a busy writer for a few seconds, on a temporary copy of the database (so
+# the census itself is never changed), and returns how long each read took and any queries that failed. The writer
+# rewrites every copy row, holding each transaction open briefly as a curator's save would.
+
+
+# --- Read-only snapshot ---
+
+SNAPSHOT_DATABASE = getattr(settings, 'CENSUS_SNAPSHOT_DATABASE', 'snapshot')
+SNAPSHOT_PUBLISH_ON_SAVE = getattr(settings, 'CENSUS_SNAPSHOT_PUBLISH_ON_SAVE', True)
+
+snapshot_published = Signal()
+
+_reading_snapshot = ContextVar('census_reading_snapshot', default=False)
+
+def snapshot_path():
+    name = str(settings.DATABASES[SNAPSHOT_DATABASE]['NAME'])
+    return Path(urlsplit(name).path if name.startswith('file:') else name)
+# The snapshot alias is normally opened as a URI, e.g. "file:/path/snapshot.sqlite3?mode=ro&immutable=1".
+
+def snapshot_enabled():
+    return SNAPSHOT_DATABASE in settings.DATABASES
+
+def snapshot_available():
+    return snapshot_enabled() and snapshot_path().exists()
+
+def _refresh_snapshot_connection():
+    connection = connections[SNAPSHOT_DATABASE]
+    status = snapshot_path().stat()
+    if getattr(connection, 'snapshot_inode', None) != status.st_ino:
+        connection.close()
+        connection.snapshot_inode = status.st_ino
+        connection.snapshot_version = status.st_mtime_ns
+# Publishing replaces the snapshot with a new file, so a connection that is still open on the old file is closed
+# and reopened. Immutable connections never look for changes themselves.
+
+def snapshot_version():
+    if not _reading_snapshot.get():
+        return None
+    return connections[SNAPSHOT_DATABASE].snapshot_version
+# While a view reads from the snapshot, this is the time (in nanoseconds) the snapshot was taken.
+
+@contextmanager
+def reading_snapshot():
+    if not snapshot_available():
+        yield
+        return
+    _refresh_snapshot_connection()
+    token = _reading_snapshot.set(True)
+    try:
+        yield
+    finally:
+        _reading_snapshot.reset(token)
+# Until a snapshot has been published, everything is simply read from the primary database.
+
+def _stream_from_snapshot(content):
+    with reading_snapshot():
+        yield from content
+
+def reads_snapshot(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with reading_snapshot():
+            response = view(request, *args, **kwargs)
+        if response.streaming:
+            response.streaming_content = _stream_from_snapshot(response.streaming_content)
+        return response
+    return wrapper
+# This decorator makes a public view read census records from the snapshot. Streamed responses (the CSV exports)
+# run their queries after the view has returned, so the snapshot is used again while they are sent.
+
+class SnapshotRouter:
+
+    def db_for_read(self, model, **hints):
+        if _reading_snapshot.get() and model._meta.app_label == 'censusapp' and getattr(model, 'census_record', True):
+            return SNAPSHOT_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db == SNAPSHOT_DATABASE:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if {obj1._state.db, obj2._state.db} <= {DEFAULT_DB_ALIAS, SNAPSHOT_DATABASE}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db == SNAPSHOT_DATABASE:
+            return False
+        return None
+# Only census records are read from the snapshot; sessions, users, the admin log and census jobs always use the primary
+# database.
+# Records that were read from the snapshot are saved to the primary database, and the snapshot is never migrated.
+
+def publish_snapshot(using=DEFAULT_DB_ALIAS):
+    path = snapshot_path()
+    source = connections[using]
+    source.ensure_connection()
+    handle, temp_path = tempfile.mkstemp(prefix=f'{path.name}.', suffix='.tmp', dir=path.parent)
+    os.close(handle)
+    try:
+        started = time.time_ns()
+        target = sqlite3.connect(temp_path)
+        try:
+            source.connection.backup(target)
+            target.execute('PRAGMA journal_mode = delete')
+        finally:
+            target.close()
+        os.chmod(temp_path, stat.S_IMODE(os.stat(source.settings_dict['NAME']).st_mode))
+        os.utime(temp_path, ns=(started, started))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    snapshot_published.send(sender=None, path=path)
+    return path
+# This function copies the primary database into a new file beside the snapshot, then swaps it into place in one step.
+# Visitors in the middle of a request keep reading the old file; the next request opens the new one.
+# The copy is switched out of WAL mode, since an immutable database is read without its -wal file. Its modification
+# time is set to when the copy began, so that it is never taken to include edits saved while it was being made.
+
+def _snapshot_queued():
+    pass
+_snapshot_queued.queues_snapshot = True
+
+def schedule_snapshot(using=DEFAULT_DB_ALIAS):
+    if not (SNAPSHOT_PUBLISH_ON_SAVE and snapshot_enabled()):
+        return
+    connection = connections[using]
+    if any(getattr(callback, 'queues_snapshot', False) for _, callback, *_ in connection.run_on_commit):
+        return
+    from .jobs import enqueue
+    enqueue('snapshot')
+    transaction.on_commit(_snapshot_queued, using=using)
+# Edits queue a "snapshot" job, which a worker ("manage.py run_census_jobs --forever") runs to publish a new snapshot,
+# so that saving never waits while the whole database is copied. The job is queued in the edit's own transaction, so
+# it is only there if the edit is committed. An admin save changes several records in one transaction, but queues
+# only once (the empty on_commit callback marks the transaction), and while a job is already waiting to run, that one
+# publishes this edit too: the edit's transaction holds SQLite's write lock, so no worker can claim the waiting job
+# until the edit has been committed.
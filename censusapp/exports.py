@@ -0,0 +1,125 @@
+from django.db.models import Count
+from django.db.models.functions import Lower
+import csv
+from . import models
+from .utils import canonical_query
+
+
+# --- Export rows ---
+
+def _counted(copies):
+    return (models.Copy.objects.all() if copies is None else copies).filter(canonical_query)
+
+def _output(entry, order, row, keyed):
+    if not keyed:
+        return row
+    return tuple((entry[field] is not None, entry[field]) for field in order), row
+# With keyed=True, each row comes with the values it is ordered by (NULLs first, as in SQLite), so that rows counted
+# separately for different parts of the census can be merged back into the same order. The header is left out.
+
+def location_copy_count_rows(copies=None, keyed=False):
+    if not keyed:
+        yield ['Location', 'Number of Copies']
+    order = ['location__name', 'location']
+    locations = (
+        _counted(copies)
+        .values('location', 'location__name')
+        .annotate(total=Count('id'))
+        .order_by(*order)
+    )
+    for entry in locations.iterator():
+        yield _output(entry, order, [entry['location__name'], entry['total']], keyed)
+
+def title_copy_count_rows(copies=None, keyed=False):
+    if not keyed:
+        yield ['Title', 'Number of Copies']
+    order = ['issue__edition__title__sort_title', 'issue__edition__title']
+    titles = (
+        _counted(copies)
+        .values('issue__edition__title', 'issue__edition__title__title', 'issue__edition__title__sort_title')
+        .annotate(total=Count('id'))
+        .order_by(*order)
+    )
+    for entry in titles.iterator():
+        yield _output(entry, order, [entry['issue__edition__title__title'], entry['total']], keyed)
+
+def edition_copy_count_rows(copies=None, keyed=False):
+    if not keyed:
+        yield ['Edition', 'Number of Copies']
+    order = ['title_order', 'issue__edition__edition_number', 'issue__edition']
+    editions = (
+        _counted(copies)
+        .values('issue__edition', 'issue__edition__title__title', 'issue__edition__edition_number')
+        .annotate(total=Count('id'), title_order=Lower('issue__edition__title__title'))
+        .order_by(*order)
+    )
+    for entry in editions.iterator():
+        row = [f"{entry['issue__edition__title__title']} Edition {entry['issue__edition__edition_number']}", entry['total']]
+        yield _output(entry, order, row, keyed)
+
+def issue_copy_count_rows(copies=None, keyed=False):
+    if not keyed:
+        yield ['Issue (Title + ESTC)', 'Number of Copies']
+    order = ['issue__edition__title__title', 'issue__estc', 'issue']
+    issues = (
+        _counted(copies)
+        .values('issue', 'issue__edition__title__title', 'issue__estc')
+        .annotate(total=Count('id'))
+        .order_by(*order)
+    )
+    for entry in issues.iterator():
+        row = [f"{entry['issue__edition__title__title']} (ESTC {entry['issue__estc']})", entry['total']]
+        yield _output(entry, order, row, keyed)
+
+def provenance_name_copy_count_rows(copies=None, keyed=False):
+    if not keyed:
+        yield ['Provenance Name', 'Bio', 'VIAF', 'Gender', 'Start Century', 'End Century', 'Number of Copies']
+    owner_fields = ['owner__name', 'owner__bio', 'owner__viaf', 'owner__gender', 'owner__start_century', 'owner__end_century']
+    order = ['owner__name', 'owner']
+    ownerships = (
+        models.ProvenanceOwnership.objects.filter(copy__in=_counted(copies))
+        .values('owner', *owner_fields)
+        .annotate(total=Count('copy'))
+        .order_by(*order)
+    )
+    for entry in ownerships.iterator():
+        yield _output(entry, order, [entry[field] for field in owner_fields] + [entry['total']], keyed)
+# Each export is a single grouped query joined to the names it needs, read from the database in chunks.
+# Given a queryset of copies, an export counts only those (still leaving out ghost copies).
+
+
+EXPORTS = {
+    'location_copy_count': location_copy_count_rows,
+    'title_copy_count': title_copy_count_rows,
+    'edition_copy_count': edition_copy_count_rows,
+    'issue_copy_count': issue_copy_count_rows,
+    'provenance_name_copy_count': provenance_name_copy_count_rows,
+}
+
+EXPORT_SHARDS = {
+    'location_copy_count': 'location',
+    'title_copy_count': 'issue__edition__title',
+    'edition_copy_count': 'issue__edition__title',
+    'issue_copy_count': 'issue__edition__title',
+    'provenance_name_copy_count': 'issue__edition__title',
+}
+# Each export can be counted in parts, by the copies of some of the titles or locations at a time. A provenance name
+# can own copies of several titles, so its counts from each part are added together when the parts are merged.
+
+
+# --- CSV writing ---
+
+class Echo:
+    def write(self, value):
+        return value
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+# This generator turns rows into CSV lines one at a time, so an export never sits in memory as a whole.
+
+def write_csv(rows, file):
+    writer = csv.writer(file)
+    for row in rows:
+        writer.writerow(row)
@@ -0,0 +1,99 @@
+from django.conf import settings
+from django.db.models import Count, F, Q, Value
+from . import models
+from .utils import (
+    FEATURE_DISPLAY_NAMES, century_label, facsimile_query, feature_query, verified_query, unverified_query
+)
+
+
+# --- Settings ---
+
+FACET_LIMIT = getattr(settings, 'SEARCH_FACET_LIMIT', 10)
+# Facets with many options (countries and titles) list only this many, with the largest counts first.
+
+
+# --- Search Facets ---
+
+def facet(name, field, options):
+    return {
+        'name': name,
+        'field': field,
+        'options': [
+            {'value': value, 'label': label, 'count': count}
+            for value, label, count in options if count
+        ],
+    }
+
+def flag_facets(copies):
+    features = [name for name in FEATURE_DISPLAY_NAMES if name not in ('unverified', 'ghost')]
+    counts = copies.aggregate(
+        verified_count=Count('pk', filter=verified_query),
+        unverified_count=Count('pk', filter=unverified_query),
+        fragment_count=Count('pk', filter=Q(fragment=True)),
+        complete_count=Count('pk', filter=Q(fragment=False)),
+        facsimile_count=Count('pk', filter=facsimile_query),
+        no_facsimile_count=Count('pk', filter=~facsimile_query),
+        **{f'{name}_count': Count('pk', filter=feature_query(name)) for name in features},
+    )
+    return [
+        facet('Verification', 'verification', [
+            ('V', 'Verified', counts['verified_count']),
+            ('U', 'Unverified', counts['unverified_count']),
+        ]),
+        facet('Fragment', 'fragment', [
+            ('no', 'Complete copies', counts['complete_count']),
+            ('yes', 'Fragments', counts['fragment_count']),
+        ]),
+        facet('Digital Facsimile', 'facsimile', [
+            ('yes', 'Available', counts['facsimile_count']),
+            ('no', 'Not available', counts['no_facsimile_count']),
+        ]),
+        facet('Specific Features', 'collection', [
+            (name, FEATURE_DISPLAY_NAMES[name], counts[f'{name}_count']) for name in features
+        ]),
+    ]
+# This function counts every yes/no facet in one aggregate query.
+
+def century_facet(copies):
+    rows = (
+        copies.filter(issue__start_date__gt=0)
+        .annotate(century=F('issue__start_date') / Value(100) + Value(1))
+        .values('century').annotate(count=Count('pk')).order_by('century')
+    )
+    return facet('Century', 'century', [
+        (str(row['century']), century_label(row['century']), row['count']) for row in rows
+    ])
+
+def geography_facets(copies):
+    rows = (
+        copies.values('location__continent', 'location__country')
+        .annotate(count=Count('pk')).order_by()
+    )
+    continents, countries = {}, {}
+    for row in rows:
+        for totals, name in [(continents, row['location__continent']), (countries, row['location__country'])]:
+            name = (name or '').strip()
+            if name:
+                totals[name] = totals.get(name, 0) + row['count']
+    def largest(totals):
+        ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:FACET_LIMIT]
+        return [(name, name, count) for name, count in ranked]
+    return [facet('Continent', 'continent', largest(continents)), facet('Country', 'country', largest(countries))]
+# Continents and countries come from one grouped query, and the continent totals are added up from it.
+
+def title_facet(copies):
+    rows = (
+        copies.values('issue__edition__title', 'issue__edition__title__title')
+        .annotate(count=Count('pk'))
+        .order_by('-count', 'issue__edition__title__sort_title')[:FACET_LIMIT]
+    )
+    return facet('Title', 'title', [
+        (str(row['issue__edition__title']), row['issue__edition__title__title'], row['count']) for row in rows
+    ])
+
+def search_facets(result_list):
+    copies = models.Copy.objects.filter(pk__in=result_list.order_by().values('pk'))
+    facets = [century_facet(copies), *geography_facets(copies), title_facet(copies), *flag_facets(copies)]
+    return [f for f in facets if f['options']]
+# This function counts the search results by each facet, in four grouped aggregate queries.
+# Each query works from the ids of the results, so copies matched through several joins are only counted once.
@@ -0,0 +1,266 @@
+from django.conf import settings
+from django.db import connections
+from collections import deque
+from datetime import datetime, timezone
+import math
+import threading
+import time
+
+
+# --- Settings ---
+
+INSTRUMENTATION_ENABLED = getattr(settings, 'CENSUS_INSTRUMENTATION', True)
+SERVER_TIMING = getattr(settings, 'CENSUS_SERVER_TIMING', True)
+WINDOW_SECONDS = getattr(settings, 'CENSUS_INSTRUMENTATION_WINDOW', 15 * 60)
+SLOW_REQUEST_MS = getattr(settings, 'CENSUS_SLOW_REQUEST_MS', 500)
+SLOW_REQUEST_SAMPLES = getattr(settings, 'CENSUS_SLOW_REQUEST_SAMPLES', 50)
+SAMPLE_MAX_QUERIES = 20
+PERCENTILES = (50, 90, 95, 99)
+# Timings are kept in memory by each worker process, so the report shows the requests handled by the process that answers it.
+
+
+# --- Histograms ---
+
+BUCKET_GROWTH = 1.1
+
+def _bucket(ms):
+    return max(0, math.ceil(math.log(max(ms, 0.01) * 100, BUCKET_GROWTH)))
+
+def _bucket_limit(bucket):
+    return BUCKET_GROWTH ** bucket / 100
+# Durations are counted in buckets that each cover 10% more than the one before, so any percentile read back from
+# them is within 10% of the true value, however many requests have been recorded.
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, ms):
+        bucket = _bucket(ms)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += ms
+        self.maximum = max(self.maximum, ms)
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank, seen = math.ceil(self.count * p / 100), 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(_bucket_limit(bucket), self.maximum)
+        return self.maximum
+
+    def summary(self):
+        return {
+            'mean': round(self.total / self.count, 2) if self.count else 0.0,
+            **{f'p{p}': round(self.percentile(p), 2) for p in PERCENTILES},
+            'max': round(self.maximum, 2),
+        }
+
+class ViewStats:
+
+    def __init__(self):
+        self.wall = Histogram()
+        self.db = Histogram()
+        self.queries = Histogram()
+        self.errors = 0
+
+    def add(self, record):
+        self.wall.add(record['wall_ms'])
+        self.db.add(record['db_ms'])
+        self.queries.add(record['queries'])
+        if record['status'] >= 500:
+            self.errors += 1
+
+    def merge(self, other):
+        self.wall.merge(other.wall)
+        self.db.merge(other.db)
+        self.queries.merge(other.queries)
+        self.errors += other.errors
+
+    def summary(self):
+        return {
+            'requests': self.wall.count,
+            'errors': self.errors,
+            'wall_ms': self.wall.summary(),
+            'db_ms': self.db.summary(),
+            'queries': {
+                'mean': self.queries.summary()['mean'],
+                'p95': round(self.queries.percentile(95)),
+                'max': round(self.queries.maximum),
+            },
+        }
+
+
+# --- Rolling windows ---
+
+class Recorder:
+
+    def __init__(self, window=WINDOW_SECONDS, samples=SLOW_REQUEST_SAMPLES):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=samples)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.current, self.previous = {}, {}
+            self.samples.clear()
+
+    def _rotate(self, now):
+        if now - self.started >= self.window:
+            expired = now - self.started >= 2 * self.window
+            self.previous = {} if expired else self.current
+            self.current = {}
+            self.started = now
+
+    def add(self, record, sample=None):
+        with self.lock:
+            self._rotate(time.time())
+            self.current.setdefault(record['view'], ViewStats()).add(record)
+            if sample is not None:
+                self.samples.append(sample)
+
+    def report(self):
+        with self.lock:
+            self._rotate(time.time())
+            merged = {}
+            for stats in (self.previous, self.current):
+                for view, view_stats in stats.items():
+                    merged.setdefault(view, ViewStats()).merge(view_stats)
+            samples = list(self.samples)
+        return {
+            'window_seconds': self.window,
+            'slow_request_ms': SLOW_REQUEST_MS,
+            'views': {view: merged[view].summary() for view in sorted(merged)},
+            'slow_requests': samples[::-1],
+        }
+
+recorder = Recorder()
+# Each view's timings cover the current window and the one before it, so the report always reflects between one and two
+# windows of recent traffic. Old windows are dropped as they expire, and memory use stays the same however busy the site is.
+
+
+# --- Query recording ---
+
+class QueryLog:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            self.statements.append((elapsed, context['connection'].alias, sql))
+
+    def slowest(self, limit=SAMPLE_MAX_QUERIES):
+        repeats = {}
+        for elapsed, alias, sql in self.statements:
+            entry = repeats.setdefault((alias, sql), {'database': alias, 'sql': sql, 'times': 0, 'ms': 0.0})
+            entry['times'] += 1
+            entry['ms'] += elapsed * 1000
+        ranked = sorted(repeats.values(), key=lambda entry: -entry['ms'])[:limit]
+        return [{**entry, 'ms': round(entry['ms'], 2)} for entry in ranked]
+# Statements are only kept until the request ends, and are written out only for slow requests. Identical statements
+# are grouped, so a query repeated for every row of a page shows up once with the number of times it ran.
+
+def _install(query_log):
+    for connection in connections.all():
+        if query_log not in connection.execute_wrappers:
+            connection.execute_wrappers.append(query_log)
+
+def _uninstall(query_log):
+    for connection in connections.all():
+        if query_log in connection.execute_wrappers:
+            connection.execute_wrappers.remove(query_log)
+
+
+# --- Middleware ---
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else None
+
+def _server_timing(wall_ms, query_log):
+    return f'app;dur={wall_ms:.1f}, db;dur={query_log.seconds * 1000:.1f};desc="{query_log.count} queries"'
+
+def _finish(request, response, started, query_log):
+    _uninstall(query_log)
+    name = view_name(request)
+    if name is None:
+        return
+    wall_ms = (time.perf_counter() - started) * 1000
+    record = {
+        'view': name,
+        'wall_ms': wall_ms,
+        'db_ms': query_log.seconds * 1000,
+        'queries': query_log.count,
+        'status': response.status_code,
+    }
+    sample = None
+    if wall_ms >= SLOW_REQUEST_MS:
+        sample = {
+            **record,
+            'wall_ms': round(wall_ms, 2),
+            'db_ms': round(record['db_ms'], 2),
+            'path': request.get_full_path(),
+            'method': request.method,
+            'at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'statements': query_log.slowest(),
+        }
+    recorder.add(record, sample)
+
+def _stream_and_finish(request, response, content, started, query_log):
+    try:
+        yield from content
+    finally:
+        _finish(request, response, started, query_log)
+
+class InstrumentationMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not INSTRUMENTATION_ENABLED:
+            return self.get_response(request)
+        query_log = QueryLog()
+        started = time.perf_counter()
+        _install(query_log)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            _uninstall(query_log)
+            raise
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = _server_timing((time.perf_counter() - started) * 1000, query_log)
+        if response.streaming:
+            response.streaming_content = _stream_and_finish(request, response, response.streaming_content, started, query_log)
+        else:
+            _finish(request, response, started, query_log)
+        return response
+# This middleware times every request that reaches a view, along with the number and duration of its database queries,
+# and records them under the view's URL name (e.g. "search" or "admin:censusapp_copy_changelist").
+# Streamed responses (the CSV exports) run their queries while they are sent, so they are recorded once the last row
+# has gone out; their Server-Timing header can only cover the work done before the first row.
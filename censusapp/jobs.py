@@ -0,0 +1,470 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Count, F
+from django.utils import timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager, nullcontext
+from datetime import timedelta
+from functools import partial
+from pathlib import Path
+import csv
+import django
+import heapq
+import io
+import os
+import shutil
+import socket
+import tempfile
+import time
+import traceback
+import zipfile
+from . import models
+from .bulk_import import IMPORT_BATCH_SIZE, IMPORTERS, bulk_import
+from .changes import latest_change
+from .database import publish_snapshot, reading_snapshot, schedule_snapshot
+from .exports import EXPORT_SHARDS, EXPORTS, write_csv
+from .models import JobStatusChoices as Status
+from .search_index import get_search_index
+from .stats import count_statistics, finish_statistics, store_statistics
+
+
+# --- Settings ---
+
+JOB_DIR = Path(getattr(settings, 'CENSUS_JOB_DIR', settings.BASE_DIR / 'jobs'))
+JOB_WORKERS = getattr(settings, 'CENSUS_JOB_WORKERS', None)
+JOB_HISTORY = getattr(settings, 'CENSUS_JOB_HISTORY', 5)
+JOB_MAX_ATTEMPTS = getattr(settings, 'CENSUS_JOB_MAX_ATTEMPTS', 3)
+JOB_RETRY_DELAY = getattr(settings, 'CENSUS_JOB_RETRY_DELAY', 60)
+JOB_STALLED_AFTER = getattr(settings, 'CENSUS_JOB_STALLED_AFTER', 60 * 60)
+JOB_POLL_INTERVAL = getattr(settings, 'CENSUS_JOB_POLL_INTERVAL', 5)
+JOB_QUEUE_EXPORTS = getattr(settings, 'CENSUS_JOB_QUEUE_EXPORTS', True)
+DUMP_CHUNK_SIZE = 2000
+# JOB_HISTORY finished jobs of each kind are kept, with their files; older ones are deleted.
+# A failed job is tried again after JOB_RETRY_DELAY seconds, then twice that, and so on, up to JOB_MAX_ATTEMPTS attempts.
+# A running job that hasn't reported any progress for JOB_STALLED_AFTER seconds (e.g. because its worker was killed)
+# is counted as a failed attempt.
+
+
+# --- Shards ---
+
+def balanced_shards(weights, count):
+    shards = [[0, []] for _ in range(max(1, count))]
+    for pk, weight in sorted(weights.items(), key=lambda item: (-item[1], item[0])):
+        shard = min(shards, key=lambda shard: shard[0])
+        shard[0] += weight
+        shard[1].append(pk)
+    return [sorted(ids) for _, ids in shards if ids]
+# The heaviest groups are handed out first, each to the shard with the least work so far, so that a title with
+# a great many copies doesn't leave the other workers waiting. The same census always gives the same shards.
+
+def shards(model, path, count):
+    weights = dict(model.objects.order_by().values(path).annotate(rows=Count('pk')).values_list(path, 'rows'))
+    return balanced_shards(weights, count)
+# This function splits the rows of a model into groups by the title or location they belong to (e.g. path
+# "issue__edition__title" for copies), weighted by the number of rows in each.
+
+
+# --- Work done in worker processes ---
+
+def _start_worker():
+    django.setup()
+# Worker processes started by "spawn" (rather than forked) need Django set up before they can read anything.
+
+def _run_all(executor, function, calls, progress=None):
+    if executor is None:
+        results = []
+        for args in calls:
+            results.append(function(*args))
+            if progress is not None:
+                progress(len(results), len(calls))
+        return results
+    futures = [executor.submit(function, *args) for args in calls]
+    for done, _ in enumerate(as_completed(futures), start=1):
+        if progress is not None:
+            progress(done, len(futures))
+    return [future.result() for future in futures]
+# Results come back in the order the calls were made, however long each one takes.
+
+def _count_export(name, path, ids):
+    with reading_snapshot():
+        return list(EXPORTS[name](models.Copy.objects.filter(**{f'{path}__in': ids}), keyed=True))
+
+def _count_statistics(path, ids):
+    with reading_snapshot():
+        return count_statistics(models.Copy.objects.filter(**{f'{path}__in': ids}))
+
+def _dump_columns(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+def _dump_part(model_name, path, ids, part_path):
+    model = apps.get_model('censusapp', model_name)
+    with reading_snapshot():
+        rows = model.objects.all()
+        if path is not None:
+            rows = rows.filter(**{f'{path}__in': ids})
+        with open(part_path, 'w', newline='', encoding='utf-8') as f:
+            write_csv(rows.order_by('pk').values_list(*_dump_columns(model)).iterator(chunk_size=DUMP_CHUNK_SIZE), f)
+    return part_path
+# Each part is written to a file rather than sent back to the parent process, so that a dump of every copy never has
+# to be held in memory.
+
+
+# --- Merging ---
+
+def merge_counts(parts):
+    previous_key, previous_row = None, None
+    for key, row in heapq.merge(*parts, key=lambda item: item[0]):
+        if previous_row is not None and key == previous_key:
+            previous_row[-1] += row[-1]
+            continue
+        if previous_row is not None:
+            yield previous_row
+        previous_key, previous_row = key, list(row)
+    if previous_row is not None:
+        yield previous_row
+# Every part is already in the export's order, so they are merged into one list in that same order, and the counts
+# of any group found in more than one part are added up. The result is the same as counting the whole census at once.
+
+def merge_parts(part_paths, file):
+    writer = csv.writer(file)
+    count = 0
+    with ExitStack() as stack:
+        readers = [csv.reader(stack.enter_context(open(path, newline='', encoding='utf-8'))) for path in part_paths]
+        for row in heapq.merge(*readers, key=lambda row: int(row[0])):
+            writer.writerow(row)
+            count += 1
+    return count
+# Parts are merged by id, so a dump lists its rows in the same order however the work was split up.
+
+
+# --- Job kinds ---
+
+class JobRun:
+
+    def __init__(self, job, executor, workdir, workers):
+        self.job = job
+        self.params = job.params or {}
+        self.executor = executor
+        self.workdir = workdir
+        self.workers = workers
+        self.census_version = None
+
+    def progress(self, done, total=None):
+        models.CensusJob.objects.filter(pk=self.job.pk).update(
+            progress_done=done, progress_total=total, heartbeat_at=timezone.now(),
+        )
+
+    @contextmanager
+    def reading_census(self):
+        with reading_snapshot():
+            self.census_version = latest_change()
+            yield
+# A job kind is a function that takes a JobRun, with the pool of worker processes to use (None for a single process),
+# a directory for its files and the job's parameters, and returns the file it wrote (if any) and a JSON result.
+# Kinds that read the census do so from the snapshot, inside reading_census(), which notes the census version.
+
+def run_export(name, run):
+    path = EXPORT_SHARDS[name]
+    with run.reading_census():
+        calls = [(name, path, ids) for ids in shards(models.Copy, path, run.workers)]
+        parts = _run_all(run.executor, _count_export, calls, run.progress)
+    rows = list(merge_counts(parts))
+    artifact = run.workdir / f'{name}.csv'
+    with open(artifact, 'w', newline='', encoding='utf-8') as f:
+        write_csv([next(EXPORTS[name]()), *rows], f)
+    return artifact, {'rows': len(rows), 'shards': len(parts)}
+# The copies are counted by title (or, for the location export, by location), a group of them in each worker.
+
+DUMP_MODELS = [
+    (models.Title, None),
+    (models.Edition, 'title'),
+    (models.Issue, 'edition__title'),
+    (models.Copy, 'issue__edition__title'),
+    (models.Location, None),
+    (models.ProvenanceName, None),
+    (models.ProvenanceOwnership, 'copy__issue__edition__title'),
+    (models.StaticPageText, None),
+]
+# Editions, issues, copies and provenance records are dumped by title, a group of titles in each worker.
+
+def run_dump(run):
+    calls = []
+    with run.reading_census():
+        for model, path in DUMP_MODELS:
+            name = model._meta.model_name
+            groups = shards(model, path, run.workers) if path is not None else [None]
+            calls += [(name, path, ids, run.workdir / f'{name}.{number}.csv') for number, ids in enumerate(groups)]
+        results = _run_all(run.executor, _dump_part, calls, run.progress)
+    parts = {}
+    for (name, *_), part in zip(calls, results):
+        parts.setdefault(name, []).append(part)
+
+    artifact = run.workdir / 'census-dump.zip'
+    counts = {}
+    with zipfile.ZipFile(artifact, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for model, _ in DUMP_MODELS:
+            name = model._meta.model_name
+            with archive.open(f'{name}.csv', 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+                csv.writer(f).writerow(_dump_columns(model))
+                counts[name] = merge_parts(parts.get(name, []), f)
+    return artifact, {'rows': counts}
+# This job writes every field of every census record (including private notes, so only staff can download it)
+# to a zip file with one CSV file per model.
+
+def run_statistics(run):
+    with run.reading_census():
+        calls = [('location', ids) for ids in shards(models.Copy, 'location', run.workers)]
+        parts = _run_all(run.executor, _count_statistics, calls, run.progress)
+        totals = {name: sum(part[name] for part in parts) for name in parts[0]} if parts else count_statistics()
+    statistics = finish_statistics(totals)
+    with reading_snapshot():
+        if latest_change() == run.census_version:
+            store_statistics(statistics)
+    return None, statistics
+# The copies at each group of locations are counted separately and the counts added up. The new figures replace
+# the cached ones, so the next page to show them doesn't have to count them itself (unless a new snapshot was
+# published meanwhile, when they may mix old and new counts).
+
+def run_import(run):
+    params = run.params
+    with open(upload_path(params['upload']), 'rb') as file:
+        report = bulk_import(
+            params['kind'], file, params['filename'], batch_size=params.get('batch_size', IMPORT_BATCH_SIZE),
+            dry_run=params.get('dry_run', False), progress=run.progress,
+        )
+    return None, {
+        'summary': report.summary(),
+        'rows': report.rows,
+        'created': len(report.created),
+        'updated': len(report.updated),
+        'error_count': report.error_count,
+        'errors': report.errors,
+    }
+# This job imports a file uploaded through the admin's bulk import page (see save_upload()). The import runs in one
+# transaction, so a failed attempt leaves nothing behind and the next attempt starts again from the first row.
+
+def run_search_index(run):
+    total = get_search_index().rebuild(using=DEFAULT_DB_ALIAS)
+    schedule_snapshot()
+    return None, {'copies': total}
+# The keyword index is rebuilt in the database and then published with the rest of the census in a new snapshot.
+
+def run_snapshot(run):
+    path = publish_snapshot()
+    return None, {'bytes': path.stat().st_size}
+# This job publishes a new read-only snapshot of the census (see schedule_snapshot()).
+
+JOB_KINDS = {
+    **{name: partial(run_export, name) for name in EXPORTS},
+    'dump': run_dump,
+    'statistics': run_statistics,
+    'import': run_import,
+    'search_index': run_search_index,
+    'snapshot': run_snapshot,
+}
+JOB_SINGLE_PROCESS = {'import', 'search_index', 'snapshot'}
+JOB_PARAMETERS = {'import': ['kind', 'upload', 'filename']}
+JOB_PRIORITIES = {'snapshot': 30, 'import': 20, 'search_index': 10, 'statistics': 5, 'dump': -10}
+# Imports need the file to import (so they are queued from the admin, with queue_import()); other kinds need nothing.
+# Kinds in JOB_SINGLE_PROCESS do all their work in one process, so no pool of worker processes is started for them.
+# Snapshots run first, so that edits reach the public pages quickly, then queued imports; dumps, which take longest
+# and are rarely urgent, run last.
+# Kinds that aren't listed have priority 0.
+
+
+# --- Queueing jobs ---
+
+def enqueue(kind, params=None, priority=None, max_attempts=JOB_MAX_ATTEMPTS):
+    if kind not in JOB_KINDS:
+        raise ValueError(f'Unknown job "{kind}". Choose from: {", ".join(JOB_KINDS)}.')
+    missing = [name for name in JOB_PARAMETERS.get(kind, []) if name not in (params or {})]
+    if missing:
+        raise ValueError(f'"{kind}" jobs need: {", ".join(missing)}.')
+    if priority is None:
+        priority = JOB_PRIORITIES.get(kind, 0)
+    if not params:
+        queued = models.CensusJob.objects.filter(kind=kind, status=Status.QUEUED).order_by('pk')
+        job = next((job for job in queued if not job.params), None)
+        if job is not None:
+            if priority > job.priority:
+                models.CensusJob.objects.filter(pk=job.pk).update(priority=priority)
+                job.priority = priority
+            return job
+    return models.CensusJob.objects.create(kind=kind, params=params or {}, priority=priority, max_attempts=max_attempts)
+# Asking for a job that is already waiting to run gives back the waiting one rather than queueing it twice (raising
+# its priority if need be). Jobs with parameters, such as imports, are always queued.
+
+def save_upload(file, filename):
+    directory = JOB_DIR / 'uploads'
+    directory.mkdir(parents=True, exist_ok=True)
+    handle, path = tempfile.mkstemp(suffix=Path(filename).suffix.lower(), dir=directory)
+    with os.fdopen(handle, 'wb') as f:
+        for chunk in file.chunks():
+            f.write(chunk)
+    return Path(path).name
+
+def upload_path(name):
+    return JOB_DIR / 'uploads' / Path(name).name
+# Uploaded files are kept under JOB_DIR until the job that imports them is done (or, if it failed, has been pruned,
+# so that it can be queued again from the admin).
+
+def queue_import(kind, file, filename, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
+    if kind not in IMPORTERS:
+        raise ValueError(f'Unknown import "{kind}".')
+    params = {'kind': kind, 'upload': save_upload(file, filename), 'filename': filename,
+              'batch_size': batch_size, 'dry_run': dry_run}
+    return enqueue('import', params)
+
+def artifact_path(job):
+    return JOB_DIR / job.artifact if job.artifact else None
+
+
+# --- Running jobs ---
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def _claim(job, worker):
+    now = timezone.now()
+    return models.CensusJob.objects.filter(pk=job.pk, status=Status.QUEUED).update(
+        status=Status.RUNNING, started_at=now, heartbeat_at=now, finished_at=None, worker=worker,
+        attempts=F('attempts') + 1, progress_done=0, progress_total=None,
+    )
+# The job is only claimed if it is still queued, so when several workers reach for the same job, one of them gets it.
+
+def next_job(worker):
+    while True:
+        job = (
+            models.CensusJob.objects.filter(status=Status.QUEUED, run_after__lte=timezone.now())
+            .order_by('-priority', 'run_after', 'pk').first()
+        )
+        if job is None or _claim(job, worker):
+            return job
+# This function claims the queued job that should run next, or returns None if there isn't one.
+
+def _remove_upload(job):
+    if job.params.get('upload'):
+        upload_path(job.params['upload']).unlink(missing_ok=True)
+
+def _running(job):
+    return models.CensusJob.objects.filter(pk=job.pk, status=Status.RUNNING, worker=job.worker)
+
+def _failed(job, error):
+    if job.attempts < job.max_attempts:
+        delay = JOB_RETRY_DELAY * 2 ** max(job.attempts - 1, 0)
+        _running(job).update(
+            status=Status.QUEUED, run_after=timezone.now() + timedelta(seconds=delay), worker='', error=error,
+        )
+    else:
+        _running(job).update(status=Status.FAILED, finished_at=timezone.now(), error=error)
+# A failed job goes back in the queue to be tried again later, until it has used up its attempts. The job is only
+# updated while it still belongs to the worker that ran it, so a worker that was taken for dead and comes back
+# later can't overwrite what has happened to the job since.
+
+def _execute(job, workers):
+    job.refresh_from_db()
+    JOB_DIR.mkdir(parents=True, exist_ok=True)
+    workdir = Path(tempfile.mkdtemp(prefix=f'.job-{job.pk}-', dir=JOB_DIR))
+    try:
+        workers = 1 if job.kind in JOB_SINGLE_PROCESS else workers or os.cpu_count() or 1
+        if workers > 1:
+            connections.close_all()
+        with ProcessPoolExecutor(workers, initializer=_start_worker) if workers > 1 else nullcontext() as executor:
+            run = JobRun(job, executor, workdir, workers)
+            artifact, result = JOB_KINDS[job.kind](run)
+        name = ''
+        if artifact is not None:
+            name = f'{job.pk}-{artifact.name}'
+            os.replace(artifact, JOB_DIR / name)
+        if _running(job).update(
+            status=Status.DONE, finished_at=timezone.now(), census_version=run.census_version, artifact=name,
+            result=result, error='',
+        ):
+            _remove_upload(job)
+        elif name:
+            (JOB_DIR / name).unlink(missing_ok=True)
+    except Exception:
+        _failed(job, traceback.format_exc())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    prune_jobs(job.kind)
+    return models.CensusJob.objects.get(pk=job.pk)
+# This function runs a claimed job in the current process, spreading its work over a pool of worker processes (one
+# per CPU unless told otherwise), and records the outcome.
+
+def run_job(job, workers=JOB_WORKERS, worker=None):
+    if not _claim(job, worker or worker_name()):
+        return None
+    return _execute(job, workers)
+# This function runs a job straight away, whatever its priority, unless someone else has already started it.
+
+def requeue_stalled(stalled_after=JOB_STALLED_AFTER):
+    cutoff = timezone.now() - timedelta(seconds=stalled_after)
+    stalled = models.CensusJob.objects.filter(status=Status.RUNNING, heartbeat_at__lt=cutoff)
+    for job in stalled:
+        _failed(job, f'The job stopped responding on {job.worker or "its worker"}.')
+# A job whose worker was killed would otherwise be left running forever.
+
+def run_queued_jobs(workers=JOB_WORKERS, worker=None, stop=None, poll_interval=None):
+    worker = worker or worker_name()
+    finished = []
+    while stop is None or not stop.is_set():
+        requeue_stalled()
+        job = next_job(worker)
+        if job is not None:
+            finished.append(_execute(job, workers))
+        elif poll_interval is None:
+            break
+        elif stop is not None:
+            stop.wait(poll_interval)
+        else:
+            time.sleep(poll_interval)
+    return finished
+# Without a poll_interval, this function runs the jobs that are ready and returns them once the queue is empty.
+# With one, it keeps waiting for new jobs, checking the queue every poll_interval seconds, until "stop" (an Event)
+# is set. Any number of workers can share the queue, on one machine or several sharing the database.
+
+def prune_jobs(kind, keep=JOB_HISTORY):
+    old = models.CensusJob.objects.filter(kind=kind, status__in=[Status.DONE, Status.FAILED]).order_by('-pk')[keep:]
+    for job in list(old):
+        path = artifact_path(job)
+        if path is not None:
+            path.unlink(missing_ok=True)
+        _remove_upload(job)
+        job.delete()
+
+def current_artifact(kind):
+    with reading_snapshot():
+        census_version = latest_change()
+    job = (
+        models.CensusJob.objects.filter(kind=kind, status=Status.DONE, census_version=census_version)
+        .exclude(artifact='').order_by('-pk').first()
+    )
+    return artifact_path(job) if job is not None else None
+# This function returns the file written by the latest job of this kind if nothing in the census has changed since,
+# so that it can be sent instead of building the same export again.
+
+
+# --- Status ---
+
+def job_status(job, artifact_url=None):
+    seconds = (job.finished_at - job.started_at).total_seconds() if job.started_at and job.finished_at else None
+    return {
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.get_status_display().lower(),
+        'created': job.created_at.isoformat(),
+        'started': job.started_at.isoformat() if job.started_at else None,
+        'finished': job.finished_at.isoformat() if job.finished_at else None,
+        'seconds': round(seconds, 2) if seconds is not None else None,
+        'priority': job.priority,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'retry_at': job.run_after.isoformat() if job.status == Status.QUEUED and job.attempts else None,
+        'progress': {'done': job.progress_done, 'total': job.progress_total} if job.started_at else None,
+        'census_version': job.census_version,
+        'result': job.result,
+        'error': job.error or None,
+        'artifact': artifact_url if job.artifact else None,
+    }
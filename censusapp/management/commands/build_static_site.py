@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from censusapp.static_site import STATIC_SITE_DIR, STATIC_SITE_WORKERS, build_site
+import time
+
+
+class Command(BaseCommand):
+    help = ('Writes the public pages of the census (titles, issues, copies and info pages) as static files. '
+            'After the first build, only pages whose records have changed are written again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-dir', default=STATIC_SITE_DIR, help='Directory to write the site to.')
+        parser.add_argument('--workers', type=int, default=STATIC_SITE_WORKERS,
+                            help='Number of processes rendering pages (default: one per CPU).')
+        parser.add_argument('--full', action='store_true', help='Write every page again, changed or not.')
+
+    def handle(self, *args, **options):
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+
+        def progress(written, failed):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Wrote {len(written)} pages.')
+            for url, status in failed.items():
+                self.stderr.write(f'Skipped {url} (status {status}).')
+
+        started = time.perf_counter()
+        totals = build_site(options['output_dir'], workers=options['workers'], full=options['full'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {totals['written']} of {totals['pages']} pages ({totals['unchanged']} unchanged, "
+            f"{totals['removed']} removed, {len(totals['failed'])} skipped) "
+            f"to {options['output_dir']} in {time.perf_counter() - started:.1f} seconds."
+        ))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from censusapp.bulk_import import IMPORT_BATCH_SIZE, IMPORTERS, bulk_import
+
+
+class Command(BaseCommand):
+    help = 'Imports census records from a CSV or XLSX file in batches, reporting any rows that could not be imported.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=list(IMPORTERS), help='The kind of record in the file.')
+        parser.add_argument('path', help='The CSV or XLSX file to import.')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+        parser.add_argument('--dry-run', action='store_true', help='Check and time the import, then roll it back.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        try:
+            file = open(options['path'], 'rb')
+        except OSError as e:
+            raise CommandError(e)
+        with file:
+            report = bulk_import(
+                options['kind'], file, options['path'], batch_size=options['batch_size'],
+                dry_run=options['dry_run'], using=options['database'],
+            )
+        for row_number, message in report.errors:
+            self.stderr.write(f'Row {row_number}: {message}')
+        if report.error_count > len(report.errors):
+            self.stderr.write(f'... and {report.error_count - len(report.errors)} more errors.')
+        style = self.style.WARNING if report.error_count else self.style.SUCCESS
+        self.stdout.write(style(report.summary()))
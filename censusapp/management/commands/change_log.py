@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from censusapp.changes import (
+    CHANGE_FEED_LIMIT, CHANGE_LOG_COMPACT_AFTER_DAYS, CHANGE_LOG_RETENTION_DAYS, changes_since, prune_change_log,
+)
+import json
+
+
+class Command(BaseCommand):
+    help = ('Shows the changes made to census records since a sequence number, or prunes the change log '
+            'by deleting expired entries and compacting older ones.')
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest='action', required=True)
+        show = subcommands.add_parser('show', help='Print the changes after --since, one JSON object per line.')
+        show.add_argument('--since', type=int, default=0)
+        show.add_argument('--limit', type=int, default=CHANGE_FEED_LIMIT)
+        prune = subcommands.add_parser('prune', help='Delete expired entries and compact older ones.')
+        prune.add_argument('--retention-days', type=int, default=CHANGE_LOG_RETENTION_DAYS)
+        prune.add_argument('--compact-after-days', type=int, default=CHANGE_LOG_COMPACT_AFTER_DAYS)
+        prune.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        if options['action'] == 'show':
+            self.show(options['since'], options['limit'])
+        else:
+            self.prune(options['database'], options['retention_days'], options['compact_after_days'])
+
+    def show(self, since, limit):
+        feed = changes_since(since, max(1, limit))
+        if feed['reset']:
+            self.stderr.write(self.style.WARNING(
+                f"Changes after {since} have expired; copy the census again and continue from {feed['next_since']}."
+            ))
+        for change in feed['changes']:
+            self.stdout.write(json.dumps(change))
+        more = ' (more to come)' if feed['has_more'] else ''
+        self.stderr.write(f"Next: --since {feed['next_since']}{more}")
+
+    def prune(self, using, retention_days, compact_after_days):
+        expired, compacted = prune_change_log(using, retention_days, compact_after_days)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {expired} expired and {compacted} superseded change log entries.'))
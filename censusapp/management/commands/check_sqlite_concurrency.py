@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from censusapp.database import check_sqlite_concurrency, sqlite_pragmas
+import statistics
+
+
+BLOCKED_READ = 0.005
+# A read this slow (in seconds) has almost certainly waited for a lock, since the query itself takes well under 1 ms.
+# Occasional slow reads are expected from thread switching, so the check looks at the 99th percentile.
+
+
+class Command(BaseCommand):
+    help = ('Checks that visitors can keep reading while the database is written to, by running reader threads '
+            'against a busy writer on a temporary copy of the SQLite database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--journal-mode', help='Override the configured journal mode, e.g. "delete" to compare.')
+
+    def handle(self, *args, **options):
+        if connections[options['database']].vendor != 'sqlite':
+            raise CommandError('This check only applies to SQLite databases.')
+        pragmas = dict(sqlite_pragmas())
+        if options['journal_mode']:
+            pragmas['journal_mode'] = options['journal_mode']
+        results = check_sqlite_concurrency(options['database'], pragmas, options['seconds'], options['readers'])
+        self.report(pragmas, **results)
+
+    def report(self, pragmas, latencies, errors, commits, seconds):
+        self.stdout.write(f"Journal mode: {pragmas.get('journal_mode', 'default')}")
+        self.stdout.write(f'Writer: {commits} commits in {seconds:g} seconds')
+        ordered = sorted(latencies)
+        slow = ordered[int(len(ordered) * 0.99) - 1] if ordered else 0
+        if ordered:
+            self.stdout.write(
+                f'Readers: {len(ordered)} queries, '
+                f'median {statistics.median(ordered) * 1000:.2f} ms, '
+                f'99th percentile {slow * 1000:.2f} ms, '
+                f'slowest {ordered[-1] * 1000:.2f} ms'
+            )
+        if errors:
+            self.stdout.write(self.style.ERROR(f'{len(errors)} queries failed, e.g. {errors[0]}'))
+        elif ordered and slow < BLOCKED_READ:
+            self.stdout.write(self.style.SUCCESS('Readers were not held up by the writer.'))
+        else:
+            self.stdout.write(self.style.WARNING('Readers were held up while the writer committed.'))
+# The same check runs in the test suite (censusapp.tests.SQLiteConcurrencyTests), which fails if any query does.
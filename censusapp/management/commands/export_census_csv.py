@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from pathlib import Path
+from censusapp.exports import EXPORTS, write_csv
+
+
+class Command(BaseCommand):
+    help = 'Writes the census CSV exports (the same reports as the export/ pages) to a directory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('reports', nargs='*', help=f"Reports to write (default: all): {', '.join(EXPORTS)}.")
+        parser.add_argument('--output-dir', default='.', help='Directory to write the CSV files to.')
+
+    def handle(self, *args, **options):
+        unknown = set(options['reports']) - set(EXPORTS)
+        if unknown:
+            raise CommandError(f"Unknown report(s): {', '.join(sorted(unknown))}")
+        output_dir = Path(options['output_dir'])
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for name in options['reports'] or EXPORTS:
+            path = output_dir / f'{name}.csv'
+            with open(path, 'w', newline='', encoding='utf-8') as file:
+                write_csv(EXPORTS[name](), file)
+            self.stdout.write(f'Wrote {path}')
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from censusapp.synthetic import census_is_empty, clear_census, generate_census
+import time
+
+
+class Command(BaseCommand):
+    help = ('Fills the database with a made-up census of a given size, for benchmarking. '
+            'The same --seed always gives the same census.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--titles', type=int, default=40)
+        parser.add_argument('--copies', type=int, default=20000)
+        parser.add_argument('--locations', type=int, default=400)
+        parser.add_argument('--provenance-names', type=int, default=3000)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--replace', action='store_true',
+                            help='Delete every existing census record first. Never use this on the real census.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if min(options['titles'], options['locations'], options['copies']) < 1:
+            raise CommandError('--titles, --locations and --copies must each be at least 1.')
+        if not census_is_empty(using):
+            if not options['replace']:
+                raise CommandError('The database already has census records. Use --replace to delete them first.')
+            clear_census(using)
+
+        started = time.perf_counter()
+        totals = generate_census(
+            titles=options['titles'], copies=options['copies'], locations=options['locations'],
+            provenance_names=options['provenance_names'], seed=options['seed'], using=using,
+        )
+        summary = ', '.join(f'{count} {name}' for name, count in totals.items())
+        self.stdout.write(self.style.SUCCESS(f'Generated {summary} in {time.perf_counter() - started:.1f} seconds.'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from censusapp.database import publish_snapshot, snapshot_enabled
+
+
+class Command(BaseCommand):
+    help = 'Publishes a read-only snapshot of the database for public pages and searches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        if not snapshot_enabled():
+            raise CommandError('No snapshot database is configured in DATABASES.')
+        path = publish_snapshot(using=options['database'])
+        size = path.stat().st_size / (1024 * 1024)
+        self.stdout.write(self.style.SUCCESS(f'Published {path} ({size:.1f} MB).'))
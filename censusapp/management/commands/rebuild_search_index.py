@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from censusapp.jobs import enqueue
+from censusapp.search_index import get_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text index used by Keyword Search.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--background', action='store_true',
+                            help='Queue the rebuild for the census job workers instead of running it here.')
+
+    def handle(self, *args, **options):
+        if options['background']:
+            job = enqueue('search_index')
+            self.stdout.write(self.style.SUCCESS(f'Queued the rebuild as job {job.pk}.'))
+            return
+        total = get_search_index().rebuild(using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} copies.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from censusapp.models import Copy
+from censusapp.utils import refresh_copy_features
+
+
+class Command(BaseCommand):
+    help = 'Recalculates the stored Specific Features of every copy.'
+
+    def handle(self, *args, **options):
+        updated = refresh_copy_features(Copy.objects.values_list('pk', flat=True))
+        self.stdout.write(self.style.SUCCESS(f'Updated the features of {updated} copies.'))
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+from censusapp.benchmarks import (
+    BENCHMARK_MIN_DIFFERENCE_MS, BENCHMARK_TOLERANCE,
+    benchmark_cases, census_size, compare, load_baseline, run_benchmarks, save_baseline,
+)
+
+
+class Command(BaseCommand):
+    help = ('Times every hot path of the public site (each search field and ordering, the title, issue and copy pages, '
+            'autofill, info pages and CSV exports), and compares the results against a saved baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--warmup', type=int, default=1)
+        parser.add_argument('--cached', action='store_true',
+                            help='Time pages as served from the page cache, instead of building them every time.')
+        parser.add_argument('--only', help='Only run the cases whose names contain this text, e.g. "search".')
+        parser.add_argument('--baseline', help='Compare the results with this baseline file, and fail on regressions.')
+        parser.add_argument('--save-baseline', help='Save the results to this file, for comparing later runs with.')
+        parser.add_argument('--tolerance', type=float, default=BENCHMARK_TOLERANCE)
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1.')
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = load_baseline(options['baseline'])
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read the baseline {options['baseline']}: {e}")
+
+        cases = benchmark_cases()
+        if options['only']:
+            cases = {name: url for name, url in cases.items() if options['only'] in name}
+        if not cases:
+            raise CommandError('There are no benchmark cases to run.')
+
+        size = census_size()
+        self.stdout.write(f"Census: {size['titles']} titles, {size['issues']} issues, {size['copies']} copies")
+        self.stdout.write(f"{'case':<44} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'queries':>8}")
+        results = run_benchmarks(
+            cases, repeat=options['repeat'], warmup=options['warmup'], cached=options['cached'], progress=self.progress,
+        )
+
+        if options['save_baseline']:
+            save_baseline(options['save_baseline'], results, cached=options['cached'])
+            self.stdout.write(f"Saved the baseline to {options['save_baseline']}.")
+        failed = [name for name, result in results.items() if result['status'] >= 400]
+        if failed:
+            self.stdout.write(self.style.WARNING(f"{len(failed)} cases did not return a page: {', '.join(failed)}"))
+        if baseline is not None:
+            self.check_baseline(results, baseline, options['tolerance'], options['cached'])
+
+    def progress(self, name, result):
+        line = f"{name:<44} {result['p50']:>9.1f} {result['p95']:>9.1f} {result['max']:>9.1f} {result['queries']:>8}"
+        self.stdout.write(line if result['status'] < 400 else self.style.WARNING(f"{line}  ({result['status']})"))
+
+    def check_baseline(self, results, baseline, tolerance, cached):
+        if baseline.get('census') != census_size():
+            self.stdout.write(self.style.WARNING(f"The baseline was measured on a different census: {baseline.get('census')}"))
+        if baseline.get('cached', False) != cached:
+            self.stdout.write(self.style.WARNING('The baseline was measured with a different --cached setting.'))
+        regressions = compare(results, baseline, tolerance=tolerance, min_difference=BENCHMARK_MIN_DIFFERENCE_MS)
+        if regressions:
+            for name, reasons in regressions.items():
+                self.stdout.write(self.style.ERROR(f"{name}: {'; '.join(reasons)}"))
+            raise CommandError(f"{len(regressions)} cases regressed since the baseline from {baseline.get('created')}.")
+        self.stdout.write(self.style.SUCCESS(f"No regressions since the baseline from {baseline.get('created')}."))
+# Baselines should be saved and compared on the same machine, with the same synthetic census (generate_synthetic_census
+# with the same size and seed), since timings from different machines can't be compared.
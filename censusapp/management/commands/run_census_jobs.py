@@ -0,0 +1,92 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+import django
+import multiprocessing
+import signal
+from censusapp.jobs import (
+    JOB_KINDS, JOB_POLL_INTERVAL, JOB_WORKERS, enqueue, run_job, run_queued_jobs, worker_name,
+)
+from censusapp.models import JobStatusChoices as Status
+
+
+def _work(workers, poll_interval, stop):
+    django.setup()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    run_queued_jobs(workers, worker_name(), stop, poll_interval)
+# Each worker process finishes the job it is running before it stops. Ctrl+C is left to the parent process.
+
+
+class Command(BaseCommand):
+    help = ('Runs census jobs (CSV exports, a dump of the whole census, a recount of the statistics, a rebuild of '
+            'the keyword index, a bulk import or a new snapshot) across several processes. Without any jobs named, '
+            'runs the queued ones; with --forever, keeps waiting for more.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('kinds', nargs='*', help=f"Jobs to run now: {', '.join(JOB_KINDS)}.")
+        parser.add_argument('--workers', type=int, default=JOB_WORKERS,
+                            help='Number of processes working on each job (default: one per CPU).')
+        parser.add_argument('--forever', action='store_true',
+                            help='Keep running queued jobs as they arrive, until stopped with Ctrl+C or SIGTERM.')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='With --forever, the number of jobs to run at once, each in its own process.')
+        parser.add_argument('--poll-interval', type=float, default=JOB_POLL_INTERVAL,
+                            help='With --forever, seconds to wait before looking for new jobs when the queue is empty.')
+
+    def handle(self, *args, **options):
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+        if options['processes'] < 1:
+            raise CommandError('--processes must be at least 1.')
+        if options['forever']:
+            if options['kinds']:
+                raise CommandError('Queue jobs at /jobs/ (or run them without --forever) rather than naming them here.')
+            return self.work_forever(options)
+
+        finished = []
+        for kind in options['kinds']:
+            try:
+                job = enqueue(kind)
+            except ValueError as e:
+                raise CommandError(e)
+            finished.append(run_job(job, options['workers']))
+        if not options['kinds']:
+            finished = run_queued_jobs(options['workers'])
+
+        failed = 0
+        for job in finished:
+            if job is None:
+                continue
+            if job.status == Status.DONE:
+                seconds = (job.finished_at - job.started_at).total_seconds()
+                saved = f', wrote {job.artifact}' if job.artifact else ''
+                self.stdout.write(self.style.SUCCESS(f'Job {job.pk} ({job.kind}) done in {seconds:.1f} seconds{saved}.'))
+                continue
+            failed += 1
+            retry = f' It will be tried again after {job.run_after:%Y-%m-%d %H:%M:%S}.' if job.status == Status.QUEUED else ''
+            self.stderr.write(f'Job {job.pk} ({job.kind}) failed (attempt {job.attempts} of {job.max_attempts}):\n'
+                              f'{job.error}{retry}')
+        if failed:
+            raise CommandError(f'{failed} job(s) failed.')
+
+    def work_forever(self, options):
+        stop = multiprocessing.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stop.set())
+        self.stdout.write(f"Running census jobs in {options['processes']} process(es). Press Ctrl+C to stop.")
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=_work, args=(options['workers'], options['poll_interval'], stop))
+            for _ in range(options['processes'])
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping once the running jobs have finished...')
+            stop.set()
+            for process in processes:
+                process.join()
+# Each process takes the next job from the queue as soon as it is free. Several commands can run at once, even on
+# different machines if they share the database.
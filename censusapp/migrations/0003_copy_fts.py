@@ -0,0 +1,46 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+
+FTS_SQL = """
+CREATE VIRTUAL TABLE censusapp_copy_fts USING fts5(
+    binding, sammelband_notes, marginalia, local_notes, provenance_notes, bibliography, provenance_names,
+    tokenize='trigram'
+)
+"""
+
+POPULATE_SQL = """
+INSERT INTO censusapp_copy_fts (
+    rowid, binding, sammelband_notes, marginalia, local_notes, provenance_notes, bibliography, provenance_names
+)
+SELECT c.id, c.binding, c.sammelband_notes, c.marginalia, c.local_notes, c.provenance_notes, c.bibliography,
+    (SELECT group_concat(p.name, char(10)) FROM censusapp_provenanceownership o
+     JOIN censusapp_provenancename p ON p.id = o.owner_id WHERE o.copy_id = c.id)
+FROM censusapp_copy c
+"""
+
+
+def create_copy_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(FTS_SQL)
+    except OperationalError:
+        return  # SQLite builds without FTS5 or the trigram tokenizer fall back to plain icontains searches
+    schema_editor.execute(POPULATE_SQL)
+
+
+def drop_copy_fts(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS censusapp_copy_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('censusapp', '0002_alter_issue_options_issue_issue_number_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_copy_fts, drop_copy_fts),
+    ]
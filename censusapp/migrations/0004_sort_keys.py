@@ -0,0 +1,93 @@
+# Generated by Django 4.2.22 on 2026-10-18 04:02
+
+from django.db import migrations, models
+import re
+
+
+# The sort keys as they were worked out when this migration was written. They are copied here, rather than imported
+# from censusapp.utils, so that later changes to those functions never change what this migration does.
+
+def strip_article(s):
+    if not s:
+        return ''
+    lower_s = s.lower()
+    for article in ['a', 'an', 'the']:
+        prefix = article + ' '
+        if lower_s.startswith(prefix):
+            return s[len(prefix):]
+    return s
+
+def title_sort_key(title_object):
+    title = title_object.title
+    if title and title[0].isdigit():
+        title = title.split()
+        return strip_article(' '.join(title[1:] + [title[0]]))
+    return strip_article(title)
+
+def location_sort_key(location):
+    return strip_article(location.name)
+
+def census_id_sort_pair(census_id):
+    match = re.fullmatch(r"([0-9]{1,19})(?:\.([0-9]{1,19}))?", (census_id or "").strip())
+    if not match:
+        return (None, None)
+    pair = (int(match.group(1)), int(match.group(2) or 0))
+    if max(pair) > 2 ** 63 - 1:
+        return (None, None)
+    return pair
+
+
+def backfill_sort_keys(apps, schema_editor):
+    Title = apps.get_model('censusapp', 'Title')
+    Location = apps.get_model('censusapp', 'Location')
+    Copy = apps.get_model('censusapp', 'Copy')
+
+    titles = list(Title.objects.all())
+    for title in titles:
+        title.sort_title = title_sort_key(title)
+    Title.objects.bulk_update(titles, ['sort_title'], batch_size=500)
+
+    locations = list(Location.objects.all())
+    for location in locations:
+        location.sort_name = location_sort_key(location)
+    Location.objects.bulk_update(locations, ['sort_name'], batch_size=500)
+
+    copies = list(Copy.objects.only('census_id'))
+    for copy in copies:
+        copy.census_id_a, copy.census_id_b = census_id_sort_pair(copy.census_id)
+    Copy.objects.bulk_update(copies, ['census_id_a', 'census_id_b'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('censusapp', '0003_copy_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='copy',
+            name='census_id_a',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='copy',
+            name='census_id_b',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='sort_name',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=500),
+        ),
+        migrations.AddField(
+            model_name='title',
+            name='sort_title',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=128),
+        ),
+        migrations.AddIndex(
+            model_name='copy',
+            index=models.Index(fields=['census_id_a', 'census_id_b'], name='copy_census_id_sort_idx'),
+        ),
+        migrations.RunPython(backfill_sort_keys, migrations.RunPython.noop),
+    ]
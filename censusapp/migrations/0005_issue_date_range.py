@@ -0,0 +1,63 @@
+# Generated by Django 4.2.22 on 2026-10-18 04:12
+
+from django.db import migrations, models
+import re
+
+
+# A copy of censusapp.utils.convert_year_range as it was when this migration was written, so that later changes
+# to it never change what this migration does.
+
+def convert_year_range(year):
+    text = re.sub(r'[\[\]?]', '', str(year or '')).strip().lower()
+    text = re.sub(r'^(c\.|ca\.|circa)\s*', '', text)
+
+    match = re.fullmatch(r'(before|after)\s+(\d{4})', text)
+    if match:
+        bound = int(match.group(2))
+        return (None, bound - 1) if match.group(1) == 'before' else (bound + 1, None)
+
+    match = re.fullmatch(r'(\d{4})(?:\s*[-\u2013/]\s*(\d{1,2}|\d{4}))?', text)
+    if not match:
+        return False
+    start, end = match.group(1), match.group(2) or match.group(1)
+    end = start[:4 - len(end)] + end
+    if int(end) < int(start):
+        return False
+    return int(start), int(end)
+
+
+def backfill_issue_dates(apps, schema_editor):
+    Issue = apps.get_model('censusapp', 'Issue')
+
+    issues = []
+    for issue in Issue.objects.only('year', 'start_date', 'end_date'):
+        year_range = convert_year_range(issue.year)
+        if year_range and None not in year_range and year_range != (issue.start_date, issue.end_date):
+            issue.start_date, issue.end_date = year_range
+            issues.append(issue)
+    Issue.objects.bulk_update(issues, ['start_date', 'end_date'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('censusapp', '0004_sort_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='issue',
+            name='end_date',
+            field=models.IntegerField(blank=True, default=0, help_text='Filled in from the year when it can be read; otherwise set by hand.'),
+        ),
+        migrations.AlterField(
+            model_name='issue',
+            name='start_date',
+            field=models.IntegerField(blank=True, default=0, help_text='Filled in from the year when it can be read; otherwise set by hand.'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['start_date', 'end_date'], name='issue_date_range_idx'),
+        ),
+        migrations.RunPython(backfill_issue_dates, migrations.RunPython.noop),
+    ]
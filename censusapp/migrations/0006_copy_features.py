@@ -0,0 +1,62 @@
+# Generated by Django 4.2.22 on 2026-10-18 04:15
+
+from django.db import migrations, models
+
+
+# A copy of censusapp.utils.copy_features (and the feature bits) as they were when this migration was written,
+# so that later changes to them never change what this migration does.
+
+FEATURE_BITS = {
+    'earlyprovenance': 1, 'womanowner': 2, 'earlywomanowner': 4, 'marginalia': 8, 'earlysammelband': 16,
+    'unverified': 32, 'ghost': 64,
+}
+
+def copy_features(copy, owners):
+    features = set()
+    for start_century, gender in owners:
+        if start_century == '17':
+            features.add('earlyprovenance')
+        if gender == 'F':
+            features.add('womanowner')
+            if start_century in ('17', '18'):
+                features.add('earlywomanowner')
+    if copy.marginalia:
+        features.add('marginalia')
+    if copy.in_early_sammelband:
+        features.add('earlysammelband')
+    if copy.verification == 'U':
+        features.add('unverified')
+    elif copy.verification == 'F':
+        features.add('ghost')
+    return sum(FEATURE_BITS[name] for name in features)
+
+
+def backfill_copy_features(apps, schema_editor):
+    Copy = apps.get_model('censusapp', 'Copy')
+    ProvenanceOwnership = apps.get_model('censusapp', 'ProvenanceOwnership')
+
+    owners = {}
+    for copy_id, start_century, gender in ProvenanceOwnership.objects.values_list(
+            'copy_id', 'owner__start_century', 'owner__gender'):
+        owners.setdefault(copy_id, []).append((start_century, gender))
+
+    copies = list(Copy.objects.only('marginalia', 'in_early_sammelband', 'verification'))
+    for copy in copies:
+        copy.features = copy_features(copy, owners.get(copy.pk, []))
+    Copy.objects.bulk_update(copies, ['features'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('censusapp', '0005_issue_date_range'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='copy',
+            name='features',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_copy_features, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.22 on 2026-10-18 04:34
+
+from django.db import migrations, models
+import re
+
+
+# Copies of the census ID sort keys as they were when this migration was written, so that later changes to
+# censusapp.utils never change what this migration does.
+
+def census_id_sort_pair(census_id):
+    match = re.fullmatch(r"([0-9]{1,19})(?:\.([0-9]{1,19}))?", (census_id or "").strip())
+    if not match:
+        return (None, None)
+    pair = (int(match.group(1)), int(match.group(2) or 0))
+    if max(pair) > 2 ** 63 - 1:
+        return (None, None)
+    return pair
+
+def census_id_sort_group(census_id):
+    if census_id_sort_pair(census_id) != (None, None):
+        return 0
+    return 1 if census_id else 2
+
+
+def backfill_census_id_groups(apps, schema_editor):
+    Copy = apps.get_model('censusapp', 'Copy')
+    copies = list(Copy.objects.only('census_id'))
+    for copy in copies:
+        copy.census_id_group = census_id_sort_group(copy.census_id)
+    Copy.objects.bulk_update(copies, ['census_id_group'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('censusapp', '0006_copy_features'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='copy',
+            name='census_id_group',
+            field=models.PositiveSmallIntegerField(default=2, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='copy',
+            index=models.Index(fields=['issue', 'census_id_group', 'census_id_a', 'census_id_b', 'census_id'], name='copy_admin_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='edition',
+            index=models.Index(fields=['title', 'edition_number'], name='edition_title_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['edition', 'estc'], name='issue_edition_estc_idx'),
+        ),
+        migrations.RunPython(backfill_census_id_groups, migrations.RunPython.noop),
+    ]
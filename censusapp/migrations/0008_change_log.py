@@ -0,0 +1,29 @@
+# Generated by Django 4.2.22 on 2026-10-18 04:50
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('censusapp', '0007_admin_order_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(max_length=32)),
+                ('object_id', models.BigIntegerField()),
+                ('operation', models.CharField(choices=[('C', 'Created'), ('U', 'Updated'), ('D', 'Deleted'), ('T', 'Truncated')], max_length=1)),
+                ('changed_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Change Log Entry',
+                'verbose_name_plural': 'Change Log',
+                'indexes': [models.Index(fields=['resource', 'object_id'], name='changelog_object_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.22 on 2026-10-18 05:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('censusapp', '0008_change_log'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CensusJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('Q', 'Queued'), ('R', 'Running'), ('D', 'Done'), ('F', 'Failed')], default='Q', max_length=1)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('census_version', models.BigIntegerField(blank=True, null=True)),
+                ('artifact', models.CharField(blank=True, max_length=255)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name': 'Census Job',
+                'verbose_name_plural': 'Census Jobs',
+                'indexes': [models.Index(fields=['status', 'kind'], name='censusjob_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.22 on 2026-10-18 05:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('censusapp', '0009_census_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='censusjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='censusjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='censusjob',
+            name='max_attempts',
+            field=models.PositiveSmallIntegerField(default=3),
+        ),
+        migrations.AddField(
+            model_name='censusjob',
+            name='params',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='censusjob',
+            name='priority',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='censusjob',
+            name='progress_done',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='censusjob',
+            name='progress_total',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='censusjob',
+            name='run_after',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='censusjob',
+            name='worker',
+            field=models.CharField(blank=True, max_length=128),
+        ),
+        migrations.AddIndex(
+            model_name='censusjob',
+            index=models.Index(fields=['status', '-priority', 'run_after'], name='censusjob_queue_idx'),
+        ),
+    ]
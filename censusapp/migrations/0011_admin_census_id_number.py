@@ -0,0 +1,44 @@
+# Generated by Django 4.2.22 on 2026-10-18 05:31
+
+from django.db import migrations, models
+import re
+
+
+# A copy of censusapp.utils.census_id_sort_number as it was when this migration was written, so that later changes
+# to it never change what this migration does.
+
+def census_id_sort_number(census_id):
+    match = re.match(r"\d+(?:\.\d*)?(?:[eE][+-]?\d+)?", census_id or "")
+    return float(match.group()) if match else None
+
+
+def backfill_census_id_numbers(apps, schema_editor):
+    Copy = apps.get_model('censusapp', 'Copy')
+    copies = list(Copy.objects.only('census_id'))
+    for copy in copies:
+        copy.census_id_number = census_id_sort_number(copy.census_id)
+    Copy.objects.bulk_update(copies, ['census_id_number'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('censusapp', '0010_census_job_queue'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='copy',
+            name='copy_admin_order_idx',
+        ),
+        migrations.AddField(
+            model_name='copy',
+            name='census_id_number',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_census_id_numbers, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='copy',
+            index=models.Index(fields=['issue', 'census_id_number', 'census_id'], name='copy_admin_order_idx'),
+        ),
+    ]
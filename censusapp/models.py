@@ -1,6 +1,10 @@
 from django.db import models
 from django.conf import settings
-from .utils import split_record, format_issue_label
+from django.utils import timezone
+from .utils import (
+    split_record, format_issue_label, title_sort_key, location_sort_key, census_id_sort_pair, census_id_sort_group,
+    census_id_sort_number, convert_year_range, updated_copy_features,
+)
 
 
 # --- TextChoices (employed by other models) --- 
@@ -22,6 +26,18 @@ class VerificationChoices(models.TextChoices):
     UNVERIFIED = 'U', 'Unverified'
     FALSE = 'F', 'False'
 
+class ChangeOperationChoices(models.TextChoices):
+    CREATE = 'C', 'Created'
+    UPDATE = 'U', 'Updated'
+    DELETE = 'D', 'Deleted'
+    TRUNCATE = 'T', 'Truncated'
+
+class JobStatusChoices(models.TextChoices):
+    QUEUED = 'Q', 'Queued'
+    RUNNING = 'R', 'Running'
+    DONE = 'D', 'Done'
+    FAILED = 'F', 'Failed'
+
 
 # --- Six core data tables ---
 
@@ -31,10 +47,15 @@ class Location(models.Model):
     state = models.CharField('State/Province/County', max_length=128, blank=True, null=True)
     country = models.CharField(max_length=128, blank=True, null=True)
     continent = models.CharField(max_length=128, blank=True, null=True)    
+    sort_name = models.CharField(max_length=500, blank=True, default='', editable=False, db_index=True)
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.sort_name = location_sort_key(self)
+        super().save(*args, **kwargs)
+
 class ProvenanceName(models.Model):
     name = models.CharField(max_length=256, blank=False)
     bio = models.CharField(max_length=1024, blank=True, null=True)
@@ -55,10 +76,15 @@ class Title(models.Model):
     apocryphal = models.BooleanField(default=False)
     notes = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to='titleicon/', blank=True, null=True)
+    sort_title = models.CharField(max_length=128, blank=True, default='', editable=False, db_index=True)
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        self.sort_title = title_sort_key(self)
+        super().save(*args, **kwargs)
+
 class Edition(models.Model):
     title = models.ForeignKey(Title, on_delete=models.CASCADE, related_name='editions')
     edition_number = models.PositiveIntegerField(unique=False, blank=False, db_index=True)
@@ -68,6 +94,11 @@ class Edition(models.Model):
     def __str__(self):
         return f"{self.title} (Edition {self.edition_number})"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['title', 'edition_number'], name='edition_title_number_idx'),
+        ]
+
 class Issue(models.Model):
     edition = models.ForeignKey(Edition, unique=False, on_delete=models.CASCADE, related_name='issues')
     issue_number = models.PositiveIntegerField(null=True, blank=True, db_index=True)
@@ -80,14 +111,27 @@ class Issue(models.Model):
             )
         ]
         ordering = ["edition__edition_number", "unknown_issue", "issue_number"]
+        indexes = [
+            models.Index(fields=['start_date', 'end_date'], name='issue_date_range_idx'),
+            models.Index(fields=['edition', 'estc'], name='issue_edition_estc_idx'),
+        ]
     stc_wing = models.CharField('STC / Wing', max_length=20, blank=True, null=True)
     estc = models.CharField('ESTC', max_length=20, blank=True, null=False)
     deep = models.CharField('DEEP', max_length=20, blank=True, null=True)
     year = models.CharField(max_length=20, blank=True, null=True)
-    start_date = models.IntegerField(blank=True, default=0)
-    end_date = models.IntegerField(blank=True, default=0)
+    start_date = models.IntegerField(blank=True, default=0,
+                                     help_text='Filled in from the year when it can be read; otherwise set by hand.')
+    end_date = models.IntegerField(blank=True, default=0,
+                                   help_text='Filled in from the year when it can be read; otherwise set by hand.')
     notes = models.TextField(blank=True, null=True)
 
+    def save(self, *args, **kwargs):
+        year_range = convert_year_range(self.year)
+        if year_range and None not in year_range:
+            self.start_date, self.end_date = year_range
+        super().save(*args, **kwargs)
+    # Issues whose year can't be read (such as "[unknown]") keep the dates entered by hand, which default to 0.
+
     def estc_as_list(self):
         return split_record(self.estc)
 
@@ -104,6 +148,15 @@ class Issue(models.Model):
             suffix = " — Issue x"
         return f"{self.edition.title} (Edition {self.edition.edition_number}){suffix}"
 
+class CopyQuerySet(models.QuerySet):
+
+    def for_list(self):
+        return self.select_related('issue__edition__title', 'location')
+
+    def for_detail(self):
+        return self.for_list().prefetch_related('provenance_names')
+# These projections load everything the copy tables and the copy modal display, in a fixed number of queries.
+
 class Copy(models.Model):
     issue = models.ForeignKey(Issue, unique=False, on_delete=models.CASCADE, related_name='copies')
     location = models.ForeignKey(Location, unique=False, on_delete=models.CASCADE)
@@ -131,13 +184,31 @@ class Copy(models.Model):
     created_by = models.CharField(max_length=500, blank=True, null=True)
     verified_by = models.CharField(max_length=500, blank=True, null=True)
     examined_by = models.CharField(max_length=500, blank=True, null=True)
+    census_id_a = models.IntegerField(blank=True, null=True, editable=False)
+    census_id_b = models.IntegerField(blank=True, null=True, editable=False)
+    census_id_group = models.PositiveSmallIntegerField(default=2, editable=False)
+    census_id_number = models.FloatField(blank=True, null=True, editable=False)
+    features = models.PositiveIntegerField(default=0, editable=False, db_index=True)
+
+    objects = CopyQuerySet.as_manager()
 
     def __str__(self):
         prefix = getattr(settings, "COPY_ID_PREFIX", "ID")
         return f"{self.issue} {self.location} {prefix}#{self.census_id or '—'}"
+
+    def save(self, *args, **kwargs):
+        self.census_id_a, self.census_id_b = census_id_sort_pair(self.census_id)
+        self.census_id_group = census_id_sort_group(self.census_id)
+        self.census_id_number = census_id_sort_number(self.census_id)
+        self.features = updated_copy_features(self)
+        super().save(*args, **kwargs)
     
     class Meta:
         verbose_name_plural = "Copies"
+        indexes = [
+            models.Index(fields=['census_id_a', 'census_id_b'], name='copy_census_id_sort_idx'),
+            models.Index(fields=['issue', 'census_id_number', 'census_id'], name='copy_admin_order_idx'),
+        ]
 
 
 # --- Relationship model linking Provenance Names to Copies ---
@@ -165,3 +236,67 @@ class StaticPageText(models.Model):
     class Meta:
         verbose_name_plural = "Static Pages"
         verbose_name = "Static Page"
+
+
+# --- Change log read by mirrors of the census ---
+
+class ChangeLogEntry(models.Model):
+    resource = models.CharField(max_length=32)
+    object_id = models.BigIntegerField()
+    operation = models.CharField(max_length=1, choices=ChangeOperationChoices.choices)
+    changed_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f'{self.pk}: {self.get_operation_display()} {self.resource} {self.object_id}'
+
+    class Meta:
+        verbose_name_plural = "Change Log"
+        verbose_name = "Change Log Entry"
+        indexes = [
+            models.Index(fields=['resource', 'object_id'], name='changelog_object_idx'),
+        ]
+# The id of each entry is its sequence number. SQLite never reuses the ids of deleted rows, and only one transaction
+# writes at a time, so entries become visible in the order of their ids.
+
+
+# --- Census-wide jobs run outside of web requests ---
+
+class CensusJob(models.Model):
+    kind = models.CharField(max_length=64)
+    status = models.CharField(max_length=1, choices=JobStatusChoices.choices, default=JobStatusChoices.QUEUED)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    census_version = models.BigIntegerField(blank=True, null=True)
+    artifact = models.CharField(max_length=255, blank=True)
+    result = models.JSONField(blank=True, null=True)
+    error = models.TextField(blank=True)
+    params = models.JSONField(default=dict, blank=True)
+    priority = models.SmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    worker = models.CharField(max_length=128, blank=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    progress_done = models.PositiveIntegerField(default=0)
+    progress_total = models.PositiveIntegerField(blank=True, null=True)
+
+    census_record = False
+
+    def __str__(self):
+        return f'{self.kind} #{self.pk} ({self.get_status_display()})'
+
+    class Meta:
+        verbose_name_plural = "Census Jobs"
+        verbose_name = "Census Job"
+        indexes = [
+            models.Index(fields=['status', 'kind'], name='censusjob_status_idx'),
+            models.Index(fields=['status', '-priority', 'run_after'], name='censusjob_queue_idx'),
+        ]
+# census_version is the last change log entry when the job read the census, so a finished export can be served
+# for as long as nothing has changed since. The artifact is the name of the file the job wrote, if any.
+# Workers take the queued job with the highest priority whose run_after has passed, and retry a failed job (after
+# a growing delay) until it has made max_attempts attempts. A running job updates heartbeat_at whenever it reports
+# progress; worker is the host and process running it.
+# Jobs aren't part of the census (census_record = False): they are always read from the primary database, and
+# saving one doesn't queue a new snapshot.
@@ -0,0 +1,153 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from functools import partial, wraps
+import hashlib
+import json
+import time
+from .database import snapshot_version
+
+
+# --- Settings ---
+
+PAGE_CACHE = getattr(settings, 'PAGE_CACHE', 'default')
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60 * 60 * 24)
+# Cached pages are only ever served to anonymous visitors; staff always see freshly built pages with their edit links.
+
+
+# --- Dependency tags ---
+
+SITE_TAG = 'site'
+
+def _tag_key(tag):
+    return f'census:pageversion:{tag}'
+
+def tag_versions(tags):
+    cache = caches[PAGE_CACHE]
+    keys = {_tag_key(tag): tag for tag in tags}
+    versions = {keys[key]: version for key, version in cache.get_many(keys).items()}
+    first_seen = snapshot_version() or time.time_ns()
+    missing = {_tag_key(tag): first_seen for tag in tags if tag not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update({keys[key]: version for key, version in missing.items()})
+    return versions
+# Each tag names something a page was built from, such as "issue:12". Its version is the time (in nanoseconds)
+# that thing last changed, or when the tag was first seen (or the snapshot being read was taken).
+
+def _expire_tags(tags):
+    now = time.time_ns()
+    caches[PAGE_CACHE].set_many({_tag_key(tag): now for tag in tags}, None)
+
+def invalidate_pages(*tags, using=DEFAULT_DB_ALIAS):
+    if tags:
+        transaction.on_commit(partial(_expire_tags, set(tags)), using=using)
+# This function expires every cached page that depends on any of the given tags, once the change that made them
+# out of date has been committed. Expiring them before would let a visitor's request, still reading the old data,
+# cache its page again under the new versions.
+
+def invalidate_all_pages(using=DEFAULT_DB_ALIAS):
+    invalidate_pages(SITE_TAG, using=using)
+# Every cached page also depends on SITE_TAG, so large changes (such as bulk imports) can expire them all at once.
+
+def depends_on(request, *tags):
+    versions = getattr(request, '_page_cache_versions', None)
+    if versions is not None:
+        versions.update(tag_versions(tags))
+# Views call this for dependencies that are only known while the page is being built.
+
+
+# --- Cached views ---
+
+_bypassed = ContextVar('census_page_cache_bypassed', default=False)
+
+@contextmanager
+def bypassing_page_cache():
+    token = _bypassed.set(True)
+    try:
+        yield
+    finally:
+        _bypassed.reset(token)
+# Pages built inside this block neither read nor fill the page cache, e.g. when the whole site is written out as static files.
+
+def _page_key(view_name, kwargs, daily):
+    raw = json.dumps([view_name, kwargs, date.today().isoformat() if daily else None], sort_keys=True)
+    return 'census:page:' + hashlib.md5(raw.encode()).hexdigest()
+
+def _cacheable(request):
+    return request.method in ('GET', 'HEAD') and not request.GET and not request.user.is_authenticated
+
+def _viewer(request):
+    return f'user:{request.user.pk}' if request.user.is_authenticated else 'anonymous'
+
+def _validators(key, viewer, versions):
+    raw = json.dumps([key, viewer, sorted(versions.items())])
+    etag = '"' + hashlib.md5(raw.encode()).hexdigest() + '"'
+    last_modified = max(versions.values(), default=0) // 10 ** 9 + 1
+    return etag, last_modified
+# The ETag changes whenever any tag the page depends on changes, and differs between visitors who see different pages.
+
+def _current(versions):
+    data_version = snapshot_version()
+    return data_version is None or max(versions.values(), default=0) <= data_version
+# A page read from a snapshot that was taken before one of its tags last changed is served, but not cached.
+# Edits are published in a new snapshot moments later, and the page is cached again once it is built from that.
+
+def _conditional(request, key, versions, response=None):
+    etag, last_modified = _validators(key, _viewer(request), versions)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
+    if response is not None:
+        response.headers.setdefault('ETag', etag)
+        response.headers.setdefault('Last-Modified', http_date(last_modified))
+        patch_vary_headers(response, ['Cookie'])
+        if request.user.is_authenticated:
+            patch_cache_control(response, private=True, no_cache=True)
+        else:
+            patch_cache_control(response, public=True, no_cache=True)
+    return response
+# This function returns a 304 Not Modified response if the browser's copy is still current. Given the rendered
+# response, it adds the validators to it instead. Browsers and proxies may keep these pages, but must check back first.
+
+def cached_page(*tags, daily=False):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, **kwargs):
+            if request.method not in ('GET', 'HEAD') or _bypassed.get():
+                return view(request, **kwargs)
+            cache = caches[PAGE_CACHE]
+            key = _page_key(view.__name__, kwargs, daily)
+            page_tags = [SITE_TAG, *[tag.format(**kwargs) for tag in tags]]
+
+            entry = cache.get(key)
+            if entry is not None and entry['versions'] == tag_versions(entry['versions']):
+                not_modified = _conditional(request, key, entry['versions'])
+                if not_modified is not None:
+                    return not_modified
+                if _cacheable(request):
+                    return _conditional(request, key, entry['versions'], entry['response'])
+
+            request._page_cache_versions = tag_versions(page_tags)
+            response = view(request, **kwargs)
+            if response.status_code != 200 or response.streaming:
+                return response
+            if not _current(request._page_cache_versions):
+                patch_vary_headers(response, ['Cookie'])
+                patch_cache_control(response, no_store=True)
+                return response
+            if _cacheable(request) and not response.cookies:
+                cache.set(key, {'versions': request._page_cache_versions, 'response': response}, PAGE_CACHE_TIMEOUT)
+            return _conditional(request, key, request._page_cache_versions, response)
+        return wrapper
+    return decorator
+# This decorator caches a public page by view and URL parameters, together with the versions of the tags it depends on.
+# A cached page is served only while all of those versions are unchanged. Tags may use the URL parameters, e.g. "issue:{id}".
+# Pages with daily=True are also rebuilt each day, for pages that show the current date.
+# Every page also gets an ETag and Last-Modified date from the same versions, so that a repeat request for an unchanged
+# page is answered with 304 Not Modified. When the versions are already known, this happens without running the view.
+# A page read from a snapshot taken before the last change to one of its tags gets neither, and may not be stored:
+# its versions already describe the newer data, so a browser revalidating it would be told that the old page is current.
@@ -0,0 +1,140 @@
+from django.db.models import F, Q
+import base64
+import binascii
+import json
+import math
+
+
+# --- Cursors ---
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+SQLITE_MIN_INT, SQLITE_MAX_INT = -2 ** 63, 2 ** 63 - 1
+
+def cursor_value_ok(value, types=(str, int, float)):
+    if isinstance(value, bool) or not isinstance(value, types):
+        return False
+    if isinstance(value, int):
+        return SQLITE_MIN_INT <= value <= SQLITE_MAX_INT
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return True
+
+def decode_cursor(cursor, length, types=(str, int, float)):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, binascii.Error):
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    if not all(cursor_value_ok(value, types) for value in values):
+        return None
+    return values
+# A cursor holds the sort key values (and primary key) of the row at the edge of a page.
+# Cursors that can't be read are ignored, which simply returns the first page. So are cursors holding anything but
+# strings and numbers that SQLite can store: the orderings coalesce nullable fields, so no sort key is ever null.
+# Callers that compare the values in Python can narrow "types" (e.g. to numbers only).
+
+def sort_key_values(queryset, names, cursor):
+    values = decode_cursor(cursor, len(names))
+    if values is None:
+        return None
+    annotations = queryset.query.annotations
+    try:
+        values = [annotations[name].output_field.get_prep_value(value) for name, value in zip(names, values)]
+    except (ValueError, TypeError):
+        return None
+    if not all(cursor_value_ok(value) for value in values):
+        return None
+    return values
+# This function reads a cursor for a queryset annotated with the sort keys "names", checking each value against the
+# type of its sort key, so that a string where a year belongs (or a number too large for an integer column) is
+# treated like any other unreadable cursor instead of failing when the query is built or run.
+
+
+# --- Keyset Pagination ---
+
+class InvalidCursor(ValueError):
+    pass
+# Raised by paginate_keyset(strict=True) when a cursor can't be used, with the name of the parameter it came in.
+
+class KeysetPage:
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, last_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.last_cursor = last_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+def keyset_filter(names, values, forward=True):
+    lookup = 'gt' if forward else 'lt'
+    condition = Q()
+    for i, name in enumerate(names):
+        step = Q(**{f'{name}__{lookup}': values[i]})
+        for earlier, value in zip(names[:i], values[:i]):
+            step &= Q(**{earlier: value})
+        condition |= step
+    return condition
+# This builds (k0 > v0) OR (k0 = v0 AND k1 > v1) OR ... so the database can seek straight to the page.
+
+def paginate_keyset(queryset, ordering, page_size, after=None, before=None, strict=False):
+    names = [f'_sort_{i}' for i in range(len(ordering))] + ['_sort_pk']
+    keys = {
+        name: F(term) if isinstance(term, str) else term
+        for name, term in zip(names, [*ordering, 'pk'])
+    }
+    queryset = queryset.annotate(**keys)
+
+    after_values = sort_key_values(queryset, names, after)
+    if strict and after and after_values is None:
+        raise InvalidCursor('after')
+    before_values = None if after_values else sort_key_values(queryset, names, before)
+    if strict and before and not after_values and before_values is None:
+        raise InvalidCursor('before')
+
+    if before_values:
+        queryset = queryset.filter(keyset_filter(names, before_values, forward=False))
+        rows = list(queryset.order_by(*[F(name).desc() for name in names])[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_previous, has_next = has_more, True
+    else:
+        if after_values:
+            queryset = queryset.filter(keyset_filter(names, after_values))
+        rows = list(queryset.order_by(*names)[:page_size + 1])
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        has_previous = after_values is not None
+
+    def cursor_for(row):
+        return encode_cursor([getattr(row, name) for name in names])
+
+    return KeysetPage(
+        rows,
+        next_cursor=cursor_for(rows[-1]) if rows and has_next else None,
+        previous_cursor=cursor_for(rows[0]) if rows and has_previous else None,
+        last_cursor=cursor_for(rows[-1]) if rows else None,
+    )
+# This function returns one page of the queryset, sorted by the given ordering with the primary key as a tiebreak.
+# Every page is a single indexed range scan, so a deep page costs the same as the first one.
+# last_cursor is set even on the last page, so a client can come back later for the rows added after it.
+# Unreadable cursors give the first page, unless strict is set.
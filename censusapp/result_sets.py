@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.core.cache import caches
+from array import array
+import base64
+import hashlib
+import json
+import zlib
+
+
+# --- Settings ---
+
+RESULT_SET_CACHE = getattr(settings, 'SEARCH_RESULT_SET_CACHE', 'default')
+RESULT_SET_TIMEOUT = getattr(settings, 'SEARCH_RESULT_SET_TIMEOUT', 60 * 60)
+QUERY_TIMEOUT = getattr(settings, 'SEARCH_QUERY_TIMEOUT', 60 * 60 * 24 * 7)
+MAX_DEPTH = 10
+# The queries behind a token are tiny, so they are kept much longer than the id arrays they produce.
+# If the ids have been evicted, they are rebuilt from the query the next time the token is used.
+
+
+# --- Compact id arrays ---
+
+def pack_ids(ids):
+    ids = sorted(ids)
+    deltas = array('q', [b - a for a, b in zip([0] + ids, ids)])
+    return zlib.compress(deltas.tobytes())
+
+def unpack_ids(data):
+    deltas = array('q')
+    deltas.frombytes(zlib.decompress(data))
+    ids, total = [], 0
+    for delta in deltas:
+        total += delta
+        ids.append(total)
+    return ids
+# Sorted ids are stored as compressed gaps, which typically takes one or two bytes per copy.
+
+
+# --- Result set tokens ---
+
+def result_set_token(field, value, within=None):
+    raw = json.dumps([within, field, value]).encode()
+    return base64.urlsafe_b64encode(hashlib.blake2b(raw, digest_size=9).digest()).decode()
+# The same search (within the same results) always gets the same 12-character token.
+
+def _query_key(token):
+    return f'census:resultset:{token}:query'
+
+def _ids_key(token):
+    return f'census:resultset:{token}:ids'
+
+def remember_result_set(field, value, within=None):
+    token = result_set_token(field, value, within)
+    caches[RESULT_SET_CACHE].set(_query_key(token), {'field': field, 'value': value, 'within': within}, QUERY_TIMEOUT)
+    return token
+# This records the query behind a set of search results and returns its token.
+
+def get_result_set_query(token):
+    if not token:
+        return None
+    return caches[RESULT_SET_CACHE].get(_query_key(token))
+
+def resolve_result_set(token, backend, results, depth=0):
+    query = get_result_set_query(token)
+    if query is None or depth > MAX_DEPTH:
+        return None
+    cache = caches[RESULT_SET_CACHE]
+
+    packed = cache.get(_ids_key(token))
+    if packed is not None:
+        return backend.restrict(results, unpack_ids(packed))
+
+    parent = results
+    if query['within']:
+        parent = resolve_result_set(query['within'], backend, results, depth + 1)
+        if parent is None:
+            return None
+    result_list, _, _ = backend.filter(parent, query['field'], query['value'])
+    ids = result_list.ids()
+    cache.set(_ids_key(token), pack_ids(ids), RESULT_SET_TIMEOUT)
+    return backend.restrict(results, ids)
+# This function narrows search results to the results behind a token. The id array is used if it is still
+# in the cache; otherwise the original search (and any searches it was refining) is run again to rebuild it.
@@ -0,0 +1,117 @@
+from django.db.models import Q
+from . import models
+from .search_index import get_search_index
+from .utils import (
+    MAX_CENTURY, century_label, collection_display, convert_year_range, facsimile_query, get_display_field,
+    get_collection, parse_number,
+)
+
+
+# --- Search filters ---
+
+def issues_in_years(start, end, within=False):
+    issues = models.Issue.objects.filter(start_date__gt=0)
+    if within:
+        return issues.filter(start_date__range=(start, end)).values('pk')
+    if start is not None:
+        issues = issues.filter(end_date__gte=start)
+    if end is not None:
+        issues = issues.filter(start_date__lte=end)
+    return issues.values('pk')
+# This function finds the issues whose dates overlap a range of years (or, with within=True, that begin inside it),
+# using the index on Issue dates. Issues with unknown dates (saved as 0) never match.
+# The copies of the matching issues are then found by issue.
+
+def location_names(field, value):
+    names = models.Location.objects.order_by().values_list(field, flat=True).distinct()
+    return [name for name in names if (name or '').strip() == value.strip()]
+# Facets list continents and countries without surrounding spaces, so a drill-down matches every spelling of
+# the name that the facet counted together.
+
+JOINED_FIELDS = {'keyword', 'provenance_name'}
+
+def search_display(field, value):
+    display_field = get_display_field(field)
+    display_value = value
+
+    if field == 'collection':
+        display_field = collection_display(value)
+        display_value = 'All'
+    elif field == 'century' and parse_number(value, MAX_CENTURY) is not None:
+        display_value = century_label(int(value))
+    elif field == 'title' and parse_number(value) is not None:
+        display_value = models.Title.objects.filter(pk=int(value)).values_list('title', flat=True).first() or value
+    elif field == 'verification' and value in models.VerificationChoices.values:
+        display_value = models.VerificationChoices(value).label
+    elif field == 'fragment' and value in ('yes', 'no'):
+        display_value = 'Fragments' if value == 'yes' else 'Complete copies'
+    elif field == 'facsimile' and value in ('yes', 'no'):
+        display_value = 'Available' if value == 'yes' else 'Not available'
+
+    return display_field, display_value
+# This function gives the field and value of a search as they should be displayed.
+
+def filter_copies(copies, field, value):
+    if field == 'keyword':
+        result_list = get_search_index().search(copies, value)
+
+    elif field == 'location' and value:
+        result_list = copies.filter(location__name__icontains=value)
+
+    elif field == 'geography' and value:
+        result_list = copies.filter(
+            Q(location__city__icontains=value) |
+            Q(location__state__icontains=value) |
+            Q(location__country__icontains=value) |
+            Q(location__continent__icontains=value)
+        )
+
+    elif field == 'provenance_name' and value:
+        result_list = copies.filter(provenance_names__name__icontains=value)
+
+    elif field == 'collection':
+        result_list = get_collection(copies, value)
+
+    elif field == 'year' and value:
+        year_range = convert_year_range(value)
+        if year_range:
+            result_list = copies.filter(issue__in=issues_in_years(*year_range))
+        else:
+            result_list = copies.filter(issue__year__icontains=value)
+
+    elif field == 'stc' and value:
+        result_list = copies.filter(issue__stc_wing__icontains=value)
+
+    elif field == 'census_id' and value:
+        result_list = copies.filter(census_id=value)
+
+    # --- Facet drill-downs ---
+
+    elif field == 'century' and parse_number(value, MAX_CENTURY) is not None:
+        start = (int(value) - 1) * 100
+        result_list = copies.filter(issue__in=issues_in_years(start, start + 99, within=True))
+
+    elif field in ('continent', 'country') and value and value.strip():
+        result_list = copies.filter(**{f'location__{field}__in': location_names(field, value)})
+
+    elif field == 'title' and parse_number(value) is not None:
+        result_list = copies.filter(issue__edition__title=int(value))
+
+    elif field == 'verification' and value in models.VerificationChoices.values:
+        result_list = copies.filter(verification=value)
+
+    elif field == 'fragment' and value in ('yes', 'no'):
+        result_list = copies.filter(fragment=(value == 'yes'))
+
+    elif field == 'facsimile' and value in ('yes', 'no'):
+        result_list = copies.filter(facsimile_query if value == 'yes' else ~facsimile_query)
+
+    else:
+        result_list = models.Copy.objects.none()
+
+    if field in JOINED_FIELDS:
+        result_list = result_list.distinct()
+    return (result_list, *search_display(field, value))
+# This function applies one search (a field and a value) to a queryset of copies.
+# It returns the matching copies along with the field and value as they should be displayed.
+# Only searches that join to a copy's provenance names can match a copy twice, so only they need DISTINCT.
@@ -0,0 +1,478 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+from array import array
+from collections import Counter
+import heapq
+import json
+import re
+import time
+from . import models
+from .facets import FACET_LIMIT, facet, search_facets
+from .pagination import KeysetPage, decode_cursor, encode_cursor, paginate_keyset
+from .search import filter_copies, search_display
+from .utils import (
+    FEATURE_BITS, FEATURE_DISPLAY_NAMES, KEYWORD_FIELDS, MAX_CENTURY, SEARCH_ORDERINGS, canonical_query, century_label,
+    collection_features, convert_year_range, parse_number,
+)
+
+
+# --- Search Results ---
+
+class SearchResults:
+
+    def count(self):
+        raise NotImplementedError
+
+    def page(self, order, page_size, after=None, before=None):
+        raise NotImplementedError
+
+    def ids(self):
+        raise NotImplementedError
+
+    def facets(self):
+        raise NotImplementedError
+# A search backend returns its results as one of these, so the search view can count, page and facet them
+# without knowing how the search was run.
+
+
+# --- Search Backends ---
+
+class SearchBackend:
+
+    def prepare(self):
+        pass
+
+    def all_copies(self):
+        raise NotImplementedError
+
+    def restrict(self, results, ids):
+        raise NotImplementedError
+
+    def filter(self, results, field, value):
+        raise NotImplementedError
+# all_copies() gives every copy in the census, restrict() narrows results to a list of copy ids (from a result-set
+# token), and filter() applies one search, returning the new results with the field and value to display.
+# prepare() is called once when a worker process starts, so a backend can load anything it needs up front.
+
+
+# --- Database backend ---
+
+class QuerySetResults(SearchResults):
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def count(self):
+        return self.queryset.count()
+
+    def page(self, order, page_size, after=None, before=None):
+        return paginate_keyset(self.queryset.for_list(), SEARCH_ORDERINGS[order], page_size, after=after, before=before)
+
+    def ids(self):
+        return list(self.queryset.order_by().values_list('pk', flat=True))
+
+    def facets(self):
+        return search_facets(self.queryset)
+
+class ORMSearchBackend(SearchBackend):
+
+    def all_copies(self):
+        return QuerySetResults(models.Copy.objects.filter(canonical_query))
+
+    def restrict(self, results, ids):
+        copies = results.queryset
+        if connections[copies.db].vendor == 'sqlite':
+            return QuerySetResults(copies.filter(pk__in=RawSQL('SELECT value FROM json_each(%s)', [json.dumps(ids)])))
+        return QuerySetResults(copies.filter(pk__in=ids))
+    # On SQLite the ids are passed as a single JSON parameter, so there is no limit on how many there can be.
+
+    def filter(self, results, field, value):
+        result_list, display_field, display_value = filter_copies(results.queryset, field, value)
+        return QuerySetResults(result_list), display_field, display_value
+# This backend runs every search as a database query.
+
+
+# --- In-memory backend ---
+
+WORD_PATTERN = re.compile(r'\w+')
+
+def fold(text):
+    return (text or '').casefold()
+
+def contains(value):
+    value = fold(value)
+    return lambda text: value in text
+
+class MemoryIndex:
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.load_tables(using)
+        self.load_copies(using)
+        self.load_ranks(using)
+
+    def load_tables(self, using):
+        self.locations = {
+            pk: (fold(name), [fold(city), fold(state), fold(country), fold(continent)], country, continent)
+            for pk, name, city, state, country, continent in models.Location.objects.using(using).values_list(
+                'pk', 'name', 'city', 'state', 'country', 'continent')
+        }
+        self.titles = {
+            pk: (title, sort_title)
+            for pk, title, sort_title in models.Title.objects.using(using).values_list('pk', 'title', 'sort_title')
+        }
+        self.issues = {
+            pk: (fold(year), fold(stc_wing), start_date, end_date, title_id)
+            for pk, year, stc_wing, start_date, end_date, title_id in models.Issue.objects.using(using).values_list(
+                'pk', 'year', 'stc_wing', 'start_date', 'end_date', 'edition__title_id')
+        }
+        self.owner_names = {
+            pk: fold(name) for pk, name in models.ProvenanceName.objects.using(using).values_list('pk', 'name')
+        }
+    # Locations, titles, issues and owners are small tables; searches scan them and then follow the postings below.
+
+    def load_copies(self, using):
+        owners = {}
+        for copy_id, owner_id in models.ProvenanceOwnership.objects.using(using).values_list('copy_id', 'owner_id'):
+            owners.setdefault(copy_id, []).append(owner_id)
+
+        self.pks = array('q')
+        self.issue = array('q')
+        self.location = array('q')
+        self.start_date = array('l')
+        self.title = array('q')
+        self.verification = bytearray()
+        self.fragment = bytearray()
+        self.facsimile = bytearray()
+        self.features = array('L')
+        self.census_ids = {}
+        self.texts = []
+        self.has_text = bytearray()
+        self.by_issue, self.by_location, self.by_owner, self.words = {}, {}, {}, {}
+
+        rows = models.Copy.objects.using(using).order_by('pk').values_list(
+            'pk', 'issue_id', 'location_id', 'census_id', 'verification', 'fragment', 'digital_facsimile_url',
+            'features', *KEYWORD_FIELDS)
+        for position, (pk, issue_id, location_id, census_id, verification, fragment, facsimile, features,
+                       *keyword_values) in enumerate(rows):
+            issue = self.issues.get(issue_id, ('', '', 0, 0, None))
+            self.pks.append(pk)
+            self.issue.append(issue_id)
+            self.location.append(location_id)
+            self.start_date.append(issue[2] or 0)
+            self.title.append(issue[4] or 0)
+            self.verification.append(ord(verification or ' '))
+            self.fragment.append(bool(fragment))
+            self.facsimile.append(bool(facsimile))
+            self.features.append(features)
+            self.census_ids.setdefault(census_id, []).append(position)
+            self.by_issue.setdefault(issue_id, []).append(position)
+            self.by_location.setdefault(location_id, []).append(position)
+
+            names = [self.owner_names.get(owner_id, '') for owner_id in owners.get(pk, [])]
+            for owner_id in owners.get(pk, []):
+                self.by_owner.setdefault(owner_id, []).append(position)
+            text = '\n'.join([fold(v) for v in keyword_values] + names)
+            self.texts.append(text)
+            self.has_text.append(bool(names) or any(v is not None for v in keyword_values))
+            for word in set(WORD_PATTERN.findall(text)):
+                self.words.setdefault(word, []).append(position)
+
+        self.position = {pk: position for position, pk in enumerate(self.pks)}
+        self.all_positions = frozenset(range(len(self.pks)))
+        self.canonical = frozenset(p for p in self.all_positions if chr(self.verification[p]) in 'VU')
+    # Each copy is one position in a set of parallel arrays. Copies are also listed by issue, location, owner and by
+    # every word of their Keyword Search text, so a search only ever looks at the copies that can match.
+
+    def load_ranks(self, using):
+        self.ranks = {}
+        for order, ordering in SEARCH_ORDERINGS.items():
+            if order == 'relevance':
+                continue
+            rank = array('l', bytes(array('l').itemsize * len(self.pks)))
+            ordered = models.Copy.objects.using(using).order_by(*ordering, 'pk').values_list('pk', flat=True)
+            for i, pk in enumerate(ordered):
+                rank[self.position[pk]] = i
+            self.ranks[order] = rank
+    # Each sort order is stored as the rank of every copy, taken from the same database ordering the other backend uses.
+
+    def positions(self, postings, keys):
+        matches = set()
+        for key in keys:
+            matches.update(postings.get(key, ()))
+        return matches
+
+    def keyword(self, value):
+        query = fold(value)
+        words = WORD_PATTERN.findall(query)
+        if not query:
+            return {p: 1 for p in self.all_positions if self.has_text[p]}
+        if not words:
+            candidates = self.all_positions
+        else:
+            candidates = None
+            for word in sorted(set(words), key=len, reverse=True):
+                postings = self.positions(self.words, [w for w in self.words if word in w])
+                candidates = postings if candidates is None else candidates & postings
+                if not candidates:
+                    return {}
+        scores = {}
+        for position in candidates:
+            occurrences = self.texts[position].count(query)
+            if occurrences:
+                scores[position] = occurrences
+        return scores
+    # Every word of the query must appear inside some word of a copy's text, which narrows the candidates before the
+    # whole query is matched as a substring. The number of times it occurs gives the relevance of each copy.
+    # As in the database, an empty query matches every copy that has any keyword text (even empty) or an owner.
+
+class MemoryResults(SearchResults):
+
+    def __init__(self, index, positions, scores=None):
+        self.index = index
+        self.positions = positions
+        self.scores = scores
+
+    def count(self):
+        return len(self.positions)
+
+    def ids(self):
+        return [self.index.pks[position] for position in self.positions]
+
+    def sort_key(self, order):
+        if order == 'relevance' and self.scores is not None:
+            scores, pks = self.scores, self.index.pks
+            return lambda position: (-scores.get(position, 0), pks[position])
+        rank = self.index.ranks.get(order, self.index.ranks['date'])
+        return lambda position: (rank[position],)
+
+    def page(self, order, page_size, after=None, before=None):
+        key = self.sort_key(order)
+        length = len(key(0)) if self.index.pks else 1
+        after_values = decode_cursor(after, length, types=(int, float))
+        before_values = None if after_values else decode_cursor(before, length, types=(int, float))
+
+        if before_values:
+            edge = tuple(before_values)
+            candidates = [p for p in self.positions if key(p) < edge]
+            rows = heapq.nlargest(page_size + 1, candidates, key=key)
+            has_more = len(rows) > page_size
+            rows = rows[:page_size][::-1]
+            has_previous, has_next = has_more, True
+        else:
+            candidates = self.positions
+            if after_values:
+                edge = tuple(after_values)
+                candidates = [p for p in candidates if key(p) > edge]
+            rows = heapq.nsmallest(page_size + 1, candidates, key=key)
+            has_next = len(rows) > page_size
+            rows = rows[:page_size]
+            has_previous = after_values is not None
+
+        copies = models.Copy.objects.using(self.index.using).for_list().in_bulk([self.index.pks[p] for p in rows])
+        return KeysetPage(
+            [copies[self.index.pks[p]] for p in rows if self.index.pks[p] in copies],
+            next_cursor=encode_cursor(list(key(rows[-1]))) if rows and has_next else None,
+            previous_cursor=encode_cursor(list(key(rows[0]))) if rows and has_previous else None,
+        )
+    # Only the copies on the page are loaded from the database, in a single query, to be displayed. They are read
+    # from the database the index was built from (not the snapshot), so every copy counted in the results can be
+    # shown; only a copy deleted since the index was built is left out.
+
+    def facets(self):
+        index = self.index
+        centuries, locations, titles = Counter(), Counter(), Counter()
+        flags = Counter()
+        for p in self.positions:
+            if index.start_date[p] > 0:
+                centuries[index.start_date[p] // 100 + 1] += 1
+            locations[index.location[p]] += 1
+            titles[index.title[p]] += 1
+            flags[chr(index.verification[p])] += 1
+            flags['fragment' if index.fragment[p] else 'complete'] += 1
+            flags['facsimile' if index.facsimile[p] else 'no_facsimile'] += 1
+            features = index.features[p]
+            for name, bit in FEATURE_BITS.items():
+                if features & bit:
+                    flags[name] += 1
+
+        continents, countries = Counter(), Counter()
+        for location_id, count in locations.items():
+            _, _, country, continent = index.locations.get(location_id, ('', [], '', ''))
+            if (continent or '').strip():
+                continents[continent.strip()] += count
+            if (country or '').strip():
+                countries[country.strip()] += count
+
+        def largest(totals):
+            ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:FACET_LIMIT]
+            return [(name, name, count) for name, count in ranked]
+
+        ranked_titles = sorted(
+            (title_id for title_id in titles if title_id in index.titles),
+            key=lambda title_id: (-titles[title_id], index.titles[title_id][1], title_id),
+        )[:FACET_LIMIT]
+        features = [name for name in FEATURE_DISPLAY_NAMES if name not in ('unverified', 'ghost')]
+        facets = [
+            facet('Century', 'century', [
+                (str(century), century_label(century), count) for century, count in sorted(centuries.items())
+            ]),
+            facet('Continent', 'continent', largest(continents)),
+            facet('Country', 'country', largest(countries)),
+            facet('Title', 'title', [
+                (str(title_id), index.titles[title_id][0], titles[title_id]) for title_id in ranked_titles
+            ]),
+            facet('Verification', 'verification', [('V', 'Verified', flags['V']), ('U', 'Unverified', flags['U'])]),
+            facet('Fragment', 'fragment', [
+                ('no', 'Complete copies', flags['complete']), ('yes', 'Fragments', flags['fragment']),
+            ]),
+            facet('Digital Facsimile', 'facsimile', [
+                ('yes', 'Available', flags['facsimile']), ('no', 'Not available', flags['no_facsimile']),
+            ]),
+            facet('Specific Features', 'collection', [
+                (name, FEATURE_DISPLAY_NAMES[name], flags[name]) for name in features
+            ]),
+        ]
+        return [f for f in facets if f['options']]
+    # These are the same facets as the database backend's, counted in one pass over the results.
+
+class MemorySearchBackend(SearchBackend):
+    version_key = 'census:search:version'
+
+    def __init__(self):
+        self._index = None
+        self._version = None
+
+    def get_index(self):
+        version = census_data_version()
+        if self._index is None or self._version != version:
+            self._index = MemoryIndex()
+            self._version = version
+        return self._index
+    # Each worker process keeps its own index, and reloads it when the data version in the shared cache changes.
+
+    def prepare(self):
+        self.get_index()
+
+    def all_copies(self):
+        index = self.get_index()
+        return MemoryResults(index, index.canonical)
+
+    def restrict(self, results, ids):
+        position = results.index.position
+        return MemoryResults(results.index, results.positions & {position[pk] for pk in ids if pk in position})
+
+    def filter(self, results, field, value):
+        index = results.index
+        matches, scores = self.matches(index, results, field, value)
+        return (MemoryResults(index, frozenset(matches), scores), *search_display(field, value))
+
+    def matches(self, index, results, field, value):
+        positions = results.positions
+
+        if field == 'keyword':
+            scores = index.keyword(value or '')
+            return positions & scores.keys(), scores
+
+        elif field == 'location' and value:
+            match = contains(value)
+            keys = [pk for pk, location in index.locations.items() if match(location[0])]
+            return positions & index.positions(index.by_location, keys), None
+
+        elif field == 'geography' and value:
+            match = contains(value)
+            keys = [pk for pk, location in index.locations.items() if any(match(part) for part in location[1])]
+            return positions & index.positions(index.by_location, keys), None
+
+        elif field == 'provenance_name' and value:
+            match = contains(value)
+            keys = [pk for pk, name in index.owner_names.items() if match(name)]
+            return positions & index.positions(index.by_owner, keys), None
+
+        elif field == 'collection':
+            feature_names = collection_features(value)
+            if not feature_names:
+                return set(), None
+            if 'ghost' in feature_names:
+                positions = index.all_positions
+            mask = sum(FEATURE_BITS[name] for name in feature_names)
+            return {p for p in positions if index.features[p] & mask == mask}, None
+
+        elif field == 'year' and value:
+            year_range = convert_year_range(value)
+            if year_range:
+                start, end = year_range
+                keys = [
+                    pk for pk, issue in index.issues.items()
+                    if issue[2] > 0 and (start is None or issue[3] >= start) and (end is None or issue[2] <= end)
+                ]
+            else:
+                match = contains(value)
+                keys = [pk for pk, issue in index.issues.items() if match(issue[0])]
+            return positions & index.positions(index.by_issue, keys), None
+
+        elif field == 'stc' and value:
+            match = contains(value)
+            keys = [pk for pk, issue in index.issues.items() if match(issue[1])]
+            return positions & index.positions(index.by_issue, keys), None
+
+        elif field == 'census_id' and value:
+            return positions & set(index.census_ids.get(value, ())), None
+
+        elif field == 'century' and parse_number(value, MAX_CENTURY) is not None:
+            start = (int(value) - 1) * 100
+            keys = [pk for pk, issue in index.issues.items() if issue[2] > 0 and start <= issue[2] <= start + 99]
+            return positions & index.positions(index.by_issue, keys), None
+
+        elif field in ('continent', 'country') and value and value.strip():
+            column = 3 if field == 'continent' else 2
+            keys = [pk for pk, location in index.locations.items() if (location[column] or '').strip() == value.strip()]
+            return positions & index.positions(index.by_location, keys), None
+
+        elif field == 'title' and parse_number(value) is not None:
+            title_id = int(value)
+            return {p for p in positions if index.title[p] == title_id}, None
+
+        elif field == 'verification' and value in models.VerificationChoices.values:
+            code = ord(value)
+            return {p for p in positions if index.verification[p] == code}, None
+
+        elif field in ('fragment', 'facsimile') and value in ('yes', 'no'):
+            column = index.fragment if field == 'fragment' else index.facsimile
+            wanted = value == 'yes'
+            return {p for p in positions if bool(column[p]) == wanted}, None
+
+        return set(), None
+    # Each search matches the same copies as filter_copies does in the database. Text is compared after case folding.
+# This backend holds the searchable fields of every copy in memory, so searches run without querying the database;
+# only the copies on the page being shown are loaded. It suits censuses that fit comfortably in each worker's memory.
+
+
+# --- Backend selection ---
+
+_search_backend = None
+
+def get_search_backend():
+    global _search_backend
+    if _search_backend is None:
+        backend_class = import_string(getattr(settings, 'CENSUS_SEARCH_BACKEND', 'censusapp.search_backends.ORMSearchBackend'))
+        _search_backend = backend_class()
+    return _search_backend
+
+def census_data_version():
+    return cache.get_or_set(MemorySearchBackend.version_key, time.time_ns, None)
+
+def _move_data_version_on():
+    cache.set(MemorySearchBackend.version_key, time.time_ns(), None)
+
+def invalidate_search_backend(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    if not any(callback is _move_data_version_on for _, callback, *_ in connection.run_on_commit):
+        transaction.on_commit(_move_data_version_on, using=using)
+# This is called whenever census data changes, so in-memory indexes are reloaded before their next search.
+# Anything else worked out from the whole census (such as the admin's copy counts) can be keyed on the same version.
+# The version moves on once the change has been committed (once per transaction), never before: a worker reloading
+# its index in between would otherwise read the old data and keep it under the new version until the next edit.
@@ -0,0 +1,133 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import FloatField, Value
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+from . import models
+from .utils import KEYWORD_FIELDS, keyword_query
+
+
+# --- Plain database index (no full-text support) ---
+
+class SearchIndex:
+
+    def is_available(self, using=DEFAULT_DB_ALIAS):
+        return False
+
+    def search(self, copies, value):
+        return copies.filter(keyword_query(value)).annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+    def update_copies(self, copy_ids, using=DEFAULT_DB_ALIAS):
+        pass
+
+    def remove_copies(self, copy_ids, using=DEFAULT_DB_ALIAS):
+        pass
+
+    def rebuild(self, using=DEFAULT_DB_ALIAS):
+        return 0
+# This class defines the interface for Keyword Search indexes. By itself it simply runs the icontains filters;
+# search() must return the filtered copies annotated with a 'search_rank' (lower values are better matches).
+
+
+# --- SQLite FTS5 index ---
+
+FTS_TABLE = 'censusapp_copy_fts'
+FTS_COLUMNS = KEYWORD_FIELDS + ['provenance_names']
+
+class FTS5SearchIndex(SearchIndex):
+    min_query_length = 3
+
+    def __init__(self):
+        self._available = {}
+
+    def is_available(self, using=DEFAULT_DB_ALIAS):
+        if using not in self._available:
+            connection = connections[using]
+            self._available[using] = (
+                connection.vendor == 'sqlite' and
+                FTS_TABLE in connection.introspection.table_names()
+            )
+        return self._available[using]
+
+    def match_expression(self, value):
+        return '"' + value.replace('"', '""') + '"'
+    # The trigram tokenizer treats a quoted phrase as a case-insensitive substring, just like icontains.
+
+    def search(self, copies, value):
+        value = value or ''
+        if len(value.strip()) < self.min_query_length or not self.is_available(copies.db):
+            return super().search(copies, value)
+        copy_table = copies.model._meta.db_table
+        return copies.extra(
+            tables=[FTS_TABLE],
+            where=[f'{FTS_TABLE}.rowid = {copy_table}.id', f'{FTS_TABLE} MATCH %s'],
+            params=[self.match_expression(value)],
+        ).annotate(search_rank=RawSQL(f'bm25({FTS_TABLE})', [], output_field=FloatField()))
+    # The FTS5 table is joined to the copies once, so the full-text match runs once per search and every result
+    # gets its BM25 relevance score from the same match. Django can't join a table that has no model, hence extra().
+
+    def _populate_sql(self, where=''):
+        copy_table = models.Copy._meta.db_table
+        ownership_table = models.ProvenanceOwnership._meta.db_table
+        name_table = models.ProvenanceName._meta.db_table
+        columns = ', '.join(FTS_COLUMNS)
+        copy_columns = ', '.join(f'c.{field}' for field in KEYWORD_FIELDS)
+        return (
+            f'INSERT INTO {FTS_TABLE} (rowid, {columns}) '
+            f'SELECT c.id, {copy_columns}, '
+            f'(SELECT group_concat(p.name, char(10)) FROM {ownership_table} o '
+            f'JOIN {name_table} p ON p.id = o.owner_id WHERE o.copy_id = c.id) '
+            f'FROM {copy_table} c {where}'
+        )
+    # Provenance names are joined with newlines so that a search term never matches across two names.
+
+    def _chunks(self, copy_ids, size=500):
+        copy_ids = list(copy_ids)
+        for i in range(0, len(copy_ids), size):
+            yield copy_ids[i: i + size]
+
+    def update_copies(self, copy_ids, using=DEFAULT_DB_ALIAS):
+        if not self.is_available(using):
+            return
+        with connections[using].cursor() as cursor:
+            for chunk in self._chunks(copy_ids):
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})', chunk)
+                cursor.execute(self._populate_sql(f'WHERE c.id IN ({placeholders})'), chunk)
+
+    def remove_copies(self, copy_ids, using=DEFAULT_DB_ALIAS):
+        if not self.is_available(using):
+            return
+        with connections[using].cursor() as cursor:
+            for chunk in self._chunks(copy_ids):
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})', chunk)
+
+    def rebuild(self, using=DEFAULT_DB_ALIAS):
+        connection = connections[using]
+        if connection.vendor != 'sqlite':
+            return 0
+        columns = ', '.join(FTS_COLUMNS)
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+            cursor.execute(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5({columns}, tokenize='trigram')")
+            cursor.execute(self._populate_sql())
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+            cursor.execute(f'SELECT count(*) FROM {FTS_TABLE}')
+            total = cursor.fetchone()[0]
+        self._available[using] = True
+        return total
+# This class keeps an FTS5 virtual table (trigram tokenizer) of the Keyword Search fields, one row per copy.
+# Search terms shorter than three characters can't use trigrams, so they fall back to the icontains filters.
+
+
+# --- Active index ---
+
+_search_index = None
+
+def get_search_index():
+    global _search_index
+    if _search_index is None:
+        index_class = import_string(getattr(settings, 'CENSUS_SEARCH_INDEX', 'censusapp.search_index.FTS5SearchIndex'))
+        _search_index = index_class()
+    return _search_index
@@ -16,6 +16,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'censusapp.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -60,12 +61,160 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,
+        },
+    },
+    'snapshot': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': f'file:{BASE_DIR / "snapshot.sqlite3"}?mode=ro&immutable=1',
+        'CONN_MAX_AGE': 600,
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
 }
+# Connections are kept open between requests, and a write waits up to 20 seconds for another to finish
+# instead of failing with "database is locked".
+
+DATABASE_ROUTERS = ['censusapp.database.SnapshotRouter']
+
+CENSUS_SNAPSHOT_PUBLISH_ON_SAVE = True
+# Public pages, searches, autofill and exports read from "snapshot", a read-only copy of the database, so that heavy
+# searches never hold up curators saving in the admin. Run "manage.py publish_snapshot" to create or refresh it;
+# after that, every save in the admin queues a job to publish a new one, which "manage.py run_census_jobs --forever"
+# runs (set CENSUS_SNAPSHOT_PUBLISH_ON_SAVE = False to publish only from the command, e.g. on a schedule). Until the
+# snapshot exists, everything reads from the primary database.
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'memory',
+}
+# These are applied to every new SQLite connection. Set SQLITE_PRAGMAS = {} in local_settings.py to keep SQLite's
+# defaults, e.g. if the database is on a network drive (where WAL mode doesn't work).
+# Run "manage.py check_sqlite_concurrency" to see how readers fare while the database is being written to; the test
+# suite runs the same check.
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# --- Keyword Search Index ---
+
+CENSUS_SEARCH_INDEX = 'censusapp.search_index.FTS5SearchIndex'
+# Set this to 'censusapp.search_index.SearchIndex' to search the database directly instead of the FTS5 index.
+# The index is kept in sync by the admin; after bulk changes made elsewhere, run "manage.py rebuild_search_index".
+
+
+# --- Search Backend ---
+
+CENSUS_SEARCH_BACKEND = 'censusapp.search_backends.ORMSearchBackend'
+# Set this to 'censusapp.search_backends.MemorySearchBackend' to run searches against an in-memory copy of the census
+# held by each worker process, instead of querying the database. It is reloaded whenever the census data changes.
+
+
+# --- Search Results ---
+
+SEARCH_PAGE_SIZE = 100
+
+SEARCH_MAX_PAGE_SIZE = 500
+# Visitors can ask for a different page size with "page_size=", up to SEARCH_MAX_PAGE_SIZE rows.
+
+SEARCH_RESULT_SET_TIMEOUT = 60 * 60
+
+SEARCH_QUERY_TIMEOUT = 60 * 60 * 24 * 7
+# "Search within results" stores each result set in the cache and sends the browser a short token instead.
+# The ids are kept for SEARCH_RESULT_SET_TIMEOUT seconds; the query behind a token is kept for SEARCH_QUERY_TIMEOUT.
+
+
+# --- JSON API ---
+
+API_PAGE_SIZE = 100
+
+API_MAX_PAGE_SIZE = 1000
+# The read-only API at /api/<resource>/ lists titles, editions, issues, copies, locations and provenance_names.
+# Clients choose their page size with "page_size=", up to API_MAX_PAGE_SIZE, and follow the cursor links between pages.
+
+
+# --- Change Log ---
+
+CENSUS_CHANGE_LOG_RETENTION_DAYS = 90
+
+CENSUS_CHANGE_LOG_COMPACT_AFTER_DAYS = 1
+# Every change to a census record is logged, and mirrors read the log from /api/changes/?since=<seq>.
+# "manage.py change_log prune" (run daily) deletes entries older than the retention period, and once entries are a day
+# old keeps only the latest one for each record.
+
+
+# --- Search Bar Autocomplete ---
+
+AUTOCOMPLETE_LIMIT = 20
+
+AUTOCOMPLETE_MAX_AGE = 300
+# Autocomplete responses list at most AUTOCOMPLETE_LIMIT matches and may be cached by browsers for AUTOCOMPLETE_MAX_AGE seconds.
+
+
+# --- Cache ---
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    }
+}
+# A file-based cache is shared by every worker process on the server without needing any other services.
+
+PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+# Public pages are cached for anonymous visitors and cleared as soon as the records they show are edited.
+
+
+# --- Bulk Import ---
+
+BULK_IMPORT_BATCH_SIZE = 500
+# Large CSV/XLSX files can be loaded with "manage.py bulk_import" or the "Bulk import" button in the admin.
+# Rows are checked and written BULK_IMPORT_BATCH_SIZE at a time, all within one transaction.
+
+
+# --- Request Instrumentation ---
+
+CENSUS_INSTRUMENTATION = True
+
+CENSUS_SLOW_REQUEST_MS = 500
+# Every request is timed along with its database queries, and sent back with a Server-Timing header for browser dev tools.
+# Staff can see the timings of each view at /instrumentation/, including the SQL of requests slower than CENSUS_SLOW_REQUEST_MS.
+
+
+# --- Static Site ---
+
+CENSUS_STATIC_SITE_DIR = BASE_DIR / 'site'
+# "manage.py build_static_site" writes the title, issue, copy and info pages here as static files, with compressed copies.
+# Run it after the census changes (e.g. every few minutes); only the pages of changed records are written again.
+# To serve them without running any views, point the web server at this directory before passing requests on to Django,
+# or set WHITENOISE_ROOT = CENSUS_STATIC_SITE_DIR and WHITENOISE_INDEX_FILE = True (WhiteNoise only reads the directory
+# when the server starts, so restart it after each build). Searches and the admin still need Django.
+
+
+# --- Census Jobs ---
+
+CENSUS_JOB_DIR = BASE_DIR / 'jobs'
+# Files written by census jobs (CSV exports and zipped dumps of the census) and files uploaded for background imports
+# are kept here. Jobs wait in the CensusJob table until a worker runs them: keep "manage.py run_census_jobs --forever"
+# running alongside the web server (add e.g. --processes 2 to run two jobs at once), or run "manage.py run_census_jobs"
+# regularly (e.g. every minute) to run whatever is queued. Staff can queue jobs at /jobs/ and follow them in the admin.
+# Each job uses one process per CPU unless CENSUS_JOB_WORKERS is set.
+# The export pages send the file of the latest export job for as long as the census hasn't changed since it ran, and
+# otherwise stream the export, queuing a new job when staff download it (unless CENSUS_JOB_QUEUE_EXPORTS = False).
+# Run e.g. "manage.py run_census_jobs title_copy_count" to write an export for visitors. Failed jobs are tried again
+# up to CENSUS_JOB_MAX_ATTEMPTS (3) times, waiting CENSUS_JOB_RETRY_DELAY (60) seconds, then twice as long each time.
+
+
 # --- Django Admin Interface ---
 
 ADMIN_URL = 'admin/'
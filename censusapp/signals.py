@@ -0,0 +1,247 @@
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_save
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from . import models
+from .models import ChangeOperationChoices
+from .autocomplete import AUTOCOMPLETE_FIELDS, invalidate_index
+from .changes import is_logged, record_changes, record_copy_updates
+from .database import apply_sqlite_pragmas, schedule_snapshot, snapshot_published
+from .page_cache import invalidate_pages
+from .search_backends import invalidate_search_backend
+from .search_index import get_search_index
+from .stats import invalidate_statistics
+from .utils import refresh_copy_features
+
+
+# --- Database connections ---
+
+@receiver(connection_created)
+def configure_sqlite_connection(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            apply_sqlite_pragmas(cursor)
+
+
+# --- Owners changed through copy.provenance_names ---
+
+@receiver(m2m_changed, sender=models.Copy.provenance_names.through)
+def note_cleared_copies(sender, instance, action, reverse, using, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._cleared_copy_ids = set(instance.ownerships.using(using).values_list('copy_id', flat=True))
+# Once a provenance name's copies have been cleared, post_clear can't say which copies they were, so they are noted
+# beforehand.
+
+def changed_copy_ids(instance, action, reverse, pk_set):
+    if not reverse:
+        return [instance.pk]
+    if action == 'post_clear':
+        return getattr(instance, '_cleared_copy_ids', set())
+    return pk_set or []
+# Owners added through copy.provenance_names (or provenance_name.copy_set), rather than by saving a
+# ProvenanceOwnership, send m2m_changed instead. This gives the copies whose owners changed.
+
+
+# --- Keyword Search index ---
+
+@receiver(post_save, sender=models.Copy)
+def index_copy(sender, instance, using, **kwargs):
+    get_search_index().update_copies([instance.pk], using=using)
+
+@receiver(post_delete, sender=models.Copy)
+def unindex_copy(sender, instance, using, **kwargs):
+    get_search_index().remove_copies([instance.pk], using=using)
+
+@receiver([post_save, post_delete], sender=models.ProvenanceOwnership)
+def index_ownership(sender, instance, using, **kwargs):
+    get_search_index().update_copies([instance.copy_id], using=using)
+
+@receiver(m2m_changed, sender=models.Copy.provenance_names.through)
+def index_owner_change(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        get_search_index().update_copies(changed_copy_ids(instance, action, reverse, pk_set), using=using)
+
+@receiver(post_save, sender=models.ProvenanceName)
+def index_provenance_name(sender, instance, using, **kwargs):
+    copy_ids = instance.ownerships.values_list('copy_id', flat=True)
+    get_search_index().update_copies(set(copy_ids), using=using)
+# Renaming a Provenance Name changes the indexed text of every copy it owned.
+
+
+# --- Specific Features ---
+
+def reload_features(copy):
+    copy.features = models.Copy.objects.filter(pk=copy.pk).values_list('features', flat=True).first() or 0
+# Copy.save keeps the owner features it holds, so a copy still in memory is given the features just stored for it;
+# otherwise saving it again would undo the change.
+
+@receiver([post_save, post_delete], sender=models.ProvenanceOwnership)
+def refresh_ownership_features(sender, instance, **kwargs):
+    refresh_copy_features([instance.copy_id])
+    if models.ProvenanceOwnership.copy.is_cached(instance):
+        reload_features(instance.copy)
+
+@receiver(post_save, sender=models.ProvenanceName)
+def refresh_provenance_name_features(sender, instance, **kwargs):
+    refresh_copy_features(set(instance.ownerships.values_list('copy_id', flat=True)))
+
+@receiver(m2m_changed, sender=models.Copy.provenance_names.through)
+def refresh_owner_features(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        refresh_copy_features(changed_copy_ids(instance, action, reverse, pk_set))
+        if not reverse:
+            reload_features(instance)
+
+
+# --- Census Statistics ---
+
+@receiver([post_save, post_delete], sender=models.Copy)
+def refresh_statistics(sender, using, **kwargs):
+    invalidate_statistics(using)
+
+
+# --- Autocomplete indexes ---
+
+@receiver([post_save, post_delete], sender=models.Location)
+def refresh_location_autocomplete(sender, using, **kwargs):
+    invalidate_index('location', 'geography', using=using)
+
+@receiver([post_save, post_delete], sender=models.ProvenanceName)
+def refresh_provenance_autocomplete(sender, using, **kwargs):
+    invalidate_index('provenance', using=using)
+
+
+# --- Cached pages ---
+
+def _copy_tags(copies):
+    return [f'copy:{pk}' for pk in copies.values_list('pk', flat=True)]
+
+def _issue_tags(issues):
+    return [f'issue:{pk}' for pk in issues.values_list('pk', flat=True)]
+
+@receiver([post_save, post_delete], sender=models.Title)
+def expire_title_pages(sender, instance, using, **kwargs):
+    invalidate_pages('titles', f'title:{instance.pk}',
+                     *_issue_tags(models.Issue.objects.filter(edition__title=instance)),
+                     *_copy_tags(models.Copy.objects.filter(issue__edition__title=instance)), using=using)
+
+@receiver([post_save, post_delete], sender=models.Edition)
+def expire_edition_pages(sender, instance, using, **kwargs):
+    invalidate_pages(f'title:{instance.title_id}',
+                     *_issue_tags(instance.issues.all()),
+                     *_copy_tags(models.Copy.objects.filter(issue__edition=instance)), using=using)
+
+@receiver([post_save, post_delete], sender=models.Issue)
+def expire_issue_pages(sender, instance, using, **kwargs):
+    title_ids = models.Edition.objects.filter(pk=instance.edition_id).values_list('title_id', flat=True)
+    invalidate_pages(f'issue:{instance.pk}',
+                     *[f'title:{pk}' for pk in title_ids],
+                     *_copy_tags(instance.copies.all()), using=using)
+
+@receiver(pre_save, sender=models.Copy)
+def remember_copy_issue(sender, instance, **kwargs):
+    if instance.pk:
+        instance._previous_issue_id = (
+            models.Copy.objects.filter(pk=instance.pk).values_list('issue_id', flat=True).first()
+        )
+# A copy moved to another issue must also disappear from the old issue's pages.
+
+@receiver([post_save, post_delete], sender=models.Copy)
+def expire_copy_pages(sender, instance, using, **kwargs):
+    issue_ids = {instance.issue_id, getattr(instance, '_previous_issue_id', None)} - {None}
+    title_ids = models.Issue.objects.filter(pk__in=issue_ids).values_list('edition__title_id', flat=True)
+    invalidate_pages(f'copy:{instance.pk}', 'statistics',
+                     *[f'issue:{pk}' for pk in issue_ids],
+                     *[f'title:{pk}' for pk in title_ids], using=using)
+# Issue lists show how many copies each title has, and some static pages show census statistics.
+
+@receiver([post_save, post_delete], sender=models.Location)
+def expire_location_pages(sender, instance, using, **kwargs):
+    copies = models.Copy.objects.filter(location=instance)
+    invalidate_pages(*_issue_tags(models.Issue.objects.filter(copies__in=copies).distinct()),
+                     *_copy_tags(copies), using=using)
+
+@receiver(post_save, sender=models.ProvenanceName)
+def expire_provenance_name_pages(sender, instance, using, **kwargs):
+    invalidate_pages(*_copy_tags(models.Copy.objects.filter(ownerships__owner=instance)), using=using)
+
+@receiver([post_save, post_delete], sender=models.ProvenanceOwnership)
+def expire_ownership_pages(sender, instance, using, **kwargs):
+    invalidate_pages(f'copy:{instance.copy_id}', using=using)
+
+@receiver(m2m_changed, sender=models.Copy.provenance_names.through)
+def expire_owner_change_pages(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_pages(*[f'copy:{pk}' for pk in changed_copy_ids(instance, action, reverse, pk_set)], using=using)
+
+@receiver(pre_save, sender=models.StaticPageText)
+def remember_static_page_name(sender, instance, **kwargs):
+    if instance.pk:
+        instance._previous_viewname = (
+            models.StaticPageText.objects.filter(pk=instance.pk).values_list('viewname', flat=True).first()
+        )
+
+@receiver([post_save, post_delete], sender=models.StaticPageText)
+def expire_static_pages(sender, instance, using, **kwargs):
+    viewnames = {instance.viewname, getattr(instance, '_previous_viewname', None)} - {None}
+    invalidate_pages(*[f'info:{viewname}' for viewname in viewnames], using=using)
+
+
+# --- In-memory search backend ---
+
+@receiver([post_save, post_delete])
+def refresh_search_backend(sender, using, **kwargs):
+    if sender in SEARCHED_MODELS:
+        invalidate_search_backend(using)
+
+@receiver(m2m_changed, sender=models.Copy.provenance_names.through)
+def refresh_search_backend_owners(sender, action, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_search_backend(using)
+
+SEARCHED_MODELS = {
+    models.Title, models.Edition, models.Issue, models.Copy,
+    models.Location, models.ProvenanceName, models.ProvenanceOwnership,
+}
+# Any change to the records that searches look at moves the data version on, so in-memory indexes are reloaded.
+
+
+# --- Change log ---
+
+@receiver(post_save)
+def log_saved_record(sender, instance, created, using, **kwargs):
+    if is_logged(sender):
+        record_changes([instance], ChangeOperationChoices.CREATE if created else ChangeOperationChoices.UPDATE, using)
+
+@receiver(post_delete)
+def log_deleted_record(sender, instance, using, **kwargs):
+    if is_logged(sender):
+        record_changes([instance], ChangeOperationChoices.DELETE, using)
+
+@receiver(m2m_changed, sender=models.Copy.provenance_names.through)
+def log_owner_change(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action == 'post_add':
+        record_copy_updates(changed_copy_ids(instance, action, reverse, pk_set), using)
+# Every change to a census record is logged in the same transaction as the change itself, including the records
+# removed along with a deleted one. Owners removed or cleared through the copy are deleted as ProvenanceOwnership
+# records, which sends post_delete for each of them, so only added owners are logged here.
+
+
+# --- Read-only snapshot ---
+
+@receiver([post_save, post_delete])
+def publish_snapshot_after_edit(sender, using, **kwargs):
+    if sender._meta.app_label == 'censusapp' and getattr(sender, 'census_record', True):
+        schedule_snapshot(using)
+
+@receiver(m2m_changed, sender=models.Copy.provenance_names.through)
+def publish_snapshot_after_owner_change(sender, action, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        schedule_snapshot(using)
+
+@receiver(snapshot_published)
+def refresh_from_snapshot(sender, **kwargs):
+    invalidate_statistics()
+    invalidate_pages('statistics')
+    invalidate_index(*AUTOCOMPLETE_FIELDS)
+# Statistics and autocomplete indexes rebuilt between an edit and the next snapshot were built from the old one,
+# so they are rebuilt again once the new snapshot is in place.
@@ -0,0 +1,257 @@
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import NoReverseMatch, reverse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+from urllib.parse import unquote
+import django
+import json
+import os
+import tempfile
+from whitenoise.compress import Compressor
+from . import models
+from .changes import changed_records, horizon, latest_change
+from .database import reading_snapshot
+from .page_cache import bypassing_page_cache
+
+
+# --- Settings ---
+
+STATIC_SITE_DIR = Path(getattr(settings, 'CENSUS_STATIC_SITE_DIR', settings.BASE_DIR / 'site'))
+STATIC_SITE_WORKERS = getattr(settings, 'CENSUS_STATIC_SITE_WORKERS', None)
+STATIC_SITE_CHUNK_SIZE = 200
+COMPRESSED_SUFFIXES = ('.gz', '.br')
+
+
+# --- Pages ---
+
+def _url(viewname, *args):
+    try:
+        return reverse(viewname, args=args)
+    except NoReverseMatch:
+        return None
+# Census ids that can't appear in a URL (such as ones containing "/") have no single copy page to write.
+
+def read_census():
+    return {
+        'since': latest_change(),
+        'titles': list(models.Title.objects.values_list('pk', flat=True)),
+        'editions': dict(models.Edition.objects.values_list('pk', 'title_id')),
+        'issues': dict(models.Issue.objects.values_list('pk', 'edition_id')),
+        'copies': dict(models.Copy.objects.values_list('pk', 'issue_id')),
+        'census_ids': dict(models.Copy.objects.exclude(census_id=None).exclude(census_id='').values_list('pk', 'census_id')),
+        'info': list(models.StaticPageText.objects.exclude(viewname=None).exclude(viewname='').values_list('viewname', flat=True)),
+    }
+# This function reads the records that have pages, and which record each belongs to, together with the last entry
+# in the change log at the time, so that the next build knows where to carry on from.
+
+def site_pages(census):
+    pages = {reverse('homepage'): ('homepage', None), '/': ('homepage', None)}
+    pages.update({_url('issue_list', pk): ('title', pk) for pk in census['titles']})
+    pages.update({_url('copy_list', pk): ('issue', pk) for pk in census['issues']})
+    pages.update({_url('copy_data', pk): ('copy', pk) for pk in census['copies']})
+    pages.update({_url('single_copy', census_id): ('copy', pk) for pk, census_id in census['census_ids'].items()})
+    pages.update({_url('info', viewname): ('info', viewname) for viewname in census['info']})
+    pages.pop(None, None)
+    return pages
+# This function lists every public page that is fully determined by the database, with the record it shows.
+# Searches, autofill and the CSV exports are left to Django.
+
+
+# --- Changed pages ---
+
+def _parents(maps, ids):
+    return {parent for ids_to_parents in maps for pk in ids for parent in [ids_to_parents.get(pk)] if parent is not None}
+
+def _children(maps, parent_ids):
+    return {pk for ids_to_parents in maps for pk, parent in ids_to_parents.items() if parent in parent_ids}
+
+def changed_pages(records, census, previous):
+    editions = [census['editions'], previous['editions']]
+    issues = [census['issues'], previous['issues']]
+    copies = [census['copies'], previous['copies']]
+    titles, issue_ids, copy_ids = set(), set(), set()
+
+    changed = records.get('titles', set())
+    titles |= changed
+    changed_issues = _children(issues, _children(editions, changed))
+    issue_ids |= changed_issues
+    copy_ids |= _children(copies, changed_issues)
+
+    changed = records.get('editions', set())
+    titles |= _parents(editions, changed)
+    changed_issues = _children(issues, changed)
+    issue_ids |= changed_issues
+    copy_ids |= _children(copies, changed_issues)
+
+    changed = records.get('issues', set())
+    issue_ids |= changed
+    titles |= _parents(editions, _parents(issues, changed))
+    copy_ids |= _children(copies, changed)
+
+    changed = records.get('copies', set())
+    copy_ids |= changed
+    issue_ids |= _parents(copies, changed)
+    titles |= _parents(editions, _parents(issues, _parents(copies, changed)))
+
+    if records.get('locations'):
+        at_locations = {pk for pk, location in models.Copy.objects.values_list('pk', 'location_id')
+                        if location in records['locations']}
+        copy_ids |= at_locations
+        issue_ids |= _parents(copies, at_locations)
+    if records.get('provenance_names'):
+        copy_ids |= {pk for pk, owner in models.ProvenanceOwnership.objects.values_list('copy_id', 'owner_id')
+                     if owner in records['provenance_names']}
+
+    pages = {('title', pk) for pk in titles} | {('issue', pk) for pk in issue_ids} | {('copy', pk) for pk in copy_ids}
+    if records.get('titles'):
+        pages.add(('homepage', None))
+    return pages
+# This function works out which pages show the records changed since the last build, the same way the page cache is
+# cleared when a record is saved: a title, edition or issue appears on the pages of everything below it, and copies
+# are counted on the pages of their issue and title. Each record is looked up where it is now and where it was at
+# the last build, so a deleted record, or one moved to another issue, updates the pages it used to appear on.
+
+def _previous(manifest):
+    return {name: {int(pk): parent for pk, parent in manifest.get(name, {}).items()}
+            for name in ('editions', 'issues', 'copies')}
+# JSON turns the ids used as keys into strings.
+
+
+# --- Rendering ---
+
+_client = None
+
+def _start_worker():
+    global _client
+    django.setup()
+    _client = Client()
+# Worker processes started by "spawn" (rather than forked) need Django set up before they can render anything.
+
+def output_path(output_dir, url):
+    parts = [unquote(part) for part in url.strip('/').split('/') if part]
+    if any(part in ('.', '..') or os.sep in part for part in parts):
+        return None
+    return Path(output_dir, *parts, 'index.html')
+# Each page is written as index.html in a directory named after its URL, e.g. title/3/index.html for /title/3/.
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(prefix=f'.{path.name}.', suffix='.tmp', dir=path.parent)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(content)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    for suffix in COMPRESSED_SUFFIXES:
+        Path(f'{path}{suffix}').unlink(missing_ok=True)
+    Compressor(quiet=True).compress(str(path))
+# Pages replace the old file in one step, so the web server never sends half a page. Gzip (and Brotli, if installed)
+# copies sit next to each page, where WhiteNoise and most web servers look for them.
+
+def remove_page(output_dir, url):
+    path = output_path(output_dir, url)
+    if path is None:
+        return
+    for name in (path, *[Path(f'{path}{suffix}') for suffix in COMPRESSED_SUFFIXES]):
+        name.unlink(missing_ok=True)
+    directory = path.parent
+    while directory != Path(output_dir) and directory.is_dir() and not any(directory.iterdir()):
+        directory.rmdir()
+        directory = directory.parent
+
+def render_pages(urls, output_dir):
+    client = _client or Client()
+    written, failed = [], {}
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']), bypassing_page_cache():
+        for url in urls:
+            response = client.get(url)
+            path = output_path(output_dir, url)
+            if response.status_code == 200 and path is not None:
+                _write(path, response.content)
+                written.append(url)
+            else:
+                remove_page(output_dir, url)
+                failed[url] = response.status_code
+    return written, failed
+# Pages are requested through the full middleware stack, as an anonymous visitor would see them, but are kept out of
+# the page cache, which would otherwise fill up with every page of the census while the site is built.
+# A page that can no longer be built (e.g. a copy deleted since the pages were listed) is removed rather than left stale.
+
+
+# --- Builds ---
+
+def manifest_path(output_dir):
+    output_dir = Path(output_dir).resolve()
+    return output_dir.parent / f'.{output_dir.name}.manifest.json'
+# The manifest is kept next to the site rather than in it, so that it is never served.
+
+def load_manifest(output_dir):
+    try:
+        with open(manifest_path(output_dir)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_manifest(output_dir, manifest):
+    path = manifest_path(output_dir)
+    handle, temp_path = tempfile.mkstemp(prefix=f'{path.name}.', suffix='.tmp', dir=path.parent)
+    with os.fdopen(handle, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
+# The manifest lists the pages written by the last build, where each edition, issue and copy belonged at the time,
+# and how far the build had read the change log.
+
+def _chunks(urls, size=STATIC_SITE_CHUNK_SIZE):
+    return [urls[i:i + size] for i in range(0, len(urls), size)]
+
+def build_site(output_dir=STATIC_SITE_DIR, workers=STATIC_SITE_WORKERS, full=False, progress=None):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(output_dir) or {'since': 0, 'pages': []}
+    built = set(manifest['pages'])
+
+    with reading_snapshot():
+        census = read_census()
+        pages = site_pages(census)
+        full = full or not built or not horizon() <= manifest['since'] <= census['since']
+        changed = set() if full else changed_pages(changed_records(manifest['since']), census, _previous(manifest))
+    stale = sorted(url for url, page in pages.items() if full or url not in built or page[0] == 'info' or page in changed)
+    removed = sorted(built - set(pages))
+    for url in removed:
+        remove_page(output_dir, url)
+
+    written, failed = [], {}
+    chunks = _chunks(stale)
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers > 1:
+        connections.close_all()
+    with ProcessPoolExecutor(workers, initializer=_start_worker) if workers > 1 else nullcontext() as executor:
+        results = (executor.map if executor else map)(render_pages, chunks, [output_dir] * len(chunks))
+        for chunk_written, chunk_failed in results:
+            written += chunk_written
+            failed.update(chunk_failed)
+            if progress is not None:
+                progress(chunk_written, chunk_failed)
+
+    save_manifest(output_dir, {
+        'since': census['since'],
+        'pages': sorted((built & set(pages)) - set(stale) | set(written)),
+        'editions': census['editions'],
+        'issues': census['issues'],
+        'copies': census['copies'],
+    })
+    return {'pages': len(pages), 'written': len(written), 'unchanged': len(pages) - len(stale),
+            'removed': len(removed), 'failed': failed}
+# This function writes every public page into output_dir. After the first build, only the pages of records changed
+# since (according to the change log), new pages and the info pages (which show the date and census statistics) are
+# written again, and the pages of deleted records are removed. full=True writes them all, as does a build that finds
+# the change log has been cut short since it last ran (e.g. after a synthetic census replaced the real one).
+# Pages are rendered in chunks by a pool of worker processes, one per CPU unless told otherwise.
@@ -0,0 +1,60 @@
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, Q
+from . import models
+from .utils import canonical_query, facsimile_query, verified_query, unverified_query
+
+
+# --- Census Statistics ---
+
+STATISTICS_CACHE_KEY = 'census:statistics'
+
+STATISTIC_FILTERS = {
+    'canonical_count': canonical_query,
+    'copy_count': canonical_query & Q(fragment=False),
+    'fragment_copy_count': canonical_query & Q(fragment=True),
+    'verified_copy_count': verified_query,
+    'unverified_copy_count': unverified_query,
+    'estc_copy_count': canonical_query & Q(from_estc=True),
+    'non_estc_copy_count': canonical_query & Q(from_estc=False),
+    'facsimile_copy_count': canonical_query & facsimile_query,
+}
+
+STATISTIC_NAMES = set(STATISTIC_FILTERS) | {'facsimile_copy_percent'}
+
+def count_statistics(copies=None):
+    copies = models.Copy.objects.all() if copies is None else copies
+    return copies.aggregate(**{name: Count('pk', filter=query) for name, query in STATISTIC_FILTERS.items()})
+# This function counts every statistic in a single pass over the Copy table (or the given copies). Counts for
+# separate groups of copies can be added together.
+
+def finish_statistics(counts):
+    statistics = dict(counts)
+    canonical_count = statistics['canonical_count']
+    facsimile_copy_percent = round(
+        100 * statistics['facsimile_copy_count'] / canonical_count
+    ) if canonical_count else 0
+    statistics['facsimile_copy_percent'] = f'{facsimile_copy_percent}%'
+    return statistics
+
+def compute_statistics():
+    return finish_statistics(count_statistics())
+
+def store_statistics(statistics):
+    cache.set(STATISTICS_CACHE_KEY, statistics, None)
+
+def get_statistics():
+    statistics = cache.get(STATISTICS_CACHE_KEY)
+    if statistics is None:
+        statistics = compute_statistics()
+        store_statistics(statistics)
+    return statistics
+
+def _clear_statistics():
+    cache.delete(STATISTICS_CACHE_KEY)
+
+def invalidate_statistics(using=DEFAULT_DB_ALIAS):
+    transaction.on_commit(_clear_statistics, using=using)
+# The figures are kept in the cache until a copy is saved or deleted, and are recounted the next time they're read.
+# They are cleared once the change has been committed, so that a request counting the copies in the meantime can't
+# store figures from before the change.
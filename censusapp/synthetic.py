@@ -0,0 +1,209 @@
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+import random
+from . import models
+from .autocomplete import AUTOCOMPLETE_FIELDS, invalidate_index
+from .bulk_import import IMPORT_BATCH_SIZE
+from .changes import record_truncation
+from .database import schedule_snapshot
+from .page_cache import invalidate_all_pages
+from .search_backends import invalidate_search_backend
+from .search_index import get_search_index
+from .stats import invalidate_statistics
+from .utils import (
+    census_id_sort_group, census_id_sort_number, census_id_sort_pair, convert_year_range, copy_features, location_sort_key,
+    title_sort_key,
+)
+
+
+# --- Word lists ---
+
+TITLE_PATTERNS = [
+    'The Tragedy of {name}', 'The History of {name}', 'The Life and Death of {name}', '{name}',
+    'The Comedy of {name}', 'A Pleasant Conceited History of {name}', 'The Famous Chronicle of {name}',
+]
+TITLE_NAMES = [
+    'Cymbeline', 'Pericles', 'Arden', 'Leir', 'Gorboduc', 'Tamburlaine', 'Edmund Ironside', 'Locrine', 'Mucedorus',
+    'Cromwell', 'Oldcastle', 'Vortigern', 'Sejanus', 'Volpone', 'Philaster', 'Bussy', 'Appius', 'Virginia',
+    'Fair Em', 'Hester', 'Solyman', 'Perseda', 'Selimus', 'Alphonsus', 'Orlando', 'Friar Bacon', 'Jack Straw',
+]
+FORMATS = ['Quarto', 'Quarto', 'Quarto', 'Folio', 'Octavo', 'Duodecimo']
+PLACES = [
+    ('London', 'England', 'United Kingdom', 'Europe'), ('Oxford', 'England', 'United Kingdom', 'Europe'),
+    ('Cambridge', 'England', 'United Kingdom', 'Europe'), ('Edinburgh', 'Scotland', 'United Kingdom', 'Europe'),
+    ('Dublin', None, 'Ireland', 'Europe'), ('Paris', None, 'France', 'Europe'), ('Berlin', None, 'Germany', 'Europe'),
+    ('Washington', 'District of Columbia', 'United States', 'North America'),
+    ('New York', 'New York', 'United States', 'North America'), ('San Marino', 'California', 'United States', 'North America'),
+    ('Chicago', 'Illinois', 'United States', 'North America'), ('Toronto', 'Ontario', 'Canada', 'North America'),
+    ('Tokyo', None, 'Japan', 'Asia'), ('Melbourne', 'Victoria', 'Australia', 'Oceania'),
+]
+INSTITUTIONS = ['The {city} Library', '{city} University Library', 'The {name} Collection', '{name} College', 'The {name} Library']
+FIRST_NAMES = {
+    'M': ['John', 'William', 'Thomas', 'Richard', 'Henry', 'Edward', 'Robert', 'George', 'Charles', 'James'],
+    'F': ['Anne', 'Elizabeth', 'Mary', 'Frances', 'Margaret', 'Jane', 'Katherine', 'Dorothy', 'Susanna', 'Lucy'],
+}
+SURNAMES = [
+    'Puckering', 'Wolfreston', 'Malone', 'Capell', 'Steevens', 'Garrick', 'Kemble', 'Douce', 'Halliwell', 'Folger',
+    'Huth', 'Locker', 'Devonshire', 'Bridgewater', 'Ashburnham', 'Heber', 'Jolley', 'Perkins', 'Daniel', 'Mostyn',
+]
+
+
+# --- Generation ---
+
+def _choice(rng, weighted):
+    values, weights = zip(*weighted)
+    return rng.choices(values, weights)[0]
+
+def _bulk_create(model, objects, using):
+    return model.objects.using(using).bulk_create(objects, batch_size=IMPORT_BATCH_SIZE)
+
+def _titles(rng, count):
+    titles, seen = [], set()
+    while len(titles) < count:
+        title = rng.choice(TITLE_PATTERNS).format(name=rng.choice(TITLE_NAMES))
+        if title in seen:
+            title = f'{title} {len(seen) + 1}'
+        seen.add(title)
+        title = models.Title(title=title, apocryphal=rng.random() < 0.1)
+        title.sort_title = title_sort_key(title)
+        titles.append(title)
+    return titles
+
+def _year(rng):
+    year = rng.randint(1594, 1700)
+    return _choice(rng, [(str(year), 80), (f'[{year}]', 8), (f'c. {year}', 6), (f'{year}-{year + 2}', 4), ('[unknown]', 2)])
+
+def _issues(rng, editions, counter):
+    issues = []
+    for edition in editions:
+        total = _choice(rng, [(1, 80), (2, 15), (3, 5)])
+        year = _year(rng)
+        for number in range(1, total + 1):
+            stc = next(counter)
+            issue = models.Issue(
+                edition=edition,
+                issue_number=number if total > 1 else None,
+                estc=f'S{100000 + stc}',
+                stc_wing=_choice(rng, [(f'STC {20000 + stc}', 6), (f'Wing S{2000 + stc}', 3), (None, 1)]),
+                deep=str(stc) if rng.random() < 0.7 else None,
+                year=year,
+            )
+            year_range = convert_year_range(year)
+            if year_range and None not in year_range:
+                issue.start_date, issue.end_date = year_range
+            issues.append(issue)
+    return issues
+
+def _locations(rng, count):
+    locations = []
+    for i in range(count):
+        city, state, country, continent = rng.choice(PLACES)
+        name = rng.choice(INSTITUTIONS).format(city=city, name=rng.choice(SURNAMES))
+        location = models.Location(name=f'{name} {i + 1}', city=city, state=state, country=country, continent=continent)
+        location.sort_name = location_sort_key(location)
+        locations.append(location)
+    return locations
+
+def _provenance_names(rng, count):
+    names = []
+    for _ in range(count):
+        gender = _choice(rng, [('M', 70), ('F', 20), ('U', 8), ('X', 2)])
+        first = rng.choice(FIRST_NAMES['F' if gender == 'F' else 'M'])
+        start = _choice(rng, [('17', 30), ('18', 35), ('19', 25), ('20', 10)])
+        names.append(models.ProvenanceName(
+            name=f'{first} {rng.choice(SURNAMES)}',
+            gender=gender,
+            start_century=start,
+            end_century=str(min(int(start) + rng.randint(0, 1), 20)),
+            bio='Collector' if rng.random() < 0.3 else None,
+        ))
+    return names
+
+def _copies(rng, issues, locations, owners, count):
+    weights = [rng.paretovariate(1.5) for _ in issues]
+    copies, ownerships = [], []
+    for number, issue in enumerate(rng.choices(issues, weights, k=count), start=1):
+        census_id = _choice(rng, [(str(number), 85), (f'{number}.{rng.randint(1, 9)}', 12), (f'{number}a', 3)])
+        fragment = rng.random() < 0.05
+        copy = models.Copy(
+            issue=issue,
+            location=rng.choice(locations),
+            shelfmark=f'{rng.choice("ABCDEFGHKLMS")} {rng.randint(1, 9999)}',
+            census_id=census_id,
+            verification=_choice(rng, [('V', 70), ('U', 25), ('F', 5)]),
+            fragment=fragment,
+            from_estc=rng.random() < 0.6,
+            digital_facsimile_url=f'https://example.org/facsimile/{number}' if rng.random() < 0.3 else None,
+            binding=_choice(rng, [('Calf', 4), ('Vellum', 2), ('Morocco', 2), ('Modern', 1), (None, 3)]),
+            in_early_sammelband=rng.random() < 0.05,
+            marginalia='Annotations in an early hand.' if rng.random() < 0.15 else None,
+            provenance_notes='Bookplate.' if rng.random() < 0.2 else None,
+            height=round(rng.uniform(14, 35), 1) if not fragment else None,
+            width=round(rng.uniform(10, 24), 1) if not fragment else None,
+        )
+        copy.census_id_a, copy.census_id_b = census_id_sort_pair(census_id)
+        copy.census_id_group = census_id_sort_group(census_id)
+        copy.census_id_number = census_id_sort_number(census_id)
+        copy_owners = rng.sample(owners, min(len(owners), _choice(rng, [(0, 50), (1, 30), (2, 15), (3, 5)])))
+        copy.features = copy_features(copy, [(owner.start_century, owner.gender) for owner in copy_owners])
+        copies.append(copy)
+        ownerships.append(copy_owners)
+    return copies, ownerships
+# Copies are spread unevenly across issues, as in the real census, where a few issues have far more copies than most.
+
+STATIC_PAGES = {
+    'about': 'A census of {canonical_count} copies, {verified_copy_count} of them verified. '
+             '{facsimile_copy_percent}% have a digital facsimile. Last updated {current_date}.',
+    'references': 'References for the census.',
+    'advisoryboard': 'Members of the advisory board.',
+}
+
+CENSUS_MODELS = [
+    models.ProvenanceOwnership, models.Copy, models.Issue, models.Edition, models.Title, models.Location, models.ProvenanceName,
+]
+
+def census_is_empty(using=DEFAULT_DB_ALIAS):
+    return not any(model.objects.using(using).exists() for model in CENSUS_MODELS)
+
+def clear_census(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        for model in CENSUS_MODELS:
+            cursor.execute(f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)}')
+# Every census record is deleted directly in SQL (children first), since deleting them one by one would send
+# hundreds of thousands of signals. generate_census() then refreshes everything built from the records.
+
+def generate_census(titles=40, copies=20000, locations=400, provenance_names=3000, seed=1, using=DEFAULT_DB_ALIAS):
+    rng = random.Random(seed)
+    counter = iter(range(1, 10 ** 9))
+    with transaction.atomic(using=using):
+        title_objects = _bulk_create(models.Title, _titles(rng, titles), using)
+        editions = _bulk_create(models.Edition, [
+            models.Edition(title=title, edition_number=number, edition_format=rng.choice(FORMATS))
+            for title in title_objects for number in range(1, _choice(rng, [(1, 30), (2, 25), (4, 25), (8, 20)]) + 1)
+        ], using)
+        issues = _bulk_create(models.Issue, _issues(rng, editions, counter), using)
+        location_objects = _bulk_create(models.Location, _locations(rng, locations), using)
+        owners = _bulk_create(models.ProvenanceName, _provenance_names(rng, provenance_names), using)
+        copy_objects, copy_owners = _copies(rng, issues, location_objects, owners, copies)
+        copy_objects = _bulk_create(models.Copy, copy_objects, using)
+        _bulk_create(models.ProvenanceOwnership, [
+            models.ProvenanceOwnership(copy=copy, owner=owner)
+            for copy, owners_of_copy in zip(copy_objects, copy_owners) for owner in owners_of_copy
+        ], using)
+        for viewname, content in STATIC_PAGES.items():
+            models.StaticPageText.objects.using(using).get_or_create(viewname=viewname, defaults={'content': content})
+
+        get_search_index().rebuild(using=using)
+        invalidate_statistics(using)
+        invalidate_index(*AUTOCOMPLETE_FIELDS, using=using)
+        invalidate_search_backend(using)
+        invalidate_all_pages(using)
+        record_truncation(using)
+        schedule_snapshot(using)
+    return {
+        'titles': len(title_objects), 'editions': len(editions), 'issues': len(issues),
+        'locations': len(location_objects), 'provenance names': len(owners), 'copies': len(copy_objects),
+    }
+# This function fills the database with a made-up census of the given size. The same seed always gives the same census,
+# so benchmark results from different runs (and different branches) can be compared.
+# Records are created in batches, with the sort keys and features that save() would normally fill in worked out here.
@@ -0,0 +1,1122 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+import io
+import os
+import sqlite3
+import tempfile
+import time
+from . import jobs, models
+from .admin import CachedCountPaginator
+from .models import ChangeOperationChoices as Operation, JobStatusChoices as Status
+from .autocomplete import AutocompleteIndex, suggest
+from .bulk_import import bulk_import
+from .changes import compact, latest_change, prune_change_log, record_truncation
+from .database import check_sqlite_concurrency, connect_sqlite, sqlite_pragmas
+from .exports import EXPORTS
+from .facets import search_facets
+from .page_cache import invalidate_pages
+from .pagination import encode_cursor
+from .result_sets import RESULT_SET_CACHE, _ids_key, _query_key, pack_ids, unpack_ids
+from .search import filter_copies
+from .search_backends import MemorySearchBackend, census_data_version, invalidate_search_backend
+from .search_index import get_search_index
+from .static_site import build_site, load_manifest, output_path
+from .stats import compute_statistics, get_statistics
+from .utils import FEATURE_BITS, census_id_sort_pair, century_label, convert_year_range, feature_query
+
+
+# --- Test data ---
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class CensusTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        title = models.Title.objects.create(title='Hamlet')
+        edition = models.Edition.objects.create(title=title, edition_number=1)
+        cls.issue = models.Issue.objects.create(edition=edition, estc='S101', year='1603')
+        cls.location = models.Location.objects.create(name='The British Library', country='United Kingdom')
+        cls.owners = [
+            models.ProvenanceName.objects.create(name='Frances Wolfreston', start_century='17', gender='F'),
+            models.ProvenanceName.objects.create(name='Edward Capell', start_century='18', gender='M'),
+        ]
+        cls.copies = [cls.add_copy(cls.issue, number) for number in range(1, 4)]
+        connection.run_on_commit.clear()
+
+    @classmethod
+    def add_copy(cls, issue, number):
+        copy = models.Copy.objects.create(
+            issue=issue, location=cls.location, census_id=str(number), shelfmark=f'C.{number}', verification='V',
+        )
+        for owner in cls.owners:
+            models.ProvenanceOwnership.objects.create(copy=copy, owner=owner)
+        return copy
+
+    def setUp(self):
+        patcher = mock.patch('censusapp.database.snapshot_available', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+# The on_commit callbacks queued while the test data is created never run, since that transaction is rolled back
+# rather than committed; they are dropped so that they don't stand in for the callbacks each test's edits queue.
+# Every test starts with an empty cache of its own, so pages are built rather than served from the page cache, and
+# static files are served without the manifest that collectstatic writes. Views read census records from the test
+# database itself rather than from a published snapshot: the test "snapshot" database only mirrors "default", and a
+# second connection to it couldn't see the records each test adds.
+
+
+# --- Number of queries per page ---
+
+class QueryCountTests(CensusTestCase):
+
+    def assertQueriesDontGrow(self, num, url):
+        with self.assertNumQueries(num):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        for number in range(4, 7):
+            self.add_copy(self.issue, number)
+        cache.clear()
+        with self.assertNumQueries(num):
+            self.assertEqual(self.client.get(url).status_code, 200)
+    # The page is loaded again with twice as many copies, each with its owners, in the same number of queries.
+
+    def test_search_results(self):
+        self.assertQueriesDontGrow(6, reverse('search') + '?field=location&value=The British Library')
+
+    def test_copy_list(self):
+        self.assertQueriesDontGrow(2, reverse('copy_list', args=[self.issue.pk]))
+
+    def test_copy_data(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('copy_data', args=[self.copies[0].pk]))
+        self.assertContains(response, 'Frances Wolfreston')
+        self.assertContains(response, 'Edward Capell')
+
+
+# --- Sort keys ---
+
+class SortKeyTests(CensusTestCase):
+
+    def test_census_id_pairs(self):
+        self.assertEqual(census_id_sort_pair('12'), (12, 0))
+        self.assertEqual(census_id_sort_pair(' 12.3 '), (12, 3))
+        self.assertEqual(census_id_sort_pair(str(2 ** 63 - 1)), (2 ** 63 - 1, 0))
+        for census_id in [None, '', '12a', '12.', str(2 ** 63), '1.' + '9' * 25, '9' * 40]:
+            with self.subTest(census_id=census_id):
+                self.assertEqual(census_id_sort_pair(census_id), (None, None))
+    # Numbers too large for an integer column are treated like any other non-numeric ID.
+
+    def test_census_id_order(self):
+        for census_id in ['10', '2.1', 'b', '9' * 25, '']:
+            models.Copy.objects.create(issue=self.issue, location=self.location, census_id=census_id, verification='V')
+        response = self.client.get(reverse('search'), {'field': 'location', 'value': 'British', 'order': 'census_id'})
+        self.assertEqual(
+            [copy.census_id for copy in response.context['page']],
+            ['1', '2', '2.1', '3', '10', '9' * 25, 'b', ''],
+        )
+    # Numeric IDs come first in numeric order, then other IDs in alphabetical order, then copies without one.
+
+    def test_title_order(self):
+        for title in ['The Tempest', '1 Henry IV', 'A Midsummer Night\'s Dream']:
+            models.Title.objects.create(title=title)
+        self.assertEqual(
+            list(models.Title.objects.order_by('sort_title').values_list('title', flat=True)),
+            ['Hamlet', '1 Henry IV', 'A Midsummer Night\'s Dream', 'The Tempest'],
+        )
+    # Leading articles are ignored, and a leading number is read after the rest of the title.
+
+
+# --- Searching by year ---
+
+class YearSearchTests(CensusTestCase):
+
+    def test_year_ranges(self):
+        cases = {
+            '1623': (1623, 1623), 'c.1630': (1630, 1630), 'ca. 1630': (1630, 1630), '[1630?]': (1630, 1630),
+            '1623-1640': (1623, 1640), '1623 \u2013 1640': (1623, 1640), '1623-40': (1623, 1640), '1623/4': (1623, 1624),
+            'before 1650': (None, 1649), 'After 1700': (1701, None),
+            '[unknown]': False, '': False, None: False, '1640-1623': False, '16234': False,
+        }
+        for year, year_range in cases.items():
+            with self.subTest(year=year):
+                self.assertEqual(convert_year_range(year), year_range)
+
+    def test_issue_dates(self):
+        edition = self.issue.edition
+        issue = models.Issue.objects.create(edition=edition, estc='S103', year='1623-40')
+        self.assertEqual((issue.start_date, issue.end_date), (1623, 1640))
+        issue = models.Issue.objects.create(edition=edition, estc='S104', year='[unknown]', start_date=1610, end_date=1612)
+        self.assertEqual((issue.start_date, issue.end_date), (1610, 1612))
+    # Dates entered by hand are kept when the year can't be read.
+
+    def test_search(self):
+        edition = self.issue.edition
+        copies = {'1603': self.copies[0]}
+        for number, year in enumerate(['1623-40', 'c.1650', '[unknown]'], start=10):
+            issue = models.Issue.objects.create(edition=edition, estc=f'S{number}', year=year)
+            copies[year] = self.add_copy(issue, number)
+
+        def found(field, value):
+            pks = set(filter_copies(models.Copy.objects.all(), field, value)[0].values_list('pk', flat=True))
+            return sorted(year for year, copy in copies.items() if copy.pk in pks)
+
+        self.assertEqual(found('year', '1620-1640'), ['1623-40'])
+        self.assertEqual(found('year', '1640-1660'), ['1623-40', 'c.1650'])
+        self.assertEqual(found('year', 'c.1650'), ['c.1650'])
+        self.assertEqual(found('year', 'before 1650'), ['1603', '1623-40'])
+        self.assertEqual(found('year', 'after 1640'), ['c.1650'])
+        self.assertEqual(found('year', 'unknown'), ['[unknown]'])
+        self.assertEqual(found('century', '17'), ['1603', '1623-40', 'c.1650'])
+    # Issues with unknown dates never match a range, but text that isn't a year still finds them by their year.
+
+
+# --- Searching within results ---
+
+class ResultSetTests(CensusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        folger = models.Location.objects.create(name='Folger Shakespeare Library', country='United States')
+        self.folger_copy = models.Copy.objects.create(issue=self.issue, location=folger, census_id='4', verification='V')
+        self.folger_copy.provenance_names.add(*self.owners)
+
+    def search(self, field, value, within=None):
+        params = {'field': field, 'value': value, **({'within': within} if within else {})}
+        response = self.client.get(reverse('search'), params)
+        self.assertEqual(response.status_code, 200)
+        return {copy.pk for copy in response.context['page']}, response.context
+
+    def test_packed_ids(self):
+        ids = [7, 3, 2 ** 40, 12]
+        self.assertEqual(unpack_ids(pack_ids(ids)), sorted(ids))
+        self.assertEqual(unpack_ids(pack_ids([])), [])
+
+    def test_search_within_results(self):
+        _, context = self.search('location', 'British')
+        token = context['result_token']
+        self.assertEqual(self.search('location', 'British')[1]['result_token'], token)
+
+        everyone, _ = self.search('provenance_name', 'Wolfreston')
+        self.assertEqual(everyone, {copy.pk for copy in self.copies} | {self.folger_copy.pk})
+        within, context = self.search('provenance_name', 'Wolfreston', within=token)
+        self.assertEqual(within, {copy.pk for copy in self.copies})
+        self.assertEqual(context['initial_field'], 'location')
+
+        self.assertEqual(len(self.search('keyword', 'Capell')[0]), 4)
+        refined, _ = self.search('keyword', 'Capell', within=context['result_token'])
+        self.assertEqual(refined, {copy.pk for copy in self.copies})
+    # The same search always gets the same token, and tokens can refine results that were themselves refined.
+
+    def test_evicted_ids_are_rebuilt(self):
+        token = self.search('location', 'British')[1]['result_token']
+        self.search('provenance_name', 'Wolfreston', within=token)
+        caches[RESULT_SET_CACHE].delete(_ids_key(token))
+        within, _ = self.search('provenance_name', 'Wolfreston', within=token)
+        self.assertEqual(within, {copy.pk for copy in self.copies})
+        self.assertIsNotNone(caches[RESULT_SET_CACHE].get(_ids_key(token)))
+
+    def test_expired_tokens_are_ignored(self):
+        token = self.search('location', 'British')[1]['result_token']
+        caches[RESULT_SET_CACHE].delete(_query_key(token))
+        for within in (token, 'unknown'):
+            with self.subTest(within=within):
+                copies, context = self.search('provenance_name', 'Wolfreston', within=within)
+                self.assertEqual(len(copies), 4)
+                self.assertIsNone(context['initial_field'])
+    # Once the query behind a token has expired, the search runs over the whole census again.
+
+
+# --- Keyword Search index ---
+
+class KeywordIndexTests(CensusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.assertTrue(get_search_index().is_available())
+        self.owner = models.ProvenanceName.objects.create(name='Elizabeth Pepys')
+
+    def keyword_search(self, value):
+        response = self.client.get(reverse('search'), {'field': 'keyword', 'value': value})
+        return {copy.pk for copy in response.context['page']}
+
+    def test_owners_added_to_a_copy(self):
+        copy = self.copies[0]
+        copy.provenance_names.add(self.owner)
+        self.assertEqual(self.keyword_search('Pepys'), {copy.pk})
+        copy.provenance_names.remove(self.owner)
+        self.assertEqual(self.keyword_search('Pepys'), set())
+
+    def test_copies_added_to_an_owner(self):
+        self.owner.copy_set.add(*self.copies[:2])
+        self.assertEqual(self.keyword_search('Pepys'), {copy.pk for copy in self.copies[:2]})
+        self.owner.copy_set.remove(self.copies[0])
+        self.assertEqual(self.keyword_search('Pepys'), {self.copies[1].pk})
+        self.owner.copy_set.clear()
+        self.assertEqual(self.keyword_search('Pepys'), set())
+
+    def test_renamed_owners(self):
+        models.ProvenanceOwnership.objects.create(copy=self.copies[2], owner=self.owner)
+        self.owner.name = 'Samuel Pepys'
+        self.owner.save()
+        self.assertEqual(self.keyword_search('Samuel'), {self.copies[2].pk})
+# Keyword Search reads owners' names from the full-text index, which must follow every way of changing them.
+
+
+# --- Search backends ---
+
+class SearchBackendTests(CensusTestCase):
+
+    def test_data_version_moves_on_once_committed(self):
+        version = census_data_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_copy(self.issue, 4)
+            self.copies[0].save()
+            self.assertEqual(census_data_version(), version)
+        self.assertNotEqual(census_data_version(), version)
+
+    def test_memory_backend_follows_edits(self):
+        backend = MemorySearchBackend()
+        results, _, _ = backend.filter(backend.all_copies(), 'location', 'british')
+        self.assertEqual(results.count(), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_copy(self.issue, 4)
+        results, _, _ = backend.filter(backend.all_copies(), 'location', 'british')
+        self.assertEqual(results.count(), 4)
+
+
+# --- Paging through search results ---
+
+class KeysetPaginationTests(CensusTestCase):
+
+    def search(self, **params):
+        query = {'field': 'location', 'value': 'British Library', 'order': 'date', 'page_size': 2, **params}
+        response = self.client.get(reverse('search'), query)
+        self.assertEqual(response.status_code, 200)
+        return [copy.pk for copy in response.context['page']], response.context['page']
+
+    def test_pages_follow_on(self):
+        first, page = self.search()
+        second, next_page = self.search(after=page.next_cursor)
+        self.assertEqual(first + second, [copy.pk for copy in self.copies])
+        self.assertIsNone(next_page.next_cursor)
+        self.assertEqual(self.search(before=next_page.previous_cursor)[0], first)
+
+    def test_unreadable_cursors_give_the_first_page(self):
+        first, _ = self.search()
+        cursors = [
+            'not a cursor',
+            encode_cursor(['x', 'Hamlet', 'British Library', 1]),
+            encode_cursor([1603, 'Hamlet', 'British Library', 'x']),
+            encode_cursor([1e300, 'Hamlet', 'British Library', 1]),
+            encode_cursor([1603, 'Hamlet']),
+        ]
+        for cursor in cursors:
+            for direction in ('after', 'before'):
+                with self.subTest(cursor=cursor, direction=direction):
+                    self.assertEqual(self.search(**{direction: cursor})[0], first)
+    # A cursor is only used if each of its values suits its sort key: here a year, a title, a location and an id.
+
+
+# --- Search facets ---
+
+class FacetTests(CensusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tempest = models.Title.objects.create(title='The Tempest')
+        tempest_issue = models.Issue.objects.create(
+            edition=models.Edition.objects.create(title=tempest, edition_number=1), estc='S202', year='1623',
+        )
+        later_issue = models.Issue.objects.create(edition=self.issue.edition, estc='S103', year='1702')
+        folger = models.Location.objects.create(
+            name='Folger Shakespeare Library', country=' United States ', continent='North America',
+        )
+        huntington = models.Location.objects.create(
+            name='Huntington Library', country='United States', continent='North America',
+        )
+        models.Copy.objects.create(
+            issue=tempest_issue, location=folger, verification='U', fragment=True, marginalia='Annotated',
+            digital_facsimile_url='https://example.com/facsimile',
+        )
+        models.Copy.objects.create(issue=later_issue, location=huntington, verification='V')
+        self.results = models.Copy.objects.filter(
+            Q(provenance_names__in=self.owners) | Q(location__continent='North America'),
+        )
+
+    def counts(self):
+        return {f['field']: [(o['value'], o['count']) for o in f['options']] for f in search_facets(self.results)}
+
+    def test_counts(self):
+        with self.assertNumQueries(4):
+            counts = self.counts()
+        self.assertEqual(counts, {
+            'century': [('17', 4), ('18', 1)],
+            'continent': [('North America', 2)],
+            'country': [('United Kingdom', 3), ('United States', 2)],
+            'title': [(str(self.issue.edition.title_id), 4), (str(models.Title.objects.get(title='The Tempest').pk), 1)],
+            'verification': [('V', 4), ('U', 1)],
+            'fragment': [('no', 4), ('yes', 1)],
+            'facsimile': [('yes', 1), ('no', 4)],
+            'collection': [('earlyprovenance', 3), ('womanowner', 3), ('earlywomanowner', 3), ('marginalia', 1)],
+        })
+    # Copies with two owners match the search twice but are counted once, and options with no copies are left out.
+    # Both spellings of "United States" are counted together.
+
+    def test_largest_options(self):
+        with mock.patch('censusapp.facets.FACET_LIMIT', 1):
+            counts = self.counts()
+        self.assertEqual(counts['country'], [('United Kingdom', 3)])
+        self.assertEqual(counts['title'], [(str(self.issue.edition.title_id), 4)])
+
+    def test_drill_down(self):
+        copies, display_field, display_value = filter_copies(models.Copy.objects.all(), 'country', 'United States')
+        self.assertEqual(copies.count(), 2)
+        copies, display_field, display_value = filter_copies(models.Copy.objects.all(), 'century', '18')
+        self.assertEqual((copies.count(), display_value), (1, century_label(18)))
+    # Drilling down into an option finds the copies it counted.
+
+
+# --- Specific Features ---
+
+class FeatureTests(CensusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.copy = models.Copy.objects.create(issue=self.issue, location=self.location, verification='V')
+        self.early_woman = FEATURE_BITS['earlyprovenance'] | FEATURE_BITS['womanowner'] | FEATURE_BITS['earlywomanowner']
+
+    def features(self, copy):
+        return models.Copy.objects.get(pk=copy.pk).features
+
+    def test_owners_changed_through_the_copy(self):
+        frances, edward = self.owners
+        self.copy.provenance_names.add(edward)
+        self.assertEqual(self.features(self.copy), 0)
+        self.copy.provenance_names.add(frances)
+        self.assertEqual(self.features(self.copy), self.early_woman)
+        self.copy.provenance_names.remove(frances)
+        self.assertEqual(self.features(self.copy), 0)
+        self.copy.provenance_names.add(frances)
+        self.copy.provenance_names.clear()
+        self.assertEqual(self.features(self.copy), 0)
+
+    def test_owners_changed_through_the_owner(self):
+        frances = self.owners[0]
+        frances.copy_set.add(self.copy)
+        self.assertEqual(self.features(self.copy), self.early_woman)
+        frances.copy_set.remove(self.copy)
+        self.assertEqual(self.features(self.copy), 0)
+        frances.copy_set.add(self.copy)
+        frances.copy_set.clear()
+        self.assertEqual([self.features(copy) for copy in [self.copy, *self.copies]], [0, 0, 0, 0])
+    # Clearing an owner's copies changes every copy it owned.
+
+    def test_ownership_records(self):
+        ownership = models.ProvenanceOwnership.objects.create(copy=self.copy, owner=self.owners[0])
+        self.assertEqual(self.features(self.copy), self.early_woman)
+        ownership.delete()
+        self.assertEqual(self.features(self.copy), 0)
+
+    def test_owner_saved(self):
+        frances = self.owners[0]
+        frances.start_century = '19'
+        frances.save()
+        self.assertEqual(self.features(self.copies[0]), FEATURE_BITS['womanowner'])
+        frances.gender = 'M'
+        frances.save()
+        self.assertEqual(self.features(self.copies[0]), 0)
+
+    def test_copy_saved(self):
+        copy = self.copies[0]
+        copy.marginalia = 'Annotated'
+        copy.verification = 'U'
+        copy.save()
+        self.assertEqual(self.features(copy), self.early_woman | FEATURE_BITS['marginalia'] | FEATURE_BITS['unverified'])
+        copy.marginalia = ''
+        copy.save()
+        self.assertEqual(self.features(copy), self.early_woman | FEATURE_BITS['unverified'])
+    # Saving a copy works out its own features again, and keeps those that come from its owners, even when its owners
+    # were added after it was loaded.
+
+    def test_feature_query(self):
+        copy = self.copies[0]
+        copy.marginalia = 'Annotated'
+        copy.save()
+        self.assertEqual(list(models.Copy.objects.filter(feature_query('marginalia', 'womanowner'))), [copy])
+        self.assertEqual(models.Copy.objects.filter(feature_query('womanowner')).count(), 3)
+        self.assertEqual(models.Copy.objects.filter(feature_query('earlysammelband')).count(), 0)
+
+
+# --- JSON API ---
+
+class ApiTests(CensusTestCase):
+
+    def get(self, resource, status=200, **params):
+        response = self.client.get(reverse('api_list', args=[resource]), params)
+        self.assertEqual(response.status_code, status, response.content)
+        return response.json()
+
+    def test_sparse_fields(self):
+        data = self.get('copies', fields='census_id,shelfmark')['data']
+        self.assertEqual(data, [
+            {'id': copy.pk, 'census_id': copy.census_id, 'shelfmark': copy.shelfmark} for copy in self.copies
+        ])
+
+    def test_included_records(self):
+        payload = self.get('copies', fields='census_id', include='issue.edition.title,provenance_names')
+        self.assertEqual([issue['id'] for issue in payload['included']['issues']], [self.issue.pk])
+        self.assertEqual([title['title'] for title in payload['included']['titles']], ['Hamlet'])
+        self.assertEqual(
+            [owner['name'] for owner in payload['included']['provenance_names']],
+            ['Frances Wolfreston', 'Edward Capell'],
+        )
+    # Each related record is sent once, however many copies refer to it.
+
+    def test_pages_follow_on(self):
+        ids, url = [], reverse('api_list', args=['copies']) + '?page_size=2&order=date'
+        while url:
+            payload = self.client.get(url).json()
+            ids += [copy['id'] for copy in payload['data']]
+            url = payload['links']['next']
+        self.assertEqual(ids, [copy.pk for copy in self.copies])
+
+    def test_resume_link_finds_new_records(self):
+        resume = self.get('copies')['links']['resume']
+        self.assertEqual(self.client.get(resume).json()['data'], [])
+        copy = self.add_copy(self.issue, 4)
+        self.assertEqual([record['id'] for record in self.client.get(resume).json()['data']], [copy.pk])
+
+    def test_unusable_cursors_are_refused(self):
+        cases = [
+            ('copies', {'after': encode_cursor(['x'])}),
+            ('copies', {'before': encode_cursor(['x'])}),
+            ('issues', {'after': encode_cursor(['x'])}),
+            ('copies', {'order': 'date', 'after': encode_cursor(['x', 'Hamlet', 'British Library', 1])}),
+            ('copies', {'order': 'date', 'after': encode_cursor([1e300, 'Hamlet', 'British Library', 1])}),
+            ('copies', {'after': 'not a cursor'}),
+        ]
+        for resource, params in cases:
+            with self.subTest(resource=resource, params=params):
+                self.assertIn('cursor', self.get(resource, status=400, **params)['error'])
+
+    def test_bad_requests(self):
+        self.get('volumes', status=400)
+        self.get('copies', status=400, fields='nonpublic_notes')
+        self.get('copies', status=400, include='owner')
+        self.get('copies', status=400, order='relevance')
+        self.get('editions', status=400, title='x')
+        self.assertEqual(self.client.get(reverse('api_detail', args=['copies', 2 ** 63])).status_code, 404)
+
+    def test_record(self):
+        response = self.client.get(reverse('api_detail', args=['copies', self.copies[0].pk]), {'include': 'location'})
+        self.assertEqual(response.json()['data']['census_id'], '1')
+        self.assertEqual(response.json()['included']['locations'][0]['name'], 'The British Library')
+
+    def test_unchanged_lists_are_not_sent_again(self):
+        url = reverse('api_list', args=['copies'])
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_copy(self.issue, 4)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+# --- Cached pages ---
+
+class PageCacheTests(CensusTestCase):
+
+    def test_cached_pages_expire_once_edits_are_committed(self):
+        url = reverse('copy_list', args=[self.issue.pk])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertNotContains(self.client.get(url), 'C.99')
+        with self.captureOnCommitCallbacks(execute=True):
+            copy = self.copies[0]
+            copy.shelfmark = 'C.99'
+            copy.save()
+            self.assertNotContains(self.client.get(url), 'C.99')
+        self.assertContains(self.client.get(url), 'C.99')
+    # Until the edit is committed, other visitors still read the page as it was, so it stays cached.
+
+    def test_pages_of_moved_copies(self):
+        edition = models.Edition.objects.create(title=self.issue.edition.title, edition_number=2)
+        other_issue = models.Issue.objects.create(edition=edition, estc='S102', year='1604')
+        urls = [reverse('copy_list', args=[self.issue.pk]), reverse('copy_list', args=[other_issue.pk])]
+        for url in urls:
+            self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            copy = self.copies[0]
+            copy.issue = other_issue
+            copy.shelfmark = 'C.99'
+            copy.save()
+        self.assertNotContains(self.client.get(urls[0]), 'C.99')
+        self.assertContains(self.client.get(urls[1]), 'C.99')
+    # A copy moved to another issue leaves the list of copies of both issues.
+
+    def test_owners_changed_through_the_copy(self):
+        url = reverse('copy_data', args=[self.copies[0].pk])
+        self.client.get(url)
+        owner = models.ProvenanceName.objects.create(name='Elizabeth Pepys')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.copies[0].provenance_names.add(owner)
+        self.assertContains(self.client.get(url), 'Elizabeth Pepys')
+
+
+# --- Conditional GETs ---
+
+class ConditionalGetTests(CensusTestCase):
+
+    def test_not_modified(self):
+        url = reverse('copy_list', args=[self.issue.pk])
+        response = self.client.get(url)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            not_modified = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+    # A page that is still current is answered from its cached versions, without running the view.
+
+    def test_modified(self):
+        url = reverse('copy_list', args=[self.issue.pk])
+        response = self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            copy = self.copies[0]
+            copy.shelfmark = 'C.99'
+            copy.save()
+        modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(modified.status_code, 200)
+        self.assertContains(modified, 'C.99')
+        self.assertNotEqual(modified['ETag'], response['ETag'])
+
+    def test_staff(self):
+        url = reverse('copy_list', args=[self.issue.pk])
+        etag = self.client.get(url)['ETag']
+        staff = User.objects.create_user('staff', password='password', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+    # Staff see pages with edit links, so they never get the page a visitor's browser kept, nor share one with a proxy.
+
+
+# --- Census statistics ---
+
+class StatisticsTests(CensusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        models.Copy.objects.create(
+            issue=self.issue, location=self.location, verification='U', fragment=True, from_estc=True,
+            digital_facsimile_url='https://example.com/facsimile',
+        )
+        models.Copy.objects.create(issue=self.issue, location=self.location, verification='F')
+
+    def test_counts(self):
+        self.assertEqual(compute_statistics(), {
+            'canonical_count': 4, 'copy_count': 3, 'fragment_copy_count': 1, 'verified_copy_count': 3,
+            'unverified_copy_count': 1, 'estc_copy_count': 1, 'non_estc_copy_count': 3, 'facsimile_copy_count': 1,
+            'facsimile_copy_percent': '25%',
+        })
+    # Ghost copies are never counted.
+
+    def test_counted_once_until_an_edit_is_committed(self):
+        with self.assertNumQueries(1):
+            get_statistics()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_statistics()['canonical_count'], 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_copy(self.issue, 4)
+            self.assertEqual(get_statistics()['canonical_count'], 4)
+        self.assertEqual(get_statistics()['canonical_count'], 5)
+
+    def test_info_pages(self):
+        models.StaticPageText.objects.create(viewname='about', content='{copy_count} copies, {facsimile_copy_percent}')
+        url = reverse('info', args=['about'])
+        self.assertContains(self.client.get(url), '3 copies, 25%')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_copy(self.issue, 4)
+        self.assertContains(self.client.get(url), '4 copies, 20%')
+
+
+# --- Search autofill ---
+
+class AutocompleteTests(CensusTestCase):
+
+    def test_matches(self):
+        index = AutocompleteIndex([
+            'The British Library', 'British Library', 'Bibliothèque nationale de France', 'Zentralbibliothek Zürich',
+            'Brown University', '', None,
+        ])
+        self.assertEqual(index.suggest('brit'), ['British Library', 'The British Library'])
+        self.assertEqual(index.suggest('lib brit'), ['British Library', 'The British Library'])
+        self.assertEqual(index.suggest('ZURICH'), ['Zentralbibliothek Zürich'])
+        self.assertEqual(index.suggest('bibliotheque nat'), ['Bibliothèque nationale de France'])
+        self.assertEqual(index.suggest('br', limit=2), ['British Library', 'Brown University'])
+        self.assertEqual(index.suggest('ibrary'), [])
+        self.assertEqual(index.suggest(' - '), [])
+    # Every word of the query must start a word of the value, and values that start with the query rank first.
+
+    def test_views(self):
+        response = self.client.get(reverse('autofill_location', args=['brit']))
+        self.assertEqual(response.json(), {'matches': ['The British Library']})
+        self.assertIn('public', response['Cache-Control'])
+        response = self.client.get(reverse('autofill_geography', args=['united']))
+        self.assertEqual(response.json(), {'matches': ['United Kingdom']})
+        response = self.client.get(reverse('autofill_provenance', args=['wolf']))
+        self.assertEqual(response.json(), {'matches': ['Frances Wolfreston']})
+
+    def test_rebuilt_once_an_edit_is_committed(self):
+        self.assertEqual(suggest('location', 'folger'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            location = models.Location.objects.create(name='Folger Shakespeare Library', country='United States')
+            self.assertEqual(suggest('location', 'folger'), [])
+        self.assertEqual(suggest('location', 'folger'), ['Folger Shakespeare Library'])
+        self.assertEqual(suggest('geography', 'united'), ['United States', 'United Kingdom'])
+        with self.captureOnCommitCallbacks(execute=True):
+            location.delete()
+        self.assertEqual(suggest('location', 'folger'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.owners[0].name = 'Frances Wolfreston (née Middlemore)'
+            self.owners[0].save()
+        self.assertEqual(suggest('provenance', 'middlemore'), ['Frances Wolfreston (née Middlemore)'])
+    # An index rebuilt by a request during the edit still holds the old values, and is rebuilt again after it.
+
+
+# --- CSV exports ---
+
+class CsvExportTests(CensusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        folger = models.Location.objects.create(name='Folger Shakespeare Library', country='United States')
+        edition = models.Edition.objects.create(title=models.Title.objects.create(title='The Tempest'), edition_number=1)
+        issue = models.Issue.objects.create(edition=edition, estc='S202', year='1623')
+        copy = models.Copy.objects.create(issue=issue, location=folger, census_id='4', verification='V')
+        copy.provenance_names.add(self.owners[0])
+        ghost = models.Copy.objects.create(issue=self.issue, location=folger, census_id='5', verification='F')
+        ghost.provenance_names.add(self.owners[1])
+
+    def test_rows(self):
+        expected = {
+            'location_copy_count': [['Folger Shakespeare Library', 1], ['The British Library', 3]],
+            'title_copy_count': [['Hamlet', 3], ['The Tempest', 1]],
+            'edition_copy_count': [['Hamlet Edition 1', 3], ['The Tempest Edition 1', 1]],
+            'issue_copy_count': [['Hamlet (ESTC S101)', 3], ['The Tempest (ESTC S202)', 1]],
+            'provenance_name_copy_count': [
+                ['Edward Capell', None, None, 'M', '18', None, 3],
+                ['Frances Wolfreston', None, None, 'F', '17', None, 4],
+            ],
+        }
+        for name, rows in expected.items():
+            with self.subTest(name=name):
+                with self.assertNumQueries(1):
+                    self.assertEqual(list(EXPORTS[name]())[1:], rows)
+    # Each export is one grouped query, however many copies there are. Ghost copies are never counted.
+
+    def download(self, name):
+        response = self.client.get(reverse(name))
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_visitors_never_queue_jobs(self):
+        self.assertEqual(self.download('title_copy_count'), 'Title,Number of Copies\r\nHamlet,3\r\nThe Tempest,1\r\n')
+        self.assertFalse(models.CensusJob.objects.filter(kind='title_copy_count').exists())
+
+    def test_staff_queue_one_job(self):
+        self.client.force_login(User.objects.create_user('curator', is_staff=True))
+        self.download('title_copy_count')
+        self.download('title_copy_count')
+        jobs = models.CensusJob.objects.filter(kind='title_copy_count')
+        self.assertEqual(list(jobs.values_list('status', flat=True)), [models.JobStatusChoices.QUEUED])
+    # Until a worker has written the export, each download is streamed, and the waiting job is shared.
+
+
+# --- Admin copy list ---
+
+class CopyAdminTests(CensusTestCase):
+
+    def test_order(self):
+        for census_id in ['12.3', 'b', '', '12.10', '2.1']:
+            models.Copy.objects.create(issue=self.issue, location=self.location, census_id=census_id, verification='V')
+        antony = models.Title.objects.create(title='Antony and Cleopatra')
+        edition = models.Edition.objects.create(title=antony, edition_number=1)
+        issue = models.Issue.objects.create(edition=edition, estc='S301', year='1623')
+        models.Copy.objects.create(issue=issue, location=self.location, census_id='99', verification='V')
+        self.client.force_login(User.objects.create_superuser('admin', password='password'))
+        response = self.client.get(reverse('admin:censusapp_copy_changelist'))
+        self.assertEqual(
+            [copy.census_id for copy in response.context['cl'].result_list],
+            ['99', '1', '2', '2.1', '3', '12.10', '12.3', '', 'b'],
+        )
+    # Copies are listed by title, then by the number their ID starts with, then by ID.
+
+    def test_cached_count(self):
+        paginator = CachedCountPaginator(models.Copy.objects.order_by('census_id'), 2)
+        self.assertEqual(paginator.count, 3)
+        self.assertEqual([copy.census_id for copy in paginator.page(2)], ['3'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_copy(self.issue, 4)
+            with self.assertNumQueries(0):
+                self.assertEqual(CachedCountPaginator(models.Copy.objects.order_by('census_id'), 2).count, 3)
+        paginator = CachedCountPaginator(models.Copy.objects.order_by('census_id'), 2)
+        self.assertEqual(paginator.count, 4)
+        self.assertEqual([copy.census_id for copy in paginator.page(2)], ['3', '4'])
+    # The count is kept until an edit to the census is committed.
+
+
+# --- Bulk imports ---
+
+class BulkImportTests(CensusTestCase):
+
+    def csv(self):
+        return io.StringIO(
+            'id,shelfmark,census_id,verification,marginalia,issue__estc,location__name\n'
+            f'{self.copies[0].pk},C.99,1,V,,S101,The British Library\n'
+            ',C.10,10,V,Annotated,S101,the british library \n'
+            ',C.11,11,V,,S999,The British Library\n'
+        )
+
+    def test_import(self):
+        logged = models.ChangeLogEntry.objects.order_by('pk').last().pk
+        with self.captureOnCommitCallbacks(execute=True):
+            report = bulk_import('copies', self.csv(), 'copies.csv')
+        self.assertEqual((report.rows, len(report.created), len(report.updated)), (3, 1, 1))
+        self.assertEqual(report.errors, [(4, 'issue: There is no issue matching s999.')])
+        copy = models.Copy.objects.get(pk=report.created[0])
+        self.assertEqual((copy.location, copy.census_id_a, copy.features), (self.location, 10, FEATURE_BITS['marginalia']))
+        self.assertEqual(models.Copy.objects.get(pk=self.copies[0].pk).shelfmark, 'C.99')
+        self.assertEqual(
+            set(models.ChangeLogEntry.objects.filter(pk__gt=logged).values_list('resource', 'object_id', 'operation')),
+            {('copies', copy.pk, Operation.CREATE), ('copies', self.copies[0].pk, Operation.UPDATE)},
+        )
+        self.assertEqual(get_statistics()['copy_count'], 4)
+    # Invalid rows are reported and skipped, and the rest are imported. Natural keys ignore case and spaces.
+
+    def test_rolled_back_on_error(self):
+        entries = models.ChangeLogEntry.objects.count()
+        with mock.patch('censusapp.bulk_import.refresh_copy_features', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                bulk_import('copies', self.csv(), 'copies.csv', batch_size=1)
+        self.assertEqual(models.Copy.objects.count(), 3)
+        self.assertEqual(models.Copy.objects.get(pk=self.copies[0].pk).shelfmark, 'C.1')
+        self.assertEqual(models.ChangeLogEntry.objects.count(), entries)
+    # Batches already written are rolled back with the rest when a later step fails, so nothing is left half done.
+
+    def test_dry_run(self):
+        report = bulk_import('copies', self.csv(), 'copies.csv', dry_run=True)
+        self.assertTrue(report.summary().startswith('Dry run: would have added 1 and updated 1 copies'))
+        self.assertEqual(models.Copy.objects.count(), 3)
+        self.assertEqual(models.Copy.objects.get(pk=self.copies[0].pk).shelfmark, 'C.1')
+
+
+# --- Change feed ---
+
+class ChangeFeedTests(CensusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.since = latest_change()
+        copy = self.copies[0]
+        copy.shelfmark = 'C.99'
+        copy.save()
+        location = models.Location.objects.create(name='Folger Shakespeare Library')
+        self.location_id = location.pk
+        location.delete()
+        self.copies[1].provenance_names.remove(self.owners[0])
+
+    def feed(self, since, **params):
+        response = self.client.get(reverse('api_changes'), {'since': since, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def records(self, since):
+        feed = self.feed(since)
+        self.assertFalse(feed['reset'])
+        return [(change['resource'], change['id'], change['operation']) for change in feed['changes']]
+
+    def test_since(self):
+        self.assertEqual(self.records(self.since), [
+            ('copies', self.copies[0].pk, 'updated'),
+            ('locations', self.location_id, 'created'),
+            ('locations', self.location_id, 'deleted'),
+            ('copies', self.copies[1].pk, 'updated'),
+        ])
+        seen = []
+        feed = {'next_since': self.since, 'has_more': True}
+        while feed['has_more']:
+            feed = self.feed(feed['next_since'], limit=3)
+            seen.extend(change['seq'] for change in feed['changes'])
+        self.assertEqual(len(seen), 4)
+        self.assertEqual(feed['next_since'], latest_change())
+        self.assertEqual(self.feed(feed['next_since'])['changes'], [])
+    # Owners removed through the copy are listed as an update to the copy.
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(reverse('api_changes'), {'since': 'x'}).status_code, 400)
+        self.assertEqual(self.feed('9' * 30)['changes'], [])
+
+    def test_compaction(self):
+        copy = self.copies[0]
+        copy.shelfmark = 'C.100'
+        copy.save()
+        models.ChangeLogEntry.objects.update(changed_at=timezone.now() - timedelta(days=2))
+        compact()
+        self.assertEqual(self.records(self.since), [
+            ('locations', self.location_id, 'deleted'),
+            ('copies', self.copies[1].pk, 'updated'),
+            ('copies', self.copies[0].pk, 'updated'),
+        ])
+    # Only the latest change to each record is kept, which is all a mirror needs to catch up.
+
+    def test_truncation(self):
+        models.ChangeLogEntry.objects.filter(pk__lte=self.since + 2).update(changed_at=timezone.now() - timedelta(days=100))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(prune_change_log(), (self.since + 2, 0))
+        feed = self.feed(self.since)
+        self.assertEqual((feed['reset'], feed['changes'], feed['next_since']), (True, [], latest_change()))
+        self.assertEqual(len(self.records(self.since + 2)), 2)
+        record_truncation()
+        self.assertTrue(self.feed(self.since + 2)['reset'])
+        self.assertEqual(self.records(latest_change()), [])
+    # A mirror further behind than the log reaches is told to copy the census again, and to carry on from next_since.
+    # Replacing the whole census truncates the log for every mirror.
+
+
+# --- Static site ---
+
+class StaticSiteTests(CensusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.output_dir = Path(temp_dir.name, 'site')
+
+    def build(self):
+        return build_site(self.output_dir, workers=1)
+
+    def page(self, viewname, *args):
+        return output_path(self.output_dir, reverse(viewname, args=args))
+
+    def test_build(self):
+        totals = self.build()
+        self.assertEqual(totals, {'pages': 10, 'written': 10, 'unchanged': 0, 'removed': 0, 'failed': {}})
+        self.assertTrue((self.output_dir / 'index.html').exists())
+        path = self.page('copy_list', self.issue.pk)
+        self.assertIn('C.2', path.read_text())
+        self.assertTrue(Path(f'{path}.gz').exists())
+        self.assertTrue(self.page('single_copy', '3').exists())
+        self.assertTrue(load_manifest(self.output_dir)['pages'])
+        self.assertFalse(any(path.name.endswith('.tmp') for path in self.output_dir.rglob('*')))
+    # The manifest is kept outside the site, so that it is never served.
+
+    def test_only_changed_pages_are_written_again(self):
+        self.build()
+        self.assertEqual(self.build()['written'], 0)
+        copy = self.copies[0]
+        copy.shelfmark = 'C.99'
+        copy.save()
+        totals = self.build()
+        self.assertEqual((totals['written'], totals['unchanged']), (4, 6))
+        self.assertIn('C.99', self.page('copy_list', self.issue.pk).read_text())
+        self.assertIn('C.99', self.page('copy_data', copy.pk).read_text())
+    # Saving a copy writes its two copy pages again, and the pages of its issue and title.
+
+    def test_deleted_pages_are_removed(self):
+        self.build()
+        copy = self.copies[2]
+        paths = [self.page('copy_data', copy.pk), self.page('single_copy', copy.census_id)]
+        copy.delete()
+        totals = self.build()
+        self.assertEqual(totals['removed'], 2)
+        for path in paths:
+            self.assertFalse(path.exists())
+            self.assertFalse(Path(f'{path}.gz').exists())
+            self.assertFalse(path.parent.exists())
+        self.assertNotIn('C.3', self.page('copy_list', self.issue.pk).read_text())
+
+    def test_full_build_after_the_log_is_truncated(self):
+        self.build()
+        record_truncation()
+        self.assertEqual(self.build()['written'], 10)
+
+
+# --- Census jobs ---
+
+class JobQueueTests(CensusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        patcher = mock.patch('censusapp.jobs.JOB_DIR', Path(temp_dir.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        models.CensusJob.objects.all().delete()
+
+    def job(self, job):
+        return models.CensusJob.objects.get(pk=job.pk)
+
+    def test_enqueue(self):
+        job = jobs.enqueue('statistics')
+        self.assertEqual(jobs.enqueue('statistics'), job)
+        self.assertEqual(jobs.enqueue('statistics', priority=50).priority, 50)
+        self.assertEqual(models.CensusJob.objects.count(), 1)
+        with self.assertRaises(ValueError):
+            jobs.enqueue('nothing')
+        with self.assertRaises(ValueError):
+            jobs.enqueue('import', {'kind': 'copies'})
+    # A job already waiting to run isn't queued twice.
+
+    def test_claim(self):
+        dump = jobs.enqueue('dump')
+        statistics = jobs.enqueue('statistics')
+        job = jobs.next_job('worker-a')
+        self.assertEqual(job, statistics)
+        job = self.job(job)
+        self.assertEqual((job.status, job.worker, job.attempts), (Status.RUNNING, 'worker-a', 1))
+        self.assertIsNone(jobs.run_job(job, worker='worker-b'))
+        self.assertEqual(jobs.next_job('worker-b'), dump)
+        self.assertIsNone(jobs.next_job('worker-c'))
+    # The job with the highest priority is taken first, and a job that has been claimed can't be claimed again.
+
+    def test_run(self):
+        job = jobs.run_job(jobs.enqueue('title_copy_count'), workers=1, worker='worker-a')
+        self.assertEqual((job.status, job.result), (Status.DONE, {'rows': 1, 'shards': 1}))
+        path = jobs.current_artifact('title_copy_count')
+        self.assertEqual(path, jobs.artifact_path(job))
+        self.assertEqual(path.read_text(encoding='utf-8').splitlines()[1:], ['Hamlet,3'])
+        self.add_copy(self.issue, 4)
+        self.assertIsNone(jobs.current_artifact('title_copy_count'))
+    # A finished export is only served until the census changes.
+
+    def test_retry(self):
+        failing = mock.Mock(side_effect=RuntimeError('No room left'))
+        job = jobs.enqueue('statistics', max_attempts=2)
+        with mock.patch.dict('censusapp.jobs.JOB_KINDS', {'statistics': failing}):
+            started = timezone.now()
+            job = jobs.run_job(job, workers=1, worker='worker-a')
+            self.assertEqual((job.status, job.attempts, job.worker), (Status.QUEUED, 1, ''))
+            self.assertIn('No room left', job.error)
+            self.assertGreaterEqual(job.run_after, started + timedelta(seconds=jobs.JOB_RETRY_DELAY))
+            self.assertIsNone(jobs.next_job('worker-a'))
+            models.CensusJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            self.assertEqual(jobs.run_queued_jobs(workers=1, worker='worker-a'), [job])
+        job = self.job(job)
+        self.assertEqual((job.status, job.attempts), (Status.FAILED, 2))
+    # A failed job waits before it is tried again, and fails for good once it has used up its attempts.
+
+    def test_stalled(self):
+        job = jobs.enqueue('statistics')
+        jobs.next_job('worker-a')
+        models.CensusJob.objects.filter(pk=job.pk).update(
+            heartbeat_at=timezone.now() - timedelta(seconds=jobs.JOB_STALLED_AFTER + 1),
+        )
+        stalled = self.job(job)
+        jobs.requeue_stalled()
+        job = self.job(job)
+        self.assertEqual((job.status, job.attempts), (Status.QUEUED, 1))
+        self.assertIn('worker-a', job.error)
+        models.CensusJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertEqual(jobs.next_job('worker-b'), job)
+        jobs._failed(stalled, 'Late')
+        job = self.job(job)
+        self.assertEqual((job.status, job.worker, job.attempts), (Status.RUNNING, 'worker-b', 2))
+    # A worker that was taken for dead and comes back later can't change what has happened to its job since.
+
+
+# --- Pages read from a snapshot ---
+
+class SnapshotValidatorTests(CensusTestCase):
+
+    def test_pages_from_an_older_snapshot_arent_validated(self):
+        url = reverse('copy_list', args=[self.issue.pk])
+        published = time.time_ns()
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_pages(f'issue:{self.issue.pk}')
+        with mock.patch('censusapp.page_cache.snapshot_version', return_value=published):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn('no-store', response['Cache-Control'])
+
+        with mock.patch('censusapp.page_cache.snapshot_version', return_value=time.time_ns()):
+            response = self.client.get(url)
+            self.assertIn('ETag', response)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+    # An edit changes the issue's tag before its snapshot is published. The page built from the old snapshot must not
+    # carry validators, or the browser would revalidate it against the new snapshot and be told to keep it.
+
+    def test_api_etag_follows_the_snapshot(self):
+        url = reverse('api_list', args=['copies'])
+        with mock.patch('censusapp.api.snapshot_version', return_value=1):
+            etag = self.client.get(url)['ETag']
+            with self.captureOnCommitCallbacks(execute=True):
+                invalidate_search_backend()
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with mock.patch('censusapp.api.snapshot_version', return_value=2):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+    # Responses read from a snapshot change only when a new snapshot is published, not when an edit is saved.
+
+
+# --- SQLite under concurrent reads and writes ---
+
+class SQLiteConcurrencyTests(TransactionTestCase):
+
+    def setUp(self):
+        edition = models.Edition.objects.create(title=models.Title.objects.create(title='Hamlet'), edition_number=1)
+        issue = models.Issue.objects.create(edition=edition, estc='S101', year='1603')
+        location = models.Location.objects.create(name='The British Library')
+        for number in range(1, 21):
+            models.Copy.objects.create(issue=issue, location=location, census_id=str(number), verification='V')
+
+    def test_readers_and_a_writer_never_fail(self):
+        results = check_sqlite_concurrency(seconds=1, readers=2)
+        self.assertEqual(results['errors'], [])
+        self.assertGreater(results['commits'], 0)
+        self.assertGreater(len(results['latencies']), 0)
+    # Readers and a busy writer share a copy of the test census (with the configured pragmas) for a second, and no
+    # query may fail with "database is locked". How long reads take depends on the machine, so it isn't checked here;
+    # "manage.py check_sqlite_concurrency" reports it.
+
+    def test_saving_doesnt_wait_for_a_long_read(self):
+        pragmas = sqlite_pragmas()
+        if str(pragmas.get('journal_mode', '')).lower() != 'wal':
+            self.skipTest('SQLITE_PRAGMAS does not use WAL mode.')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'census.sqlite3')
+            reader, writer = connect_sqlite(path, pragmas), connect_sqlite(path, pragmas, timeout=0.1)
+            try:
+                writer.execute('CREATE TABLE record (value INTEGER)')
+                writer.execute('INSERT INTO record VALUES (1)')
+                reader.execute('BEGIN')
+                self.assertEqual(reader.execute('SELECT value FROM record').fetchone(), (1,))
+                try:
+                    writer.execute('UPDATE record SET value = 2')
+                except sqlite3.OperationalError as e:
+                    self.fail(f'Saving waited for a reader: {e}')
+                self.assertEqual(reader.execute('SELECT value FROM record').fetchone(), (1,))
+                reader.execute('COMMIT')
+                self.assertEqual(reader.execute('SELECT value FROM record').fetchone(), (2,))
+            finally:
+                reader.close()
+                writer.close()
+    # A visitor's long read (such as an export) keeps seeing the census as it was when it began, and a curator's save
+    # commits straight away instead of waiting for the read to finish. Without WAL mode, the save would fail with
+    # "database is locked".
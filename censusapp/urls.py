@@ -1,22 +1,39 @@
 from django.conf import settings
-from django.urls import path
+from django.urls import path, register_converter
 from django.conf.urls.static import static
 from django.contrib import admin
 from . import views
+from .utils import parse_number
 
 copy_id_prefix = getattr(settings, 'COPY_ID_PREFIX', 'censusnumber').lower()
 
+
+class RecordIdConverter:
+    regex = '[0-9]+'
+
+    def to_python(self, value):
+        number = parse_number(value)
+        if number is None:
+            raise ValueError(value)
+        return number
+
+    def to_url(self, value):
+        return str(value)
+
+register_converter(RecordIdConverter, 'id')
+# Like <int:...>, but an id too large for the database doesn't match the URL, so it gets a 404 rather than an error.
+
 urlpatterns = [
 
     # --- Main site ---
 
     path('', views.homepage, name='homepage'),
     path('homepage/', views.homepage, name='homepage'),
-    path('title/<int:id>/', views.issue_list, name='issue_list'),
-    path('issue/<int:id>/', views.copy_list, name='copy_list'),
+    path('title/<id:id>/', views.issue_list, name='issue_list'),
+    path('issue/<id:id>/', views.copy_list, name='copy_list'),
     path('copy/<str:census_id>/', views.single_copy, name='single_copy'),
     path(f'{copy_id_prefix}/<str:census_id>/', views.single_copy, name='single_copy_by_prefix'),
-    path('copydata/<int:pk>/', views.copy_data, name='copy_data'),
+    path('copydata/<id:pk>/', views.copy_data, name='copy_data'),
     path('search/', views.search, name='search'),
     path('info/<str:viewname>/', views.info, name='info'),
 
@@ -38,6 +55,25 @@ urlpatterns = [
     path('export/provenance_name_copy_count/', views.provenance_name_copy_count_csv_export, name='provenance_name_copy_count'),
 
 
+    # --- JSON API ---
+
+    path('api/changes/', views.api_changes, name='api_changes'),
+    path('api/<str:resource>/', views.api_list, name='api_list'),
+    path('api/<str:resource>/<int:pk>/', views.api_detail, name='api_detail'),
+
+
+    # --- Census jobs ---
+
+    path('jobs/', views.job_list, name='job_list'),
+    path('jobs/<id:pk>/', views.job_detail, name='job_detail'),
+    path('jobs/<id:pk>/artifact/', views.job_artifact, name='job_artifact'),
+
+
+    # --- Request instrumentation ---
+
+    path('instrumentation/', views.instrumentation_report, name='instrumentation_report'),
+
+
     # --- User account management ---
 
     path('login/', views.login_user, name='login_user'),
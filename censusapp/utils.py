@@ -1,7 +1,9 @@
-from django.db.models import Q
+from django.db.models import Q, Value
+from django.db.models.functions import Coalesce, Lower
 from django.conf import settings
 import re
 from . import models
+from .pagination import SQLITE_MAX_INT
 
 
 # --- String Cleaning ---
@@ -18,15 +20,37 @@ def strip_article(s):
     return s
 # This function removes leading articles for correct alphabetization
 
+def parse_number(value, maximum=SQLITE_MAX_INT):
+    if not value or not re.fullmatch(r'[0-9]{1,19}', value):
+        return None
+    number = int(value)
+    return number if number <= maximum else None
+# This function reads a record id (or other whole number) typed into a URL, or returns None if it isn't one that
+# the database could hold. str.isdigit() would also accept other digits, such as "²", which int() can't read.
+
+MAX_CENTURY = 100
+
 def convert_year_range(year):
-    if '-' in year:
-        start, end = [n.strip() for n in year.split('-', 1)]
-        if len(start) == 4 and start.isdigit() and len(end) == 4 and end.isdigit():
-            return int(start), int(end)
-    elif len(year) == 4 and year.isdigit():
-        return int(year), int(year)
-    return False
-# This function allows years and year ranges to be sorted in the correct order
+    text = re.sub(r'[\[\]?]', '', str(year or '')).strip().lower()
+    text = re.sub(r'^(c\.|ca\.|circa)\s*', '', text)
+
+    match = re.fullmatch(r'(before|after)\s+(\d{4})', text)
+    if match:
+        bound = int(match.group(2))
+        return (None, bound - 1) if match.group(1) == 'before' else (bound + 1, None)
+
+    match = re.fullmatch(r'(\d{4})(?:\s*[-\u2013/]\s*(\d{1,2}|\d{4}))?', text)
+    if not match:
+        return False
+    start, end = match.group(1), match.group(2) or match.group(1)
+    end = start[:4 - len(end)] + end
+    if int(end) < int(start):
+        return False
+    return int(start), int(end)
+# This function reads a year or year range ("1623", "c.1630", "[1630?]", "1623-1640", "1623-40", "1623/4") as a
+# (start, end) pair, allowing years and year ranges to be sorted and searched in the correct order.
+# "before 1650" and "after 1700" give open-ended ranges, with None for the missing end.
+# Anything else (such as "[unknown]") gives False.
 
 def split_record(field_value):
     if not field_value:
@@ -68,72 +92,57 @@ def issue_sort_key(issue):
     return (ed_number, unknown_sort, num_sort)
 
 
-# --- Sorting Functions for Copies ---
-
-def copy_location_sort_key(copy):
-    name = copy.location.name if copy.location else ''
-    return strip_article(name)
-
-def copy_shelfmark_sort_key(copy):
-    return copy.shelfmark or ''
+# --- Sort keys stored on Locations and Copies ---
 
-def copy_census_id_sort_key(copy):
-    census_id = copy.census_id or ''
-    try:    
-        if '.' in census_id:
-            census_id_a, census_id_b = map(int, census_id.split('.'))
-        else:
-            census_id_a = int(census_id)
-            census_id_b = 0
-    except (ValueError, TypeError):
-        census_id_a, census_id_b = 0, 0
-    return (census_id_a, census_id_b)
+def location_sort_key(location):
+    return strip_article(location.name)
 
-def copy_sort_key(copy):
-    census_id_a, census_id_b = copy_census_id_sort_key(copy)
-    return (copy_location_sort_key(copy),
-            copy_shelfmark_sort_key(copy),
-            census_id_a,
-            census_id_b)
-
-
-# --- Sorting Functions for Search Results ---
-
-def search_sort_copy_id(copy):
-    s = (copy.census_id or "").strip()
-    if not s:
-        return (2, "", "")  
+def census_id_sort_pair(census_id):
+    match = re.fullmatch(r"([0-9]+)(?:\.([0-9]+))?", (census_id or "").strip())
+    if not match:
+        return (None, None)
+    pair = (parse_number(match.group(1)), parse_number(match.group(2) or '0'))
+    if None in pair:
+        return (None, None)
+    return pair
+# This function splits numeric IDs such as "12" or "12.3" into a pair of integers (12, 0) or (12, 3).
+# Non-numeric and empty IDs have no pair, and sort after the numeric ones. So do IDs with a number too large for the
+# database to store.
 
-    if re.fullmatch(r"\d+(?:\.\d+)?", s):
-        return (0, float(s), s)  
-
-    return (1, s.lower(), s)
-
-def copy_date_sort_key(copy):
-    v = getattr(copy.issue, 'start_date', 0) or 0
-    try:
-        return int(v)
-    except (TypeError, ValueError):
+def census_id_sort_group(census_id):
+    if census_id_sort_pair(census_id) != (None, None):
         return 0
-
-def search_sort_date(copy):
-    return (copy_date_sort_key(copy),
-            title_sort_key(copy.issue.edition.title),
-            copy_location_sort_key(copy))
-
-def search_sort_title(copy):
-    return (title_sort_key(copy.issue.edition.title),
-            copy_date_sort_key(copy),
-            copy_location_sort_key(copy))
-
-def search_sort_location(copy):
-    return (copy_location_sort_key(copy),
-            copy_date_sort_key(copy),
-            title_sort_key(copy.issue.edition.title))
-
-def search_sort_stc(copy):
-    stc = (copy.issue.stc_wing or '')
-    return (stc, copy_location_sort_key(copy))
+    return 1 if census_id else 2
+# Numeric IDs come first, then other IDs, then copies without an ID.
+
+def census_id_sort_number(census_id):
+    match = re.match(r"\d+(?:\.\d*)?(?:[eE][+-]?\d+)?", census_id or "")
+    return float(match.group()) if match else None
+# This function reads the number at the start of an ID ("12.10" gives 12.1 and "12a" gives 12.0), as SQLite's
+# CAST(census_id AS REAL) does, for the Copy admin list. IDs that don't start with a digit have no number.
+
+
+# --- Database orderings for Copies ---
+
+COPY_LIST_ORDERING = [
+    'location__sort_name',
+    Coalesce('shelfmark', Value('')),
+    Coalesce('census_id_a', Value(0)),
+    Coalesce('census_id_b', Value(0)),
+    'pk',
+]
+
+SEARCH_ORDERINGS = {
+    'date': ['issue__start_date', 'issue__edition__title__sort_title', 'location__sort_name'],
+    'title': ['issue__edition__title__sort_title', 'issue__start_date', 'location__sort_name'],
+    'location': ['location__sort_name', 'issue__start_date', 'issue__edition__title__sort_title'],
+    'stc': [Coalesce('issue__stc_wing', Value('')), 'location__sort_name'],
+    'census_id': ['census_id_group', Coalesce('census_id_a', Value(0)), Coalesce('census_id_b', Value(0)),
+                  Lower(Coalesce('census_id', Value('')))],
+    'relevance': ['search_rank'],
+}
+# These orderings use the sort keys saved on Titles, Locations and Copies, so the database does all the sorting.
+# Each one ends with the primary key (added in the view) so that ties always come out in the same order.
 
 
 # --- Verification Queries ---
@@ -144,6 +153,21 @@ false_query = Q(verification='F')
 canonical_query = (Q(verification='V') |
                     Q(verification='U'))
 
+facsimile_query = ~(Q(digital_facsimile_url__isnull=True) | Q(digital_facsimile_url=''))
+
+
+# --- Keyword Search ---
+
+KEYWORD_FIELDS = ['binding', 'sammelband_notes', 'marginalia', 'local_notes', 'provenance_notes', 'bibliography']
+# These are the Copy fields covered by Keyword Search (along with the names of linked Provenance Names).
+
+def keyword_query(value):
+    query = Q(provenance_names__name__icontains=value)
+    for field in KEYWORD_FIELDS:
+        query |= Q(**{f'{field}__icontains': value})
+    return query
+# This function is the plain database version of Keyword Search, used when no full-text index is available.
+
 
 # --- Search options ---
 
@@ -155,6 +179,13 @@ SEARCH_DISPLAY_NAMES = {
     'collection': 'Specific Features',
     'year': 'Year',
     'stc': 'STC / Wing',
+    'century': 'Century',
+    'continent': 'Continent',
+    'country': 'Country',
+    'title': 'Title',
+    'verification': 'Verification',
+    'fragment': 'Fragment',
+    'facsimile': 'Digital Facsimile',
 }
 
 def get_display_field(field_name):
@@ -162,52 +193,103 @@ def get_display_field(field_name):
         return f"{getattr(settings, 'COPY_ID_PREFIX', 'ID')}\u202f#"
     return SEARCH_DISPLAY_NAMES.get(field_name, field_name)
 
+def century_label(century):
+    suffix = 'th' if 10 <= century % 100 <= 20 else {1: 'st', 2: 'nd', 3: 'rd'}.get(century % 10, 'th')
+    return f'{century}{suffix} century'
+
 
 # --- Specific Features options ---
 
+FEATURE_DISPLAY_NAMES = {
+    'earlyprovenance': 'Copies with known early provenance (before 1700)',
+    'womanowner': 'Copies with a known woman owner',
+    'earlywomanowner': 'Copies with a known woman owner before 1800',
+    'marginalia': 'Copies that include marginalia',
+    'earlysammelband': 'Copies in an early sammelband',
+    'unverified': 'Unverified copies',
+    'ghost': 'Ghost copies',
+}
+
+FEATURE_BITS = {name: 1 << i for i, name in enumerate(FEATURE_DISPLAY_NAMES)}
+# Each Specific Feature has one bit in Copy.features. New features must be added at the end, followed by
+# running the refresh_copy_features command, so that the bits of existing features keep their meaning.
+
+def copy_features(copy, owners):
+    features = set()
+    for start_century, gender in owners:
+        if start_century == '17':
+            features.add('earlyprovenance')
+        if gender == 'F':
+            features.add('womanowner')
+            if start_century in ('17', '18'):
+                features.add('earlywomanowner')
+    if copy.marginalia:
+        features.add('marginalia')
+    if copy.in_early_sammelband:
+        features.add('earlysammelband')
+    if copy.verification == 'U':
+        features.add('unverified')
+    elif copy.verification == 'F':
+        features.add('ghost')
+    return sum(FEATURE_BITS[name] for name in features)
+# This function works out the features bitset of a copy, given the (start century, gender) of each of its owners.
+
+OWNER_FEATURE_BITS = FEATURE_BITS['earlyprovenance'] | FEATURE_BITS['womanowner'] | FEATURE_BITS['earlywomanowner']
+
+def updated_copy_features(copy):
+    return (copy.features & OWNER_FEATURE_BITS) | copy_features(copy, [])
+# This function works out the features of a copy after its own fields have changed, keeping the features that come
+# from its owners as they were stored. Those are kept up to date by the signals whenever the owners change, so saving
+# a copy doesn't have to look its owners up again.
+
+def refresh_copy_features(copy_ids, chunk_size=500):
+    copy_ids = list(copy_ids)
+    updated = 0
+    for i in range(0, len(copy_ids), chunk_size):
+        chunk = copy_ids[i:i + chunk_size]
+        owners = {copy_id: [] for copy_id in chunk}
+        ownerships = models.ProvenanceOwnership.objects.filter(copy_id__in=chunk)
+        for copy_id, start_century, gender in ownerships.values_list('copy_id', 'owner__start_century', 'owner__gender'):
+            owners[copy_id].append((start_century, gender))
+
+        changed = []
+        for copy in models.Copy.objects.filter(pk__in=chunk).only('marginalia', 'in_early_sammelband', 'verification', 'features'):
+            features = copy_features(copy, owners[copy.pk])
+            if features != copy.features:
+                copy.features = features
+                changed.append(copy)
+        models.Copy.objects.bulk_update(changed, ['features'])
+        updated += len(changed)
+    return updated
+# This function recalculates the stored features of the given copies after their owners have changed.
+
+def feature_query(*feature_names):
+    mask = sum(FEATURE_BITS[name] for name in feature_names)
+    return Q(features__in=[value for value in range(1 << len(FEATURE_BITS)) if value & mask == mask])
+# This query matches copies with all of the given features, as a lookup on the index of Copy.features.
+
+def collection_features(collection_name):
+    feature_names = collection_name.split(',') if collection_name else []
+    if not feature_names or any(name not in FEATURE_BITS for name in feature_names):
+        return []
+    return feature_names
+
+def collection_display(collection_name):
+    feature_names = collection_features(collection_name)
+    if not feature_names:
+        return 'Specific Features'
+    return '; '.join(FEATURE_DISPLAY_NAMES[name] for name in feature_names)
+
 def get_collection(copy_list, collection_name):
-    if collection_name == 'ghost':
-        return models.Copy.objects.filter(false_query), 'Ghost copies'
-    
-    feature_map = {
-        'earlyprovenance': {
-            'filter': copy_list.filter(provenance_names__start_century='17'),
-            'display': 'Copies with known early provenance (before 1700)'
-        },
-        'womanowner': {
-            'filter': copy_list.filter(provenance_names__gender='F'),
-            'display': 'Copies with a known woman owner'
-        },
-        'earlywomanowner': {
-            'filter': copy_list.filter(Q(provenance_names__gender='F') &
-                                       (Q(provenance_names__start_century='17') |
-                                        Q(provenance_names__start_century='18'))),
-            'display': 'Copies with a known woman owner before 1800'
-        },
-        'marginalia': {
-            'filter': copy_list.exclude(Q(marginalia='') | Q(marginalia=None)),
-            'display': 'Copies that include marginalia'
-        },
-        'earlysammelband': {
-            'filter': copy_list.filter(in_early_sammelband=True),
-            'display': 'Copies in an early sammelband'
-        },
-        'unverified': {
-            'filter': copy_list.filter(unverified_query),
-            'display': 'Unverified copies'
-        },
-        'ghost': {
-            'filter': models.Copy.objects.filter(false_query),
-            'display': 'Ghost copies'
-        }
-    }
-
-    feature = feature_map.get(collection_name)
-    if feature:
-        return feature['filter'], feature['display']
-    else:
-        return copy_list.none(), 'Specific Features'
-    
+    feature_names = collection_features(collection_name)
+    if not feature_names:
+        return copy_list.none()
+    if 'ghost' in feature_names:
+        copy_list = models.Copy.objects.all()
+    return copy_list.filter(feature_query(*feature_names))
+# Several features can be combined with commas (for example "womanowner,marginalia") to find copies with all of them.
+# Ghost copies are searched among all copies, since they are never part of the census itself.
+
 
 # --- Context Processor for Census Globals ---
 def census_globals(request):
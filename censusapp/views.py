@@ -1,28 +1,42 @@
-from django.http import HttpResponse, JsonResponse, Http404
+from django.conf import settings
+from django.http import FileResponse, JsonResponse, Http404, QueryDict, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render, redirect
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import authenticate, login, logout
-from django.db.models import Q, Count
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.shortcuts import render
-from django.views.decorators.http import require_GET
+from django.urls import reverse
+from django.views.decorators.http import require_GET, require_http_methods
 from . import models
+from .api import ApiError, api_etag, get_record, get_resource, list_records
+from .autocomplete import AUTOCOMPLETE_MAX_AGE, suggest
+from .changes import CHANGE_FEED_LIMIT, CHANGE_FEED_MAX_LIMIT, changes_since
+from .database import reads_snapshot
+from .exports import EXPORTS, stream_csv
+from .instrumentation import recorder
+from .jobs import JOB_KINDS, JOB_QUEUE_EXPORTS, artifact_path, current_artifact, enqueue, job_status
+from .page_cache import cached_page, depends_on
+from .pagination import SQLITE_MAX_INT
+from .result_sets import get_result_set_query, remember_result_set, resolve_result_set
+from .search_backends import get_search_backend
+from .stats import STATISTIC_NAMES, get_statistics
 from .utils import (
-    convert_year_range, 
-    title_sort_key, issue_sort_key, copy_sort_key, search_sort_copy_id, 
-    search_sort_date, search_sort_title, search_sort_location, search_sort_stc, 
-    verified_query, unverified_query, canonical_query, 
-    get_display_field, get_collection,
+    COPY_LIST_ORDERING, SEARCH_ORDERINGS,
+    canonical_query, 
+    get_display_field,
 )
 from datetime import datetime
 from collections import Counter
-import csv
+from string import Formatter
 
 # --- Main Pages ---
 
+@reads_snapshot
+@cached_page('titles')
 def homepage(request):
     gridwidth = 5
-    titles = models.Title.objects.all()
-    titles = sorted(titles, key=title_sort_key)
+    titles = list(models.Title.objects.order_by('sort_title', 'pk'))
     titlerows = [titles[i: i + gridwidth]
                  for i in range(0, len(titles), gridwidth)]
     context = {
@@ -32,6 +46,8 @@ def homepage(request):
     }
     return render(request, 'census/frontpage.html', context)
 
+@reads_snapshot
+@cached_page('title:{id}')
 def issue_list(request, id):
     selected_title = get_object_or_404(models.Title, pk=id)
     editions = list(selected_title.editions.order_by('edition_number'))
@@ -55,10 +71,12 @@ def issue_list(request, id):
     }
     return render(request, 'census/issue-list.html', context)
 
+@reads_snapshot
+@cached_page('issue:{id}')
 def copy_list(request, id):
-    selected_issue = get_object_or_404(models.Issue, pk=id)
-    copies = models.Copy.objects.filter(canonical_query, issue=selected_issue)
-    copies = sorted(copies, key=copy_sort_key)
+    selected_issue = get_object_or_404(models.Issue.objects.select_related('edition__title'), pk=id)
+    copies = models.Copy.objects.for_list().filter(canonical_query, issue=selected_issue)
+    copies = list(copies.order_by(*COPY_LIST_ORDERING))
     context = {
         'title': selected_issue.edition.title,
         'selected_issue': selected_issue,
@@ -68,8 +86,9 @@ def copy_list(request, id):
     }
     return render(request, 'census/copy-list.html', context)
 
+@reads_snapshot
 def single_copy(request, census_id):
-    selected_copy = get_object_or_404(models.Copy, census_id=census_id)
+    selected_copy = get_object_or_404(models.Copy.objects.for_list(), census_id=census_id)
     copies = [selected_copy]
     selected_issue = selected_copy.issue
     context = {
@@ -82,8 +101,10 @@ def single_copy(request, census_id):
     }
     return render(request, 'census/copy-list.html', context)
 
+@reads_snapshot
+@cached_page('copy:{pk}')
 def copy_data(request, pk):
-    selected_copy = get_object_or_404(models.Copy, pk=pk)
+    selected_copy = get_object_or_404(models.Copy.objects.for_detail(), pk=pk)
     context = {"copy": selected_copy}
     return render(request, 'census/copy-modal.html', context)
 
@@ -119,90 +140,59 @@ def logout_user(request):
 
 # --- Search ---
 
+@reads_snapshot
 def search(request, field=None, value=None, order=None):
     field = field or request.GET.get('field')
     value = value or request.GET.get('value')
     order = order or request.GET.get('order')
-    initial_field = request.GET.get('initial_field')
-    initial_value = request.GET.get('initial_value')
-    initial_ids = request.GET.getlist('initial_ids')
+    within = request.GET.get('within')
 
-    canonical_copies = models.Copy.objects.filter(canonical_query)
+    backend = get_search_backend()
+    copies = backend.all_copies()
 
-    if initial_ids:
-        canonical_copies = canonical_copies.filter(pk__in=initial_ids)
+    initial_query = get_result_set_query(within)
+    if initial_query:
+        refined_copies = resolve_result_set(within, backend, copies)
+        if refined_copies is None:
+            initial_query = None
+        else:
+            copies = refined_copies
+    if not initial_query:
+        within = None
 
     if not field and value:
         field = 'keyword'
 
-    display_field = get_display_field(field)
-    display_value = value
-
-    if field == 'keyword':
-        query = (
-            Q(binding__icontains=value) |
-            Q(sammelband_notes__icontains=value) |
-            Q(marginalia__icontains=value) |
-            Q(local_notes__icontains=value) |
-            Q(provenance_notes__icontains=value) |
-            Q(provenance_names__name__icontains=value) |
-            Q(bibliography__icontains=value)
-        )
-        result_list = canonical_copies.filter(query)
-
-    elif field == 'location' and value:
-        result_list = canonical_copies.filter(location__name__icontains=value)
-
-    elif field == 'geography' and value:
-        result_list = canonical_copies.filter(
-            Q(location__city__icontains=value) |
-            Q(location__state__icontains=value) |
-            Q(location__country__icontains=value) |
-            Q(location__continent__icontains=value)
-        )
-
-    elif field == 'provenance_name' and value:
-        result_list = canonical_copies.filter(provenance_names__name__icontains=value)
-
-    elif field == 'collection':
-        result_list, display_field = get_collection(canonical_copies, value)
-        display_value = 'All'
-
-    elif field == 'year' and value:
-        year_range = convert_year_range(value)
-        if year_range:
-            start, end = year_range
-            result_list = canonical_copies.filter(issue__start_date__lte=end, issue__end_date__gte=start)
-        else:
-            result_list = canonical_copies.filter(issue__year__icontains=value)
-
-    elif field == 'stc' and value:
-        result_list = canonical_copies.filter(issue__stc_wing__icontains=value)
-
-    elif field == 'census_id' and value:
-        result_list = canonical_copies.filter(census_id=value)
+    results, display_field, display_value = backend.filter(copies, field, value)
 
-    else:
-        result_list = models.Copy.objects.none()
-
-    result_list = result_list.distinct()
+    initial_field = initial_query['field'] if initial_query else None
+    initial_value = (initial_query['value'] or 'All') if initial_query else None
     initial_display_field = get_display_field(initial_field)
 
-    if not order:
+    if order not in SEARCH_ORDERINGS or (order == 'relevance' and field != 'keyword'):
         order = 'date'
 
-    if order == 'date':
-        result_list = sorted(result_list, key=search_sort_date)
-    elif order == 'title':
-        result_list = sorted(result_list, key=search_sort_title)
-    elif order == 'location':
-        result_list = sorted(result_list, key=search_sort_location)
-    elif order == 'stc':
-        result_list = sorted(result_list, key=search_sort_stc)
-    elif order == 'census_id':
-        result_list = sorted(result_list, key=search_sort_copy_id)
-
-    current_ids = [copy.pk for copy in result_list]
+    default_page_size = getattr(settings, 'SEARCH_PAGE_SIZE', 100)
+    try:
+        page_size = int(request.GET.get('page_size', default_page_size))
+    except ValueError:
+        page_size = default_page_size
+    page_size = max(1, min(page_size, getattr(settings, 'SEARCH_MAX_PAGE_SIZE', 500)))
+
+    copy_count = results.count()
+    page = results.page(order, page_size, after=request.GET.get('after'), before=request.GET.get('before'))
+    result_token = remember_result_set(field, value, within) if copy_count else None
+    facets = results.facets() if copy_count else []
+
+    base_query = QueryDict(mutable=True)
+    for name, param in [('field', field), ('value', value), ('within', within)]:
+        if param:
+            base_query[name] = param
+    if 'page_size' in request.GET:
+        base_query['page_size'] = page_size
+    sort_query = base_query.urlencode()
+    base_query['order'] = order
+    page_query = base_query.urlencode()
 
     icon_path = 'census/images/ghost.png' if field == 'collection' and value == 'ghost' else 'census/images/question-mark.png'
 
@@ -214,11 +204,15 @@ def search(request, field=None, value=None, order=None):
         'display_field': display_field,
         'display_value': display_value,
         'initial_display_field': initial_display_field,
-        'result_list': result_list,
-        'copy_count': len(result_list),
-        'initial_ids': current_ids,
+        'result_list': page.object_list,
+        'page': page,
+        'copy_count': copy_count,
+        'result_token': result_token,
+        'facets': facets,
         'icon_path': icon_path,
         'order': order,
+        'sort_query': sort_query,
+        'page_query': page_query,
     }
 
     return render(request, 'census/search-results.html', context)
@@ -226,34 +220,25 @@ def search(request, field=None, value=None, order=None):
 
 # --- Autofill ---
 
+def autofill_response(field, query):
+    response = JsonResponse({'matches': suggest(field, query)})
+    patch_cache_control(response, public=True, max_age=AUTOCOMPLETE_MAX_AGE)
+    return response
+
+@reads_snapshot
 @require_GET
 def autofill_location(request, query=None):
-    matches = []
-    if query:
-        matches = models.Location.objects.filter(name__icontains=query).values_list('name', flat=True)
-    return JsonResponse({'matches': list(matches)})
+    return autofill_response('location', query)
 
+@reads_snapshot
 @require_GET
 def autofill_geography(request, query=None):
-    if not query:
-        return JsonResponse({'matches': []})
-    
-    fields = ['city', 'state', 'country', 'continent']
-    matches = set()
-
-    for field in fields:
-        values = models.Location.objects.filter(**{f'{field}__icontains': query}).values_list(field, flat=True)
-        matches.update(values)
-    
-    filtered_matches = sorted({m.strip() for m in matches if m and m.strip()})
-    return JsonResponse({'matches': filtered_matches})
+    return autofill_response('geography', query)
 
+@reads_snapshot
 @require_GET
 def autofill_provenance(request, query=None):
-    matches = []
-    if query:
-        matches = models.ProvenanceName.objects.filter(name__icontains=query).values_list('name', flat=True)
-    return JsonResponse({'matches': list(matches)})
+    return autofill_response('provenance', query)
 
 @require_GET
 def autofill_collection(request, query=None):
@@ -271,45 +256,30 @@ def autofill_collection(request, query=None):
 
 # --- Static Pages ---
 
+@reads_snapshot
+@cached_page('info:{viewname}', daily=True)
 def info(request, viewname):
     DISPLAY_NAMES = {
     'about': 'About',
     'advisoryboard': 'Advisory Board',
     'references': 'References',
 }
-    current_date = datetime.now().strftime('%d %B %Y')
-    canonical_count = models.Copy.objects.filter(canonical_query).count()
-    copy_count = models.Copy.objects.filter(canonical_query & Q(fragment=False)).count()
-    fragment_copy_count = models.Copy.objects.filter(canonical_query & Q(fragment=True)).count()
-    verified_copy_count = models.Copy.objects.filter(verified_query).count()
-    unverified_copy_count = models.Copy.objects.filter(unverified_query).count()
-    estc_copy_count = models.Copy.objects.filter(canonical_query, from_estc=True).count()
-    non_estc_copy_count = models.Copy.objects.filter(canonical_query, from_estc=False).count()
-    facsimile_copy_count = models.Copy.objects.filter(canonical_query).exclude(Q(digital_facsimile_url__isnull=True) | Q(digital_facsimile_url='')).count()
-    facsimile_copy_percent = round(
-        100 * facsimile_copy_count / canonical_count
-    ) if canonical_count else 0
-    context = {
-        'page_name': DISPLAY_NAMES.get(viewname, viewname.title()),
-        'current_date': current_date,
-        'canonical_count': canonical_count,
-        'copy_count': copy_count,
-        'verified_copy_count': verified_copy_count,
-        'unverified_copy_count': unverified_copy_count,
-        'fragment_copy_count': fragment_copy_count,
-        'estc_copy_count': estc_copy_count,
-        'non_estc_copy_count': non_estc_copy_count,
-        'facsimile_copy_count': facsimile_copy_count,
-        'facsimile_copy_percent': f'{facsimile_copy_percent}%',
-    }
-
     try:
         page = models.StaticPageText.objects.get(viewname=viewname)
     except models.StaticPageText.DoesNotExist:
         raise Http404("Page not found")
 
+    context = {
+        'page_name': DISPLAY_NAMES.get(viewname, viewname.title()),
+        'current_date': datetime.now().strftime('%d %B %Y'),
+    }
+
     raw = page.content or ''
     try:
+        placeholders = {name for _, name, _, _ in Formatter().parse(raw) if name}
+        if placeholders & STATISTIC_NAMES:
+            depends_on(request, 'statistics')
+            context.update(get_statistics())
         formatted_content = raw.format(**context)
     except Exception:
         formatted_content = raw  # fall back if placeholders don't match
@@ -320,108 +290,132 @@ def info(request, viewname):
     
 # --- CSV Exports ---
 
-def location_copy_count_csv_export(request):
-    locations = models.Copy.objects.filter(canonical_query).values('location')
-    locations = locations.annotate(total=Count('location')).order_by('location__name')
-
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="location_copy_count.csv"'
-
-    writer = csv.writer(response)
-    writer.writerow(['Location', 'Number of Copies'])
-
-    for loc in locations:
-        writer.writerow([models.Location.objects.get(pk=loc['location']).name, loc['total']])
-
+def csv_export_response(request, name):
+    path = current_artifact(name)
+    if path is not None:
+        try:
+            return FileResponse(open(path, 'rb'), content_type='text/csv', as_attachment=True, filename=f'{name}.csv')
+        except FileNotFoundError:
+            pass
+    if JOB_QUEUE_EXPORTS and request.user.is_staff:
+        enqueue(name)
+    response = StreamingHttpResponse(stream_csv(EXPORTS[name]()), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{name}.csv"'
     return response
+# If a census job has already written this export and nothing has changed since, its file is sent as it is.
+# Otherwise the export is streamed as it is counted. When staff download it, a job is also queued to write it for the
+# next download; visitors never write to the database, so they can't fill the job queue.
 
-def title_copy_count_csv_export(request):
-    titles = models.Copy.objects.filter(canonical_query).values('issue__edition__title')
-    titles = titles.annotate(total=Count('id'))
-
-    title_map = {
-        t.id: t for t in models.Title.objects.filter(
-            id__in=[e['issue__edition__title'] for e in titles]
-        )
-    }
-    for e in titles:
-        e['title_obj'] = title_map[e['issue__edition__title']]
-    titles = sorted(titles, key=lambda e: title_sort_key(e['title_obj']))
-
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="title_copy_count.csv"'
-
-    writer = csv.writer(response)
-    writer.writerow(['Title', 'Number of Copies'])
-
-    for entry in titles:
-        title = entry['title_obj']
-        writer.writerow([title.title, entry['total']])
+@reads_snapshot
+def location_copy_count_csv_export(request):
+    return csv_export_response(request, 'location_copy_count')
 
-    return response
+@reads_snapshot
+def title_copy_count_csv_export(request):
+    return csv_export_response(request, 'title_copy_count')
 
+@reads_snapshot
 def edition_copy_count_csv_export(request):
-    editions = models.Copy.objects.filter(canonical_query).values('issue__edition')
-    editions = editions.annotate(total=Count('id'))
-
-    edition_map = {
-        ed.id: ed for ed in models.Edition.objects.select_related('title').filter(
-            id__in=[e['issue__edition'] for e in editions]
-        )
-    }
-    for e in editions:
-        e['edition'] = edition_map[e['issue__edition']]
-    def edition_sort_key(e):
-        ed = e['edition']
-        try:
-            num = int(ed.edition_number)
-        except (ValueError, TypeError):
-            num = float('inf')
-        return (ed.title.title.lower(), num)
+    return csv_export_response(request, 'edition_copy_count')
 
-    editions = sorted(editions, key=edition_sort_key)
+@reads_snapshot
+def issue_copy_count_csv_export(request):
+    return csv_export_response(request, 'issue_copy_count')
 
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="edition_copy_count.csv"'
+@reads_snapshot
+def provenance_name_copy_count_csv_export(request):
+    return csv_export_response(request, 'provenance_name_copy_count')
 
-    writer = csv.writer(response)
-    writer.writerow(['Edition', 'Number of Copies'])
 
-    for entry in editions:
-        ed = entry['edition']
-        writer.writerow([f"{ed.title.title} Edition {ed.edition_number}", entry['total']])
+# --- JSON API ---
 
+def api_response(request, build):
+    etag = api_etag(request)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        try:
+            payload = build()
+        except ApiError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        if payload is None:
+            return JsonResponse({'error': 'Not found.'}, status=404)
+        response = JsonResponse(payload)
+    response.headers['ETag'] = etag
+    patch_cache_control(response, public=True, no_cache=True)
     return response
+# Clients can send back the ETag of a response with If-None-Match, and get a 304 Not Modified until the census changes.
 
-def issue_copy_count_csv_export(request):
-    issues = models.Copy.objects.filter(canonical_query).values('issue')
-    issues = issues.annotate(total=Count('id')).order_by('issue__edition__title__title', 'issue__estc')
+@reads_snapshot
+@require_GET
+def api_list(request, resource):
+    return api_response(request, lambda: list_records(get_resource(resource), request.GET, request.path))
 
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="issue_copy_count.csv"'
+@reads_snapshot
+@require_GET
+def api_detail(request, resource, pk):
+    return api_response(request, lambda: get_record(get_resource(resource), pk, request.GET))
+
+@reads_snapshot
+@require_GET
+def api_changes(request):
+    def feed():
+        try:
+            since = int(request.GET.get('since', 0))
+            limit = int(request.GET.get('limit', CHANGE_FEED_LIMIT))
+        except ValueError:
+            raise ApiError('"since" and "limit" must be numbers.')
+        return changes_since(min(max(since, 0), SQLITE_MAX_INT), max(1, min(limit, CHANGE_FEED_MAX_LIMIT)))
+    return api_response(request, feed)
+# Mirrors poll /api/changes/?since=<seq> for the records created, updated or deleted since they last looked.
+# A "since" beyond any sequence number the database can hold is read as the largest one, which has no changes after it.
 
-    writer = csv.writer(response)
-    writer.writerow(['Issue (Title + ESTC)', 'Number of Copies'])
 
-    for entry in issues:
-        issue = models.Issue.objects.get(pk=entry['issue'])
-        writer.writerow([f"{issue.edition.title.title} (ESTC {issue.estc})", entry['total']])
+# --- Request instrumentation ---
 
+@staff_member_required
+@require_GET
+def instrumentation_report(request):
+    response = JsonResponse(recorder.report(), json_dumps_params={'indent': 2})
+    patch_cache_control(response, private=True, no_store=True)
     return response
+# Staff can see how long each view has been taking, and the slowest queries of recent slow requests, as JSON.
 
-def provenance_name_copy_count_csv_export(request):
-    ownerships = models.ProvenanceOwnership.objects.filter(
-        copy__in=models.Copy.objects.filter(canonical_query)
-    ).values('owner').annotate(total=Count('copy')).order_by('owner__name')
 
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="provenance_name_copy_count.csv"'
+# --- Census jobs ---
 
-    writer = csv.writer(response)
-    writer.writerow(['Provenance Name', 'Bio', 'VIAF', 'Gender', 'Start Century', 'End Century', 'Number of Copies'])
+def _job_status(job):
+    return job_status(job, reverse('job_artifact', args=[job.pk]))
 
-    for entry in ownerships:
-        owner = models.ProvenanceName.objects.get(pk=entry['owner'])
-        writer.writerow([owner.name, owner.bio, owner.viaf, owner.gender, owner.start_century, owner.end_century, entry['total']])
+@staff_member_required
+@require_http_methods(['GET', 'POST'])
+def job_list(request):
+    if request.method == 'POST':
+        try:
+            priority = request.POST.get('priority')
+            job = enqueue(request.POST.get('kind', ''), priority=int(priority) if priority else None)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse(_job_status(job), status=202)
+    jobs = models.CensusJob.objects.order_by('-pk')[:50]
+    response = JsonResponse({'kinds': list(JOB_KINDS), 'jobs': [_job_status(job) for job in jobs]})
+    patch_cache_control(response, private=True, no_store=True)
+    return response
+# Staff can POST kind=<job> (and optionally priority=<number>) to queue an export, a dump of the census, a recount
+# of the statistics, a rebuild of the keyword index or a new snapshot, which the job workers then run, and GET this
+# page to follow the recent jobs and their progress.
 
+@staff_member_required
+@require_GET
+def job_detail(request, pk):
+    response = JsonResponse(_job_status(get_object_or_404(models.CensusJob, pk=pk)))
+    patch_cache_control(response, private=True, no_store=True)
     return response
+
+@staff_member_required
+@require_GET
+def job_artifact(request, pk):
+    job = get_object_or_404(models.CensusJob, pk=pk)
+    path = artifact_path(job)
+    if path is None or not path.is_file():
+        raise Http404('This job has no file.')
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=job.artifact.split('-', 1)[-1])
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'censusapp.settings')
 
 application = get_wsgi_application()
+
+from censusapp.search_backends import get_search_backend  # noqa: E402
+get_search_backend().prepare()
+# Backends that keep an index in memory load it here, as each worker starts, rather than on the first search.